@@ -0,0 +1,166 @@
+"""
+Local Vector Store Benchmark
+Compares latency and recall of the embedded vector store against Milvus on the same data
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+from pymilvus import connections, Collection
+
+from main import (
+    LocalVectorStore,
+    describe_milvus_collection,
+    milvus_search_params,
+    milvus_vectors,
+    chunk_store,
+    LOCAL_VECTOR_DIR,
+    MILVUS_COLLECTION,
+    logger
+)
+
+def percentile_ms(samples: List[float], q: float) -> float:
+    return float(np.percentile(samples, q) * 1000) if samples else 0.0
+
+def sync_from_milvus(collection: Collection, store: LocalVectorStore, batch_size: int = 1000):
+    """Copy every vector and its fields from Milvus (and the chunk store) into the local store"""
+    fields = {field.name for field in collection.schema.fields}
+    compact = "content" not in fields
+    iterator = collection.query_iterator(
+        batch_size=batch_size,
+        expr="id >= 0",
+        output_fields=["id", "title", "source", "chunk_index"] + ([] if compact else ["embedding", "content"])
+    )
+    copied = 0
+    while True:
+        rows = iterator.next()
+        if not rows:
+            break
+        rows = [dict(row) for row in rows if int(row["id"]) not in store.positions]
+        if compact:
+            # Text and full-precision vectors live in the chunk store
+            stored = chunk_store.get([int(row["id"]) for row in rows], vectors=True)
+            rows = [
+                dict(row, content=stored[int(row["id"])]["content"], embedding=stored[int(row["id"])]["embedding"])
+                for row in rows if int(row["id"]) in stored
+            ]
+        if rows:
+            store.add(
+                [row["embedding"] for row in rows],
+                [
+                    {
+                        "content": row["content"],
+                        "title": row["title"],
+                        "source": row["source"],
+                        "chunk_index": row["chunk_index"]
+                    }
+                    for row in rows
+                ],
+                [int(row["id"]) for row in rows]
+            )
+        copied += len(rows)
+    iterator.close()
+    logger.info(f"Copied {copied} vectors from Milvus into {store.directory}")
+
+def recall_at_k(results: List[List[int]], truth: List[List[int]], k: int) -> float:
+    return float(np.mean([len(set(r[:k]) & set(t[:k])) / k for r, t in zip(results, truth)]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--local-dir", default=LOCAL_VECTOR_DIR)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--noise", type=float, default=0.05, help="Relative noise added to sampled query vectors")
+    parser.add_argument("--search-params", help="Milvus search params as JSON; defaults to those the API uses")
+    parser.add_argument("--ivf-nlist", type=int, default=0, help="Also benchmark the local IVF layer with this many lists")
+    parser.add_argument("--ivf-nprobe", type=int, default=32)
+    parser.add_argument("--sync", action="store_true", help="Copy Milvus data into the local store first")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    connections.connect(
+        alias="default",
+        host=os.getenv("MILVUS_HOST", "milvus-standalone"),
+        port=int(os.getenv("MILVUS_PORT", "19530"))
+    )
+    collection = Collection(MILVUS_COLLECTION)
+    collection.load()
+    describe_milvus_collection(collection)
+    search_param = milvus_search_params(args.top_k)
+    if args.search_params:
+        search_param["params"] = json.loads(args.search_params)
+
+    store = LocalVectorStore(args.local_dir)
+    store.refresh()
+    if args.sync:
+        sync_from_milvus(collection, store)
+
+    if store.live_count == 0:
+        raise SystemExit("Local store is empty; run with --sync to copy Milvus data")
+    if store.live_count != collection.num_entities:
+        logger.warning(f"Local store has {store.live_count} vectors, Milvus has {collection.num_entities}")
+
+    # Queries are perturbed copies of stored vectors, so both engines see realistic neighbours
+    rng = np.random.default_rng(42)
+    live = np.flatnonzero(store.alive[:store.count])
+    sample = store.matrix[np.sort(rng.choice(live, size=min(args.queries, len(live)), replace=False))]
+    scale = np.linalg.norm(sample, axis=1, keepdims=True) / np.sqrt(sample.shape[1])
+    queries = sample + rng.standard_normal(sample.shape).astype(np.float32) * scale * args.noise
+
+    report: Dict[str, Dict[str, float]] = {}
+
+    truth, timings = [], []
+    for query in queries:
+        started = time.perf_counter()
+        truth.append([row_id for row_id, _ in store.search(query, args.top_k)])
+        timings.append(time.perf_counter() - started)
+    report["local_exact"] = {
+        "p50_ms": percentile_ms(timings, 50),
+        "p95_ms": percentile_ms(timings, 95),
+        f"recall@{args.top_k}": 1.0
+    }
+
+    results, timings = [], []
+    for query in queries:
+        started = time.perf_counter()
+        hits = collection.search(
+            data=milvus_vectors([query]),
+            anns_field="embedding",
+            param=search_param,
+            limit=args.top_k
+        )
+        timings.append(time.perf_counter() - started)
+        results.append([int(hit.id) for hit in hits[0]])
+    report["milvus"] = {
+        "p50_ms": percentile_ms(timings, 50),
+        "p95_ms": percentile_ms(timings, 95),
+        f"recall@{args.top_k}": recall_at_k(results, truth, args.top_k)
+    }
+
+    if args.ivf_nlist:
+        store.build_ivf(args.ivf_nlist)
+        results, timings = [], []
+        for query in queries:
+            started = time.perf_counter()
+            results.append([row_id for row_id, _ in store.search(query, args.top_k, nprobe=args.ivf_nprobe)])
+            timings.append(time.perf_counter() - started)
+        report["local_ivf"] = {
+            "p50_ms": percentile_ms(timings, 50),
+            "p95_ms": percentile_ms(timings, 95),
+            f"recall@{args.top_k}": recall_at_k(results, truth, args.top_k)
+        }
+
+    print(f"{store.live_count} vectors, {len(queries)} queries, top_k={args.top_k}")
+    for engine, metrics in report.items():
+        print(f"{engine:12s} " + "  ".join(f"{name}={value:.3f}" for name, value in metrics.items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"vectors": store.live_count, "queries": len(queries), "results": report}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
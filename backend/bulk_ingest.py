@@ -0,0 +1,216 @@
+"""
+Bulk Ingestion
+Loads a whole corpus (a directory tree or a JSONL manifest) through the same chunking,
+embedding and storage path as uploads, resuming from a checkpoint file
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import main
+from main import (
+    initialize_clients,
+    initialize_milvus_collection,
+    load_local_vector_store,
+    load_lexical_index,
+    save_lexical_index,
+    close_openrouter_client,
+    process_document_chunks,
+    supabase_writer,
+    chunk_legal_text,
+    iter_document_lines,
+    get_milvus_collection,
+    run_milvus,
+    parse_document_date,
+    lexical_state,
+    milvus_executor,
+    VECTOR_ENGINE,
+    INGEST_WINDOW_CHUNKS,
+    logger
+)
+
+SUPPORTED_EXTENSIONS = {'.pdf', '.txt', '.docx', '.md'}
+
+def discover_directory(root: str, user_id: Optional[str]) -> List[Dict[str, Any]]:
+    """One entry per supported file; the relative path is the document's source"""
+    entries = []
+    for directory, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS:
+                path = os.path.join(directory, filename)
+                entries.append({"path": path, "source": os.path.relpath(path, root), "user_id": user_id})
+    return sorted(entries, key=lambda entry: entry["source"])
+
+def read_manifest(path: str, user_id: Optional[str]) -> List[Dict[str, Any]]:
+    """JSONL with a "path" per line, plus optional source, title, doc_id, user_id and metadata fields"""
+    base = os.path.dirname(os.path.abspath(path))
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "path" not in entry:
+                raise SystemExit(f"{path}:{line_number}: missing \"path\"")
+            entry["path"] = os.path.join(base, entry["path"])
+            entry.setdefault("source", os.path.basename(entry["path"]))
+            entry.setdefault("user_id", user_id)
+            entries.append(entry)
+    return entries
+
+def document_id(entry: Dict[str, Any]) -> str:
+    # Same derivation as /api/documents/upload, so uploads and bulk loads update each other
+    return entry.get("doc_id") or hashlib.md5(f"{entry['user_id']}:{entry['source']}".encode()).hexdigest()
+
+def fingerprint(path: str) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+def read_checkpoint(path: str) -> Dict[str, str]:
+    """doc_id -> file fingerprint of every document already committed"""
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    done[record["doc_id"]] = record["fingerprint"]
+    return done
+
+def append_checkpoint(path: str, records: List[Dict[str, Any]]):
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+class BulkProgress:
+    def __init__(self, total: int):
+        self.total = total
+        self.started = time.perf_counter()
+        self.docs = 0
+        self.chunks = 0
+        self.inserted = 0
+        self.failed: List[str] = []
+
+    def line(self) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return (
+            f"{self.docs}/{self.total} docs, {self.chunks} chunks ({self.inserted} inserted), "
+            f"{len(self.failed)} failed, {self.docs / elapsed:.2f} docs/s, {self.chunks / elapsed:.1f} chunks/s"
+        )
+
+async def ingest_entry(entry: Dict[str, Any], window_size: int) -> Dict[str, int]:
+    metadata = {
+        "jurisdiction": entry.get("jurisdiction") or "",
+        "document_type": entry.get("document_type") or "",
+        "legal_domain": entry.get("legal_domain") or "",
+        "document_date": parse_document_date(entry["document_date"]) if entry.get("document_date") else 0
+    }
+    file_ext = os.path.splitext(entry["path"])[1].lower()
+    chunks = chunk_legal_text(iter_document_lines(entry["path"], file_ext, entry["source"]))
+    return await process_document_chunks(
+        chunks,
+        entry["doc_id"],
+        entry.get("title") or os.path.basename(entry["source"]),
+        entry["source"],
+        entry.get("user_id"),
+        metadata,
+        window_size=window_size,
+        flush=False
+    )
+
+async def run(args):
+    await initialize_clients()
+    await initialize_milvus_collection()
+    await load_local_vector_store()
+    if VECTOR_ENGINE != "local" and not main.milvus_connected:
+        raise SystemExit("Milvus is not reachable")
+
+    # With Redis, lexical changes reach the API processes through the updates stream;
+    # without it, this process maintains the snapshot they load
+    try:
+        lexical_state["publish"] = bool(main.redis_client) and await main.redis_client.ping()
+    except Exception:
+        lexical_state["publish"] = False
+    if not lexical_state["publish"]:
+        await load_lexical_index()
+
+    entries = read_manifest(args.manifest, args.user_id) if args.manifest else discover_directory(args.dir, args.user_id)
+    done = read_checkpoint(args.checkpoint)
+    todo = []
+    for entry in entries:
+        entry["doc_id"] = document_id(entry)
+        entry["fingerprint"] = fingerprint(entry["path"])
+        if done.get(entry["doc_id"]) != entry["fingerprint"]:
+            todo.append(entry)
+    logger.info(f"{len(entries)} documents found, {len(entries) - len(todo)} already in {args.checkpoint}")
+
+    progress = BulkProgress(len(todo))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def ingest(entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        async with semaphore:
+            try:
+                counts = await ingest_entry(entry, args.window)
+            except Exception as e:
+                logger.error(f"Failed to ingest {entry['source']}: {e}")
+                progress.failed.append(entry["source"])
+                return None
+        progress.docs += 1
+        progress.chunks += counts["chunks"]
+        progress.inserted += counts["inserted"]
+        return {"doc_id": entry["doc_id"], "source": entry["source"], "fingerprint": entry["fingerprint"], **counts}
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.report_interval)
+            print(progress.line(), flush=True)
+
+    reporter = asyncio.create_task(report())
+    try:
+        # Documents are committed a batch at a time: one Milvus flush, then the checkpoint
+        for start in range(0, len(todo), args.batch_size):
+            batch = todo[start:start + args.batch_size]
+            results = [result for result in await asyncio.gather(*(ingest(entry) for entry in batch)) if result]
+            if results and VECTOR_ENGINE != "local":
+                await run_milvus(get_milvus_collection().flush)
+            append_checkpoint(args.checkpoint, results)
+    finally:
+        reporter.cancel()
+        if not lexical_state["publish"]:
+            await save_lexical_index(force=True)
+        # Document rows are already checkpointed, so queued ones must be written (or spilled) before exit
+        await supabase_writer.close()
+        await close_openrouter_client()
+        if main.redis_client:
+            await main.redis_client.aclose()
+        milvus_executor.shutdown(wait=False)
+        if main.extraction_executor:
+            main.extraction_executor.shutdown(wait=False, cancel_futures=True)
+
+    print(progress.line())
+    if progress.failed:
+        print(f"Failed ({len(progress.failed)}), rerun to retry: " + ", ".join(progress.failed[:20]))
+    return 1 if progress.failed else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="Directory to walk for .pdf, .docx, .txt and .md files")
+    source.add_argument("--manifest", help="JSONL manifest, one document per line")
+    parser.add_argument("--checkpoint", default="bulk_ingest.checkpoint.jsonl", help="Completed documents; rerun to resume")
+    parser.add_argument("--user-id", help="Owner recorded for documents without one")
+    parser.add_argument("--concurrency", type=int, default=8, help="Documents extracted, chunked and embedded at once")
+    parser.add_argument("--batch-size", type=int, default=50, help="Documents per Milvus flush and checkpoint write")
+    parser.add_argument("--window", type=int, default=max(INGEST_WINDOW_CHUNKS, 1024), help="Chunks embedded and inserted per request group")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="Seconds between progress lines")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(run(parse_args())))
@@ -0,0 +1,78 @@
+"""
+Ingestion Worker
+Consumes uploaded documents from the Redis Streams ingestion queue; run as many processes as needed
+"""
+
+import argparse
+import asyncio
+import signal
+import socket
+import os
+
+from prometheus_client import start_http_server
+
+import main
+from main import (
+    initialize_clients,
+    initialize_milvus_collection,
+    load_local_vector_store,
+    close_openrouter_client,
+    consume_ingest_jobs,
+    ingest_worker_heartbeat,
+    supabase_writer,
+    monitor_event_loop_lag,
+    metrics_registry,
+    lexical_state,
+    milvus_executor,
+    logger
+)
+
+async def run(consumer: str, concurrency: int, metrics_port: int):
+    if metrics_port:
+        # Ingest stage histograms are recorded here, not in the API processes
+        start_http_server(metrics_port, registry=metrics_registry())
+    await initialize_clients()
+    await initialize_milvus_collection()
+    await load_local_vector_store()
+    if not main.redis_client:
+        raise SystemExit("Redis is required to consume the ingestion queue")
+
+    # The lexical index lives in the API processes; workers publish their changes to them
+    lexical_state["publish"] = True
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    if main.supabase_client:
+        supabase_writer.start()
+    try:
+        await asyncio.gather(
+            ingest_worker_heartbeat(consumer, stop),
+            *(consume_ingest_jobs(f"{consumer}-{slot}", stop) for slot in range(concurrency))
+        )
+    finally:
+        lag_monitor.cancel()
+        await close_openrouter_client()
+        # Document rows still queued are written (or spilled) before exit
+        await supabase_writer.close()
+        await main.redis_client.aclose()
+        milvus_executor.shutdown(wait=False)
+        if main.extraction_executor:
+            main.extraction_executor.shutdown(wait=False, cancel_futures=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--name", default=f"{socket.gethostname()}-{os.getpid()}", help="Consumer name prefix")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("INGEST_WORKER_CONCURRENCY", "1")),
+                        help="Documents processed at once by this process")
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("INGEST_METRICS_PORT", "0")),
+                        help="Serve Prometheus metrics on this port (0 disables)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    logger.info(f"Starting ingestion worker {args.name} with concurrency {args.concurrency}")
+    asyncio.run(run(args.name, args.concurrency, args.metrics_port))
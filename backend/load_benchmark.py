@@ -0,0 +1,694 @@
+"""
+Load Benchmark
+Drives /api/search, /api/chat, /api/chat/stream and uploads at controlled concurrency against
+local stand-ins (a mock OpenRouter with configurable latency and deterministic embeddings,
+fakeredis and the embedded vector store) and reports latency percentiles, throughput and a
+per-stage breakdown. Results are saved as JSON and can be compared with an earlier run.
+
+    pip install -r requirements-dev.txt
+    python load_benchmark.py --scenarios search,chat --concurrency 1,8,32
+    python load_benchmark.py --compare latest
+    python load_benchmark.py serve-mock --port 8099
+"""
+
+import argparse
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results")
+
+# Functions timed as stages; they are looked up as module globals of main, so wrapping them there
+# times every call the endpoints make
+STAGES = {
+    "embedding": "generate_embedding_openrouter",
+    "answer_cache": "lookup_cached_answer",
+    "memory": "load_conversation",
+    "retrieval": "retrieve_documents",
+    "vector_search": "search_similar_documents",
+    "lexical_search": "search_lexical",
+    "context": "build_context",
+    "rerank": "rerank_documents",
+    "llm": "generate_chat_response_openrouter",
+    "llm_stream": "stream_chat_response_openrouter",
+    "ingest": "process_document_chunks",
+    "ingest_embedding": "generate_embeddings_batch"
+}
+
+VOCABULARY = (
+    "amparo contrato arrendamiento obligación acreedor deudor sentencia tribunal juez demanda "
+    "recurso apelación código civil penal federal estado municipio ley reglamento artículo fracción "
+    "párrafo derecho propiedad posesión usufructo servidumbre herencia testamento sucesión divorcio "
+    "alimentos custodia patria potestad delito pena prisión multa reparación daño perjuicio "
+    "responsabilidad notario escritura registro público sociedad mercantil accionista asamblea "
+    "trabajador patrón despido indemnización salario jornada huelga sindicato seguridad social "
+    "impuesto contribución crédito fiscal autoridad procedimiento administrativo nulidad plazo término"
+).split()
+
+percentile_names = {50: "p50_ms", 95: "p95_ms", 99: "p99_ms"}
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {name: 0.0 for name in percentile_names.values()}
+    return {name: float(np.percentile(samples, q) * 1000) for q, name in percentile_names.items()}
+
+# ==================== Mock OpenRouter ====================
+
+class MockOpenRouterSettings:
+    def __init__(
+        self,
+        dimensions: int = 1536,
+        embedding_latency_ms: float = 40.0,
+        embedding_item_ms: float = 0.5,
+        chat_latency_ms: float = 400.0,
+        token_latency_ms: float = 15.0,
+        response_tokens: int = 60,
+        jitter: float = 0.2,
+        error_rate: float = 0.0,
+        degraded_models: Optional[List[str]] = None,
+        degraded_latency_ms: float = 20000.0,
+        seed: int = 42
+    ):
+        self.dimensions = dimensions
+        self.embedding_latency_ms = embedding_latency_ms
+        self.embedding_item_ms = embedding_item_ms
+        self.chat_latency_ms = chat_latency_ms
+        self.token_latency_ms = token_latency_ms
+        self.response_tokens = response_tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # Chat models that answer this slowly, to exercise fallback and hedging
+        self.degraded_models = set(degraded_models or [])
+        self.degraded_latency_ms = degraded_latency_ms
+        self.random = random.Random(seed)
+
+    def delay(self, milliseconds: float) -> float:
+        """Seconds to wait, with multiplicative jitter so percentiles are not flat"""
+        return max(milliseconds * (1 + self.random.uniform(-self.jitter, self.jitter)), 0.0) / 1000.0
+
+@functools.lru_cache(maxsize=65536)
+def token_vector(token: str, dimensions: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.md5(token.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+
+def mock_embedding(text: str, dimensions: int) -> List[float]:
+    """Deterministic bag-of-words projection: texts sharing words get similar unit vectors"""
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for token in re.findall(r"\w+", text.lower()):
+        vector += token_vector(token, dimensions)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector = token_vector("", dimensions)
+        norm = np.linalg.norm(vector)
+    return (vector / norm).tolist()
+
+def create_mock_openrouter(settings: MockOpenRouterSettings):
+    """OpenAI-compatible /embeddings and /chat/completions with simulated latency"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    mock = FastAPI(title="Mock OpenRouter")
+    mock.state.requests = {"embeddings": 0, "embedding_inputs": 0, "chat": 0}
+
+    def failure() -> Optional[JSONResponse]:
+        if settings.error_rate and settings.random.random() < settings.error_rate:
+            return JSONResponse({"error": {"message": "mock upstream error"}}, status_code=503, headers={"Retry-After": "0"})
+        return None
+
+    @mock.post("/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        mock.state.requests["embeddings"] += 1
+        mock.state.requests["embedding_inputs"] += len(inputs)
+        await asyncio.sleep(settings.delay(settings.embedding_latency_ms + settings.embedding_item_ms * len(inputs)))
+        error = failure()
+        if error:
+            return error
+        dimensions = int(body.get("dimensions") or settings.dimensions)
+        return {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [
+                {"object": "embedding", "index": index, "embedding": mock_embedding(text, dimensions)}
+                for index, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": sum(len(text) // 4 + 1 for text in inputs), "total_tokens": sum(len(text) // 4 + 1 for text in inputs)}
+        }
+
+    @mock.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        mock.state.requests["chat"] += 1
+        prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+        words = re.findall(r"\w+", prompt.lower()) or VOCABULARY
+        rng = random.Random(hashlib.md5(prompt.encode()).hexdigest())
+        tokens = [rng.choice(words) + " " for _ in range(settings.response_tokens)]
+        usage = {
+            "prompt_tokens": len(prompt) // 4 + 1,
+            "completion_tokens": len(tokens),
+            "total_tokens": len(prompt) // 4 + 1 + len(tokens)
+        }
+        degraded = body.get("model") in settings.degraded_models
+        await asyncio.sleep(settings.delay(settings.degraded_latency_ms if degraded else settings.chat_latency_ms))
+        error = failure()
+        if error:
+            return error
+
+        if not body.get("stream"):
+            await asyncio.sleep(settings.delay(settings.token_latency_ms * len(tokens)))
+            return {
+                "id": "mock",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": usage
+            }
+
+        async def stream():
+            yield ": OPENROUTER PROCESSING\n\n"
+            for token in tokens:
+                await asyncio.sleep(settings.delay(settings.token_latency_ms))
+                yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": token}}]}) + "\n\n"
+            yield "data: " + json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return mock
+
+# ==================== Stage Timing ====================
+
+class StageTimer:
+    """Wraps functions of main to record how long each call takes"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, started: float):
+        self.samples.setdefault(stage, []).append(time.perf_counter() - started)
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        timer = self
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapped_generator(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                finally:
+                    timer.record(stage, started)
+            return wrapped_generator
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapped_coroutine(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    timer.record(stage, started)
+            return wrapped_coroutine
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timer.record(stage, started)
+        return wrapped
+
+    def install(self, module):
+        for stage, name in STAGES.items():
+            if hasattr(module, name):
+                setattr(module, name, self.wrap(stage, getattr(module, name)))
+
+    def take(self) -> Dict[str, Dict[str, float]]:
+        """Summaries since the last call, then start over"""
+        samples, self.samples = self.samples, {}
+        return {
+            stage: dict(percentiles(values), calls=len(values), mean_ms=float(np.mean(values) * 1000))
+            for stage, values in samples.items()
+        }
+
+# ==================== Workload ====================
+
+def synthetic_document(rng: random.Random, articles: int) -> str:
+    """Spanish legal-looking text with Artículo headings, so the legal chunker splits it as usual"""
+    lines = [f"TÍTULO {rng.randint(1, 9)}", f"Capítulo {rng.randint(1, 20)}"]
+    for number in range(1, articles + 1):
+        sentences = [
+            " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(8, 20))).capitalize() + "."
+            for _ in range(rng.randint(3, 8))
+        ]
+        lines.append(f"Artículo {number}. " + " ".join(sentences))
+    return "\n".join(lines) + "\n"
+
+def reformed_document(rng: random.Random, text: str, changed: float = 0.2) -> str:
+    """A later version of a document with some articles rewritten, like a reformed code"""
+    lines = text.splitlines()
+    for index, line in enumerate(lines):
+        if line.startswith("Artículo") and rng.random() < changed:
+            lines[index] = line.split(". ", 1)[0] + ". " + " ".join(rng.choice(VOCABULARY) for _ in range(12)).capitalize() + "."
+    return "\n".join(lines) + "\n"
+
+def synthetic_query(rng: random.Random) -> str:
+    return "¿Qué dice la ley sobre " + " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(3, 7))) + "?"
+
+def result_quality(query: str, documents: List[Dict[str, Any]], dimensions: int) -> Dict[str, float]:
+    """How relevant the retrieved chunks are and how much of their text repeats each other"""
+    if not documents:
+        return {"novelty": 0.0, "relevance": 0.0, "redundancy": 0.0, "distinct_sources": 0.0}
+    sentences = [
+        sentence.strip()
+        for doc in documents
+        for sentence in re.split(r"(?<=\.)\s+", doc.get("content") or "") if sentence.strip()
+    ]
+    vectors = np.asarray([mock_embedding(doc.get("content") or "", dimensions) for doc in documents])
+    query_vector = np.asarray(mock_embedding(query, dimensions))
+    similarity = vectors @ vectors.T
+    pairs = len(documents) * (len(documents) - 1)
+    return {
+        # Share of the context that is not repeated text
+        "novelty": len(set(sentences)) / len(sentences) if sentences else 0.0,
+        "relevance": float(np.mean(vectors @ query_vector)),
+        "redundancy": float((similarity.sum() - np.trace(similarity)) / pairs) if pairs else 0.0,
+        "distinct_sources": len({doc.get("source") for doc in documents}) / len(documents)
+    }
+
+async def drive(concurrency: int, total: int, send: Callable[[int], Any]) -> Dict[str, Any]:
+    """Closed loop: concurrency workers each send their next request as soon as one completes"""
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    extras: List[Dict[str, Any]] = []
+    counter = iter(range(total))
+
+    async def worker():
+        for index in counter:
+            started = time.perf_counter()
+            try:
+                status, extra = await send(index)
+            except Exception as e:
+                status, extra = type(e).__name__, None
+            latencies.append(time.perf_counter() - started)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if extra:
+                extras.append(extra)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "throughput_rps": ok / elapsed if elapsed else 0.0,
+        "errors": total - ok,
+        "statuses": statuses,
+        "latency": dict(percentiles(latencies), mean_ms=float(np.mean(latencies) * 1000) if latencies else 0.0),
+        "extras": extras
+    }
+
+def parse_sse(body: str) -> Dict[str, Any]:
+    events = {}
+    for block in body.split("\n\n"):
+        event = re.search(r"^event: (.+)$", block, re.MULTILINE)
+        data = re.search(r"^data: (.+)$", block, re.MULTILINE)
+        if event and data:
+            events[event.group(1)] = json.loads(data.group(1))
+    return events
+
+async def wait_for_ingestion(client, doc_ids: List[str], timeout: float) -> Dict[str, int]:
+    deadline = time.perf_counter() + timeout
+    states: Dict[str, str] = {}
+    while time.perf_counter() < deadline:
+        for doc_id in doc_ids:
+            if states.get(doc_id) in ("completed", "failed"):
+                continue
+            response = await client.get(f"/api/documents/{doc_id}/status")
+            if response.status_code == 200:
+                states[doc_id] = response.json()["state"]
+        if all(states.get(doc_id) in ("completed", "failed") for doc_id in doc_ids):
+            break
+        await asyncio.sleep(0.05)
+    summary: Dict[str, int] = {}
+    for doc_id in doc_ids:
+        summary[states.get(doc_id, "pending")] = summary.get(states.get(doc_id, "pending"), 0) + 1
+    return summary
+
+# ==================== Runner ====================
+
+def configure_environment(args, workdir: str):
+    """Point every store at a scratch directory and every service at a stand-in, before main is imported"""
+    os.environ.update({
+        "OPENROUTER_API_KEY": "benchmark",
+        "OPENROUTER_API_URL": args.openrouter_url or "http://mock-openrouter",
+        "VECTOR_ENGINE": args.vector_engine,
+        "LOCAL_VECTOR_DIR": os.path.join(workdir, "vectors"),
+        "LEXICAL_INDEX_PATH": os.path.join(workdir, "lexical_index.pkl"),
+        "CHUNK_STORE_PATH": os.path.join(workdir, "chunks.sqlite3"),
+        "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "EMBEDDING_DIMENSIONS": str(args.dimensions),
+        "RERANK_ENABLED": "false" if args.no_rerank else os.getenv("RERANK_ENABLED", "true"),
+        # Never write benchmark traffic to a real database
+        "SUPABASE_URL": "",
+        "SUPABASE_SERVICE_KEY": "",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING")
+    })
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="rag-benchmark-")
+    configure_environment(args, workdir)
+
+    import httpx
+    import main
+
+    if not args.redis_url:
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("fakeredis is required for the in-process Redis stand-in (pip install -r requirements-dev.txt), or pass --redis-url")
+        fake_server = fakeredis.FakeServer()
+        main.aioredis.from_url = lambda *_, **__: fakeredis.aioredis.FakeRedis(server=fake_server)
+
+    settings = MockOpenRouterSettings(
+        dimensions=args.dimensions,
+        embedding_latency_ms=args.embedding_latency_ms,
+        chat_latency_ms=args.chat_latency_ms,
+        token_latency_ms=args.token_latency_ms,
+        response_tokens=args.response_tokens,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        degraded_models=[model for model in args.degraded_models.split(",") if model],
+        degraded_latency_ms=args.degraded_latency_ms,
+        seed=args.seed
+    )
+    mock = create_mock_openrouter(settings)
+
+    timer = StageTimer()
+    timer.install(main)
+    rng = random.Random(args.seed)
+    report: Dict[str, Any] = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("compare", "command")},
+        "scenarios": []
+    }
+
+    try:
+        async with main.lifespan(main.app):
+            if not args.openrouter_url:
+                # Route the shared OpenRouter client into the mock app, with no sockets involved
+                client = main.get_openrouter_client()
+                main.openrouter_client = httpx.AsyncClient(
+                    base_url=main.OPENROUTER_API_URL,
+                    headers=client.headers,
+                    transport=httpx.ASGITransport(app=mock),
+                    timeout=client.timeout
+                )
+                await client.aclose()
+
+            stop = asyncio.Event()
+            consumers = [
+                asyncio.create_task(main.ingest_worker_heartbeat("benchmark", stop)),
+                *(asyncio.create_task(main.consume_ingest_jobs(f"benchmark-{slot}", stop)) for slot in range(args.ingest_workers))
+            ] if main.redis_client and main.INGEST_QUEUE_ENABLED else []
+
+            # Seed the corpus through the ingestion path; not part of any measurement
+            seeding = time.perf_counter()
+            texts: List[str] = []
+            for number in range(args.corpus_docs):
+                if texts and rng.random() < args.reformed_docs:
+                    text = reformed_document(rng, rng.choice(texts))
+                else:
+                    text = synthetic_document(rng, rng.randint(5, args.max_articles))
+                texts.append(text)
+                await main.process_document_chunks(
+                    main.chunk_text(text), f"corpus-{number}", f"Ley {number}", f"corpus/ley-{number}.txt", "benchmark",
+                    {"jurisdiction": rng.choice(["federal", "cdmx", "jalisco"])}
+                )
+            await main.save_lexical_index(force=True)
+            report["corpus"] = {
+                "documents": args.corpus_docs,
+                "chunks": main.local_vector_store.live_count if args.vector_engine == "local" else None,
+                "seed_seconds": time.perf_counter() - seeding
+            }
+            timer.take()
+
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=300) as api:
+                for scenario in args.scenarios.split(","):
+                    for concurrency in (int(level) for level in args.concurrency.split(",")):
+                        result = await run_scenario(api, scenario, concurrency, args, rng)
+                        result["stages"] = timer.take()
+                        report["scenarios"].append(result)
+                        print_result(result)
+
+            stop.set()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            report["mock_openrouter"] = dict(mock.state.requests)
+            report["coalescing"] = {flight.name: dict(flight.stats) for flight in (main.embedding_flight, main.search_flight, main.chat_flight)}
+            report["answer_cache"] = dict(main.answer_cache.stats)
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return report
+
+async def run_scenario(api, scenario: str, concurrency: int, args, rng: random.Random) -> Dict[str, Any]:
+    # Fresh queries for each request unless --repeat is set, so caches only help when asked to
+    pool = [synthetic_query(rng) for _ in range(max(1, int(args.requests * (1 - args.repeat))))]
+
+    def query(index: int) -> str:
+        return pool[index % len(pool)]
+
+    def user(index: int) -> str:
+        # Spread over users so per-user concurrency caps only bite when --users is small
+        return f"benchmark-{index % args.users}"
+
+    if scenario == "search":
+        async def send(index: int):
+            response = await api.post("/api/search", json={"query": query(index), "limit": args.top_k, "user_id": user(index)})
+            if response.status_code != 200:
+                return response.status_code, None
+            return response.status_code, {"quality": result_quality(query(index), response.json(), args.dimensions)}
+    elif scenario == "chat":
+        async def send(index: int):
+            response = await api.post("/api/chat", json={"message": query(index), "user_id": user(index)})
+            if response.status_code != 200:
+                return response.status_code, None
+            return response.status_code, {"quality": result_quality(query(index), response.json()["sources"], args.dimensions)}
+    elif scenario == "chat_stream":
+        async def send(index: int):
+            response = await api.post("/api/chat/stream", json={"message": query(index), "user_id": user(index)})
+            done = parse_sse(response.text).get("done")
+            return (response.status_code if done else "stream_error"), done
+    elif scenario == "upload":
+        doc_ids: List[str] = []
+        documents = [synthetic_document(rng, rng.randint(5, args.max_articles)) for _ in range(args.requests)]
+        prefix = f"upload-{concurrency}-{rng.randrange(1 << 30)}"
+
+        async def send(index: int):
+            response = await api.post(
+                "/api/documents/upload",
+                params={"user_id": user(index), "jurisdiction": "federal"},
+                files={"file": (f"{prefix}-{index}.txt", documents[index].encode(), "text/plain")}
+            )
+            if response.status_code == 200:
+                doc_ids.append(response.json()["document_id"])
+            return response.status_code, None
+    else:
+        raise SystemExit(f"Unknown scenario {scenario}; use search, chat, chat_stream or upload")
+
+    result = await drive(concurrency, args.requests, send)
+    result["scenario"] = scenario
+    extras = result.pop("extras")
+
+    qualities = [extra["quality"] for extra in extras if "quality" in extra]
+    if qualities:
+        # Retrieval quality of the sources behind each answer; compare runs with RERANK_* settings
+        result["quality"] = {metric: float(np.mean([quality[metric] for quality in qualities])) for metric in qualities[0]}
+    if scenario == "chat_stream" and extras:
+        result["time_to_first_token"] = percentiles([extra["time_to_first_token_ms"] / 1000 for extra in extras])
+    if scenario == "upload":
+        # Uploads only spool and enqueue; throughput is measured until every document is searchable
+        started = time.perf_counter() - result["seconds"]
+        result["ingestion"] = await wait_for_ingestion(api, doc_ids, args.ingest_timeout)
+        elapsed = time.perf_counter() - started
+        result["ingestion_seconds"] = elapsed
+        result["documents_per_second"] = result["ingestion"].get("completed", 0) / elapsed if elapsed else 0.0
+    return result
+
+def print_result(result: Dict[str, Any]):
+    latency = result["latency"]
+    line = (
+        f"{result['scenario']:12s} c={result['concurrency']:<4d} {result['throughput_rps']:8.1f} req/s  "
+        f"p50={latency['p50_ms']:.1f}ms p95={latency['p95_ms']:.1f}ms p99={latency['p99_ms']:.1f}ms  errors={result['errors']}"
+    )
+    if "time_to_first_token" in result:
+        line += f"  ttft p50={result['time_to_first_token']['p50_ms']:.0f}ms"
+    if "quality" in result:
+        line += "  " + " ".join(f"{metric}={value:.3f}" for metric, value in result["quality"].items())
+    if "documents_per_second" in result:
+        line += f"  ingest {result['documents_per_second']:.2f} docs/s {result['ingestion']}"
+    print(line, flush=True)
+    for stage, summary in sorted(result["stages"].items(), key=lambda item: -item[1]["mean_ms"] * item[1]["calls"]):
+        print(f"    {stage:16s} calls={summary['calls']:<6d} mean={summary['mean_ms']:.1f}ms p95={summary['p95_ms']:.1f}ms")
+
+# ==================== Results ====================
+
+def save_report(report: Dict[str, Any], directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    name = f"load-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{report.get('git_revision') or 'unknown'}.json"
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+def load_baseline(reference: str, directory: str, exclude: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """A results file, or "latest" for the newest saved run other than exclude"""
+    if reference == "latest":
+        candidates = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.startswith("load-") and name.endswith(".json")
+        ) if os.path.isdir(directory) else []
+        candidates = [path for path in candidates if path != exclude]
+        if not candidates:
+            return None
+        reference = candidates[-1]
+    with open(reference) as f:
+        report = json.load(f)
+    report["path"] = reference
+    return report
+
+def compare_reports(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Print per-scenario changes; returns the regressions beyond threshold (a fraction)"""
+    previous = {(result["scenario"], result["concurrency"]): result for result in baseline["scenarios"]}
+    regressions = []
+    print(f"\nCompared with {baseline['path']} ({baseline.get('git_revision') or 'unknown revision'})")
+    for result in current["scenarios"]:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if not before:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            old, new = before["latency"][metric], result["latency"][metric]
+            change = (new - old) / old if old else 0.0
+            changes.append(f"{metric}={change:+.0%}")
+            if change > threshold:
+                regressions.append(f"{result['scenario']} c={result['concurrency']} {metric} {old:.1f} -> {new:.1f}ms")
+        old, new = before["throughput_rps"], result["throughput_rps"]
+        change = (new - old) / old if old else 0.0
+        changes.append(f"throughput={change:+.0%}")
+        if change < -threshold:
+            regressions.append(f"{result['scenario']} c={result['concurrency']} throughput {old:.1f} -> {new:.1f} req/s")
+        for metric in ("novelty", "redundancy", "distinct_sources"):
+            if metric in result.get("quality", {}) and metric in before.get("quality", {}):
+                changes.append(f"{metric} {before['quality'][metric]:.3f}->{result['quality'][metric]:.3f}")
+        print(f"{result['scenario']:12s} c={result['concurrency']:<4d} " + "  ".join(changes))
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "serve-mock"])
+    parser.add_argument("--scenarios", default="search,chat,chat_stream,upload", help="Comma-separated: search, chat, chat_stream, upload")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level")
+    parser.add_argument("--repeat", type=float, default=0.0, help="Fraction of repeated queries, to exercise the caches")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--no-rerank", action="store_true", help="Disable MMR reranking, for a baseline to --compare against")
+    parser.add_argument("--users", type=int, default=1000, help="Distinct user ids requests are spread over")
+    parser.add_argument("--corpus-docs", type=int, default=100, help="Documents ingested before measuring")
+    parser.add_argument("--max-articles", type=int, default=40, help="Upper bound on articles per synthetic document")
+    parser.add_argument("--reformed-docs", type=float, default=0.3,
+                        help="Fraction of corpus documents that are reformed versions of earlier ones (near-duplicates)")
+    parser.add_argument("--ingest-workers", type=int, default=2, help="In-process queue consumers for the upload scenario")
+    parser.add_argument("--ingest-timeout", type=float, default=600.0)
+    parser.add_argument("--dimensions", type=int, default=1536, help="Embedding size returned by the mock")
+    parser.add_argument("--embedding-latency-ms", type=float, default=40.0)
+    parser.add_argument("--chat-latency-ms", type=float, default=400.0, help="Mock time to first token")
+    parser.add_argument("--token-latency-ms", type=float, default=15.0)
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Relative +/- jitter on every mock delay")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests answered with 503")
+    parser.add_argument("--degraded-models", default="", help="Comma-separated chat models the mock answers slowly")
+    parser.add_argument("--degraded-latency-ms", type=float, default=20000.0, help="Mock time to first token of degraded models")
+    parser.add_argument("--vector-engine", default="local", choices=["local", "milvus", "auto"],
+                        help="local uses the embedded store; milvus needs MILVUS_HOST")
+    parser.add_argument("--redis-url", help="Use a real Redis instead of fakeredis")
+    parser.add_argument("--openrouter-url", help="Use an already running mock (see serve-mock) instead of the in-process one")
+    parser.add_argument("--port", type=int, default=8099, help="Port for serve-mock")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--no-save", action="store_true", help="Do not write a results file")
+    parser.add_argument("--compare", help='Results file to compare with, or "latest"')
+    parser.add_argument("--regression-threshold", type=float, default=0.1, help="Relative change reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 when a regression is found")
+    parser.add_argument("--keep-data", action="store_true", help="Keep the scratch stores for inspection")
+    return parser.parse_args()
+
+def main_cli():
+    args = parse_args()
+    settings_args = dict(
+        dimensions=args.dimensions,
+        embedding_latency_ms=args.embedding_latency_ms,
+        chat_latency_ms=args.chat_latency_ms,
+        token_latency_ms=args.token_latency_ms,
+        response_tokens=args.response_tokens,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        degraded_models=[model for model in args.degraded_models.split(",") if model],
+        degraded_latency_ms=args.degraded_latency_ms,
+        seed=args.seed
+    )
+
+    if args.command == "serve-mock":
+        import uvicorn
+        # Point a deployment at it with OPENROUTER_API_URL=http://<host>:<port>
+        uvicorn.run(create_mock_openrouter(MockOpenRouterSettings(**settings_args)), host="0.0.0.0", port=args.port)
+        return 0
+
+    report = asyncio.run(run(args))
+    path = None if args.no_save else save_report(report, args.results_dir)
+    if path:
+        print(f"Saved {path}")
+
+    if args.compare:
+        baseline = load_baseline(args.compare, args.results_dir, exclude=path)
+        if baseline is None:
+            print("No earlier results to compare with")
+        elif compare_reports(report, baseline, args.regression_threshold) and args.fail_on_regression:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -3,25 +3,64 @@ LegalTracking RAG Backend API
 Main FastAPI application using OpenRouter for LLM and embeddings
 """
 
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterable, Iterator
 import os
 import json
 import hashlib
 from datetime import datetime
 import logging
-from contextlib import asynccontextmanager
+import asyncio
+import random
+import time
+import functools
+import pickle
+import re
+import unicodedata
+import threading
+import fcntl
+import codecs
+import tempfile
+import itertools
+import multiprocessing
+import resource
+import signal
+import sqlite3
+import contextvars
+import heapq
+import math
+import uuid
+import ipaddress
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, TimeoutError as FuturesTimeoutError
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from collections import OrderedDict, deque
 
 # External libraries
 import httpx
 from dotenv import load_dotenv
 from supabase import create_client, Client
-import redis
+from postgrest.exceptions import APIError
+import redis.asyncio as aioredis
 import numpy as np
-from pymilvus import connections, Collection, FieldSchema, CollectionSchema, DataType, utility
+import tiktoken
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt
+import chardet
+from docx import Document as DocxDocument
+from docx.table import Table as DocxTable
+from docx.text.paragraph import Paragraph as DocxParagraph
+from PyPDF2 import PdfReader
+from pymilvus import connections, Collection, FieldSchema, CollectionSchema, DataType, utility, MilvusException
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+
+# Tracing is optional; spans are only recorded when opentelemetry is installed and enabled
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
 
 # Load environment variables
 load_dotenv()
@@ -35,17 +74,264 @@ logger = logging.getLogger(__name__)
 
 # Global clients
 supabase_client: Optional[Client] = None
-redis_client: Optional[redis.Redis] = None
+redis_client: Optional[aioredis.Redis] = None
+openrouter_client: Optional[httpx.AsyncClient] = None
+milvus_collection: Optional[Collection] = None
+milvus_fields: set = set()
+milvus_index: Dict[str, Any] = {}
+milvus_auto_id = True
 milvus_connected = False
 
 # OpenRouter configuration
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1"
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_EMBEDDING_MODEL = os.getenv("OPENROUTER_EMBEDDING_MODEL", "openai/text-embedding-3-small")
 OPENROUTER_CHAT_MODEL = os.getenv("OPENROUTER_CHAT_MODEL", "deepseek/deepseek-chat")
 OPENROUTER_SITE_URL = os.getenv("OPENROUTER_SITE_URL", "https://github.com/legal-rag-mexico")
 OPENROUTER_APP_NAME = os.getenv("OPENROUTER_APP_NAME", "LegalTracking-RAG")
 
+# OpenRouter connection pool settings
+OPENROUTER_HTTP2 = os.getenv("OPENROUTER_HTTP2", "true").lower() == "true"
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "100"))
+OPENROUTER_MAX_KEEPALIVE = int(os.getenv("OPENROUTER_MAX_KEEPALIVE", "20"))
+OPENROUTER_KEEPALIVE_EXPIRY = float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", "30"))
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
+OPENROUTER_POOL_TIMEOUT = float(os.getenv("OPENROUTER_POOL_TIMEOUT", "10"))
+OPENROUTER_EMBEDDING_TIMEOUT = float(os.getenv("OPENROUTER_EMBEDDING_TIMEOUT", "30"))
+OPENROUTER_CHAT_TIMEOUT = float(os.getenv("OPENROUTER_CHAT_TIMEOUT", "60"))
+
+# Admission control for OpenRouter calls; the per-minute budgets are shared through Redis by every process
+OPENROUTER_REQUESTS_PER_MINUTE = int(os.getenv("OPENROUTER_REQUESTS_PER_MINUTE", "0"))  # 0 = no budget
+OPENROUTER_TOKENS_PER_MINUTE = int(os.getenv("OPENROUTER_TOKENS_PER_MINUTE", "0"))
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "64"))  # in-flight calls per process
+INTERACTIVE_RESERVE = float(os.getenv("INTERACTIVE_RESERVE", "0.25"))  # share of slots and budget ingestion may not use
+ADMISSION_QUEUE_TARGET_MS = float(os.getenv("ADMISSION_QUEUE_TARGET_MS", "2000"))  # shed chat/search expected to wait longer
+OPENROUTER_MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))  # query embeddings; chat falls back across models
+OPENROUTER_RETRY_MAX_DELAY = float(os.getenv("OPENROUTER_RETRY_MAX_DELAY", "4"))
+USER_MAX_CONCURRENT_REQUESTS = int(os.getenv("USER_MAX_CONCURRENT_REQUESTS", "4"))  # per process; 0 disables
+ADMISSION_BUDGET_KEY = "admission:openrouter"
+PRIORITY_INTERACTIVE = 0
+PRIORITY_INGEST = 1
+
+# Chat model fallback, circuit breakers and hedging; breakers are kept per process
+CHAT_FIRST_TOKEN_TIMEOUT = float(os.getenv("CHAT_FIRST_TOKEN_TIMEOUT", "15"))  # before the next model is tried
+CHAT_HEDGING_ENABLED = os.getenv("CHAT_HEDGING_ENABLED", "false").lower() == "true"
+CHAT_HEDGE_DELAY_MS = float(os.getenv("CHAT_HEDGE_DELAY_MS", "3000"))  # until a model has latency history
+CHAT_HEDGE_MIN_DELAY_MS = float(os.getenv("CHAT_HEDGE_MIN_DELAY_MS", "500"))
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))  # recent calls per model
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_ERROR_THRESHOLD = float(os.getenv("CIRCUIT_ERROR_THRESHOLD", "0.5"))
+CIRCUIT_SLOW_CALL_MS = float(os.getenv("CIRCUIT_SLOW_CALL_MS", "10000"))  # slower first tokens count as failures
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+# Embedding batch settings for document ingestion
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "128"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "64000"))
+EMBEDDING_BATCH_CONCURRENCY = int(os.getenv("EMBEDDING_BATCH_CONCURRENCY", "4"))
+EMBEDDING_BATCH_MAX_RETRIES = int(os.getenv("EMBEDDING_BATCH_MAX_RETRIES", "5"))
+EMBEDDING_RETRY_MAX_DELAY = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY", "30"))  # also caps Retry-After
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+EMBEDDING_CACHE_TTL = 3600
+
+# Redis cache settings
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2"))
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32")  # float32, float16 or int8
+EMBEDDING_CACHE_VERSION = "v2"
+
+# Milvus access settings
+MILVUS_COLLECTION = "legal_documents"
+MILVUS_EXECUTOR_WORKERS = int(os.getenv("MILVUS_EXECUTOR_WORKERS", "8"))
+MILVUS_BATCH_WINDOW_MS = float(os.getenv("MILVUS_BATCH_WINDOW_MS", "3"))
+MILVUS_BATCH_MAX_QUERIES = int(os.getenv("MILVUS_BATCH_MAX_QUERIES", "32"))
+MILVUS_NUM_PARTITIONS = int(os.getenv("MILVUS_NUM_PARTITIONS", "16"))
+MILVUS_BASE_OUTPUT_FIELDS = ["content", "title", "source", "chunk_index"]
+MILVUS_METADATA_FIELDS = ["doc_id", "jurisdiction", "document_type", "legal_domain", "document_date"]
+MILVUS_FILTER_FIELDS = ["doc_id", "source", "jurisdiction", "document_type", "legal_domain"]
+
+# ANN index settings; an existing collection keeps its index until milvus_reindex.py migrates it
+MILVUS_INDEX_TYPE = os.getenv("MILVUS_INDEX_TYPE", "HNSW").upper()  # HNSW, IVF_FLAT, IVF_SQ8 or IVF_PQ
+MILVUS_METRIC_TYPE = os.getenv("MILVUS_METRIC_TYPE", "COSINE").upper()  # COSINE, IP or L2
+MILVUS_INDEX_PARAMS = json.loads(os.getenv("MILVUS_INDEX_PARAMS", "{}"))  # overrides the build defaults below
+MILVUS_SEARCH_PARAMS = json.loads(os.getenv("MILVUS_SEARCH_PARAMS", "{}"))  # e.g. {"ef": 96}; see tune_index.py
+MILVUS_DEFAULT_INDEX_PARAMS = {
+    "HNSW": {"M": 16, "efConstruction": 200},
+    "IVF_FLAT": {"nlist": 1024},
+    "IVF_SQ8": {"nlist": 1024},
+    "IVF_PQ": {"nlist": 1024, "m": 48, "nbits": 8},
+    "FLAT": {},
+    "BIN_IVF_FLAT": {"nlist": 1024},
+    "BIN_FLAT": {}
+}
+MILVUS_DEFAULT_SEARCH_PARAMS = {
+    "HNSW": {"ef": 64},
+    "IVF_FLAT": {"nprobe": 16},
+    "IVF_SQ8": {"nprobe": 16},
+    "IVF_PQ": {"nprobe": 32},
+    "FLAT": {},
+    "BIN_IVF_FLAT": {"nprobe": 32},
+    "BIN_FLAT": {}
+}
+MILVUS_ID_COUNTER_KEY = f"milvus:next_id:{MILVUS_COLLECTION}"
+
+# Vector size and layout of new collections; migrate existing ones with milvus_reindex.py
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))  # 0 = model default; text-embedding-3 accepts e.g. 256 or 512
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none").lower()  # none, scalar (IVF_SQ8) or binary (sign bits)
+RESCORE_MULTIPLIER = int(os.getenv("RESCORE_MULTIPLIER", "4"))  # quantized shortlist size, re-scored at full precision
+CHUNK_STORE_ENABLED = os.getenv("CHUNK_STORE_ENABLED", "true").lower() == "true"  # keep chunk text out of Milvus
+CHUNK_STORE_PATH = os.getenv("CHUNK_STORE_PATH", "/app/cache/chunks.sqlite3")
+
+# Vector engine: "milvus", "local" (embedded store only) or "auto" (Milvus with local failover)
+VECTOR_ENGINE = os.getenv("VECTOR_ENGINE", "auto").lower()
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "/app/cache/vectors")
+LOCAL_VECTOR_IVF_THRESHOLD = int(os.getenv("LOCAL_VECTOR_IVF_THRESHOLD", "200000"))
+LOCAL_VECTOR_IVF_NLIST = int(os.getenv("LOCAL_VECTOR_IVF_NLIST", "1024"))
+LOCAL_VECTOR_IVF_NPROBE = int(os.getenv("LOCAL_VECTOR_IVF_NPROBE", "32"))
+
+# Hybrid lexical + vector retrieval settings
+LEXICAL_INDEX_ENABLED = os.getenv("LEXICAL_INDEX_ENABLED", "true").lower() == "true"
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "/app/cache/lexical_index.pkl")
+LEXICAL_SNAPSHOT_INTERVAL = float(os.getenv("LEXICAL_SNAPSHOT_INTERVAL", "30"))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_CANDIDATE_MULTIPLIER = int(os.getenv("HYBRID_CANDIDATE_MULTIPLIER", "4"))
+
+# Diversity reranking (maximal marginal relevance) of an over-fetched candidate set
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "true").lower() == "true"
+RERANK_CANDIDATE_MULTIPLIER = int(os.getenv("RERANK_CANDIDATE_MULTIPLIER", "4"))  # candidates per result kept
+RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", "0.7"))  # 1 ranks by relevance only, 0 by novelty only
+RERANK_MAX_PER_SOURCE = int(os.getenv("RERANK_MAX_PER_SOURCE", "2"))  # while other sources remain; 0 disables
+RERANK_SOURCE_CAP_MARGIN = float(os.getenv("RERANK_SOURCE_CAP_MARGIN", "0.15"))  # relevance an alternative may lack
+RERANK_RECENCY_WEIGHT = float(os.getenv("RERANK_RECENCY_WEIGHT", "0"))  # boost for a recent document_date
+RERANK_RECENCY_HALF_LIFE_DAYS = float(os.getenv("RERANK_RECENCY_HALF_LIFE_DAYS", "3650"))
+RERANK_AUTHORITY_WEIGHT = float(os.getenv("RERANK_AUTHORITY_WEIGHT", "0"))  # boost by document_type
+RERANK_AUTHORITY_LEVELS = json.loads(os.getenv("RERANK_AUTHORITY_LEVELS", "{}")) or {
+    # Prefixes of document_type, following the hierarchy of Mexican legal sources
+    "constitucion": 1.0,
+    "tratado": 0.9,
+    "ley": 0.8,
+    "codigo": 0.8,
+    "jurisprudencia": 0.7,
+    "reglamento": 0.6,
+    "decreto": 0.5,
+    "norma": 0.5,
+    "tesis": 0.5,
+    "acuerdo": 0.4,
+    "circular": 0.3,
+    "contrato": 0.2
+}
+
+# Request coalescing settings
+CHAT_COALESCING_ENABLED = os.getenv("CHAT_COALESCING_ENABLED", "false").lower() == "true"
+
+# Metrics and tracing; PROMETHEUS_MULTIPROC_DIR must be set when uvicorn runs several workers
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+OTEL_TRACING_ENABLED = os.getenv("OTEL_TRACING_ENABLED", "false").lower() == "true"
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "legaltracking-rag")
+
+# Semantic answer cache settings
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+# Conversation memory in Redis, keyed by context_id
+CONVERSATION_MEMORY_ENABLED = os.getenv("CONVERSATION_MEMORY_ENABLED", "true").lower() == "true"
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "86400"))  # idle seconds before a conversation is evicted
+CONVERSATION_RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "4"))  # turns kept verbatim
+CONVERSATION_MAX_TOKENS = int(os.getenv("CONVERSATION_MAX_TOKENS", "1500"))  # summary plus recent turns in the prompt
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "400"))
+CONVERSATION_SUMMARY_MODEL = os.getenv("CONVERSATION_SUMMARY_MODEL", OPENROUTER_CHAT_MODEL)
+CONVERSATION_REUSE_THRESHOLD = float(os.getenv("CONVERSATION_REUSE_THRESHOLD", "0.85"))  # similarity to reuse earlier sources
+CONVERSATION_WRITE_ATTEMPTS = int(os.getenv("CONVERSATION_WRITE_ATTEMPTS", "5"))  # retries when concurrent turns collide
+CONVERSATION_KEY_PREFIX = "conversation:"
+
+# Write-behind buffer for Supabase rows (chat history, document records, search history)
+SUPABASE_WRITE_BATCH_SIZE = int(os.getenv("SUPABASE_WRITE_BATCH_SIZE", "100"))
+SUPABASE_WRITE_INTERVAL = float(os.getenv("SUPABASE_WRITE_INTERVAL", "1.0"))  # seconds a row may wait for its batch
+SUPABASE_WRITE_QUEUE_SIZE = int(os.getenv("SUPABASE_WRITE_QUEUE_SIZE", "5000"))  # writers wait for room beyond this
+SUPABASE_WRITE_ENQUEUE_TIMEOUT = float(os.getenv("SUPABASE_WRITE_ENQUEUE_TIMEOUT", "5"))  # then the row is spilled
+SUPABASE_WRITE_MAX_RETRIES = int(os.getenv("SUPABASE_WRITE_MAX_RETRIES", "3"))
+SUPABASE_WRITE_RETRY_MAX_DELAY = float(os.getenv("SUPABASE_WRITE_RETRY_MAX_DELAY", "8"))
+SUPABASE_DRAIN_TIMEOUT = float(os.getenv("SUPABASE_DRAIN_TIMEOUT", "15"))  # on shutdown, before the rest is spilled
+SUPABASE_SPILL_DIR = os.getenv("SUPABASE_SPILL_DIR", "/app/cache/supabase_spill")
+SUPABASE_SPILL_MAX_MB = float(os.getenv("SUPABASE_SPILL_MAX_MB", "256"))  # per process
+SUPABASE_SPILL_REPLAY_INTERVAL = float(os.getenv("SUPABASE_SPILL_REPLAY_INTERVAL", "30"))
+SUPABASE_SPILL_CLAIM_SECONDS = 60  # idle time before another process's spill file is taken over
+SUPABASE_UPSERT_KEYS = {"documents": "document_id"}  # tables written as upserts on this (unique) column
+SUPABASE_TRANSIENT_CODES = ("PGRST00", "08", "40", "53", "57")  # connection, rollback, resources, timeouts
+
+# Context packing settings
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "2000"))  # five chunks; the old cut was 6000 characters
+CHAT_MAX_TOKENS = 2000
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Document chunking and ingestion settings
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "60"))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")
+UPLOAD_READ_SIZE = 1024 * 1024
+TEXT_MAX_LINE_CHARS = 65536
+INGEST_WINDOW_CHUNKS = int(os.getenv("INGEST_WINDOW_CHUNKS", "256"))
+
+# PDF/DOCX extraction worker settings
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 2)))
+EXTRACTION_PAGES_PER_TASK = int(os.getenv("EXTRACTION_PAGES_PER_TASK", "16"))
+EXTRACTION_TASK_TIMEOUT = float(os.getenv("EXTRACTION_TASK_TIMEOUT", "60"))
+EXTRACTION_FILE_TIMEOUT = float(os.getenv("EXTRACTION_FILE_TIMEOUT", "1800"))
+EXTRACTION_MEMORY_LIMIT_MB = int(os.getenv("EXTRACTION_MEMORY_LIMIT_MB", "1024"))
+ENCODING_DETECTION_BYTES = 1024 * 1024
+
+# Durable ingestion queue (Redis Streams) consumed by ingest_worker.py processes
+INGEST_QUEUE_ENABLED = os.getenv("INGEST_QUEUE_ENABLED", "true").lower() == "true"
+INGEST_STREAM = "ingest:jobs"
+INGEST_GROUP = "ingest-workers"
+INGEST_DEAD_LETTER_STREAM = "ingest:dead"
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_CLAIM_IDLE_MS = int(os.getenv("INGEST_CLAIM_IDLE_MS", "60000"))
+INGEST_BLOCK_MS = 1000  # must stay below REDIS_SOCKET_TIMEOUT
+INGEST_WORKERS_KEY = "ingest:workers"  # heartbeats of running ingest_worker.py processes
+INGEST_WORKER_HEARTBEAT_SECONDS = 10
+INGEST_WORKER_LIVE_SECONDS = 30  # without a heartbeat this recent, uploads are ingested in-process
+INGEST_STATUS_TTL = 7 * 24 * 3600
+DOCUMENT_LOCK_TTL = 600
+LEXICAL_UPDATES_STREAM = "lexical:updates"
+LEXICAL_UPDATES_MAXLEN = int(os.getenv("LEXICAL_UPDATES_MAXLEN", "10000"))
+
+# Models offered through OpenRouter; context_window drives the prompt budget
+EMBEDDING_MODELS = [
+    {"id": "openai/text-embedding-3-small", "name": "OpenAI Embedding Small", "cost": "$0.00002/1k tokens", "dimensions": 1536},
+    {"id": "openai/text-embedding-3-large", "name": "OpenAI Embedding Large", "cost": "$0.00013/1k tokens", "dimensions": 3072},
+    {"id": "voyage/voyage-2", "name": "Voyage 2", "cost": "$0.00012/1k tokens", "dimensions": 1024}
+]
+EMBEDDING_DIM = EMBEDDING_DIMENSIONS or next(
+    (model["dimensions"] for model in EMBEDDING_MODELS if model["id"] == OPENROUTER_EMBEDDING_MODEL), 1536
+)
+CHAT_MODELS = [
+    {"id": "deepseek/deepseek-chat", "name": "DeepSeek Chat", "cost": "$0.0001/1k tokens", "context_window": 64000},
+    {"id": "anthropic/claude-3-haiku", "name": "Claude 3 Haiku", "cost": "$0.00025/1k tokens", "context_window": 200000},
+    {"id": "meta-llama/llama-3-70b-instruct", "name": "Llama 3 70B", "cost": "Free tier available", "context_window": 8192},
+    {"id": "mistralai/mistral-7b-instruct", "name": "Mistral 7B", "cost": "$0.00007/1k tokens", "context_window": 32768},
+    {"id": "google/gemini-pro", "name": "Gemini Pro", "cost": "$0.000125/1k tokens", "context_window": 32760},
+    {"id": "openai/gpt-3.5-turbo", "name": "GPT-3.5 Turbo", "cost": "$0.0005/1k tokens", "context_window": 16385}
+]
+# Tried in order after the requested chat model; ids must come from CHAT_MODELS
+CHAT_FALLBACK_MODELS = [
+    model.strip()
+    for model in os.getenv("CHAT_FALLBACK_MODELS", "anthropic/claude-3-haiku,openai/gpt-3.5-turbo").split(",")
+    if model.strip()
+]
+for unknown_model in set(CHAT_FALLBACK_MODELS) - {model["id"] for model in CHAT_MODELS}:
+    logger.warning(f"Ignoring chat fallback model {unknown_model}: not in CHAT_MODELS")
+CHAT_FALLBACK_MODELS = [model for model in CHAT_FALLBACK_MODELS if model in {entry["id"] for entry in CHAT_MODELS}]
+
+# Connection reuse counters for the shared OpenRouter client
+openrouter_stats: Dict[str, int] = {
+    "requests": 0,
+    "new_connections": 0,
+    "reused_connections": 0,
+    "tls_handshakes": 0
+}
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
@@ -53,9 +339,26 @@ async def lifespan(app: FastAPI):
     logger.info("Starting up RAG Backend API...")
     await initialize_clients()
     await initialize_milvus_collection()
+    await load_local_vector_store()
+    await load_lexical_index()
+    lexical_follower = await start_lexical_follower()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    if supabase_client:
+        supabase_writer.start()
     yield
     # Shutdown
     logger.info("Shutting down RAG Backend API...")
+    lag_monitor.cancel()
+    if lexical_follower:
+        lexical_follower.cancel()
+    await close_openrouter_client()
+    await supabase_writer.close()
+    await save_lexical_index(force=True)
+    if redis_client:
+        await redis_client.aclose()
+    milvus_executor.shutdown(wait=False)
+    if extraction_executor:
+        extraction_executor.shutdown(wait=False, cancel_futures=True)
     if milvus_connected:
         connections.disconnect("default")
 
@@ -85,6 +388,8 @@ class ChatRequest(BaseModel):
     user_id: str = Field(..., description="User identifier")
     language: str = Field("es", description="Language code (es/en)")
     model: Optional[str] = Field(None, description="Optional model override")
+    vector_weight: float = Field(1.0, ge=0, description="Weight of vector hits in rank fusion")
+    lexical_weight: float = Field(1.0, ge=0, description="Weight of BM25 hits in rank fusion (0 disables)")
 
 class ChatResponse(BaseModel):
     response: str
@@ -96,13 +401,36 @@ class ChatResponse(BaseModel):
 class DocumentUploadResponse(BaseModel):
     success: bool
     document_id: str
-    chunks_processed: int
+    chunks_processed: Optional[int] = None  # unknown until ingestion runs; see /api/documents/{document_id}/status
     message: str
 
+class DocumentDeleteResponse(BaseModel):
+    success: bool
+    document_id: str
+    chunks_deleted: int
+    message: str
+
+class DocumentStatusResponse(BaseModel):
+    document_id: str
+    state: str
+    filename: Optional[str] = None
+    chunks_processed: int = 0
+    chunks_unchanged: int = 0
+    chunks_embedded: int = 0
+    chunks_inserted: int = 0
+    chunks_failed: int = 0
+    chunks_deleted: int = 0
+    attempts: int = 0
+    error: Optional[str] = None
+    updated_at: Optional[str] = None
+
 class SearchRequest(BaseModel):
     query: str
+    user_id: Optional[str] = Field(None, description="User identifier for per-user limits (anonymous searches are not capped per user)")
     limit: int = Field(10, ge=1, le=100)
     filters: Optional[Dict[str, Any]] = None
+    vector_weight: float = Field(1.0, ge=0, description="Weight of vector hits in rank fusion")
+    lexical_weight: float = Field(1.0, ge=0, description="Weight of BM25 hits in rank fusion (0 disables)")
 
 class SearchResult(BaseModel):
     content: str
@@ -111,12 +439,165 @@ class SearchResult(BaseModel):
     score: float
     metadata: Optional[Dict[str, Any]] = None
 
+# ==================== Metrics ====================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+REQUEST_SECONDS = Histogram(
+    "rag_request_seconds", "HTTP request latency until the last body byte", ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Latency of one pipeline stage", ["operation", "stage"], buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "rag_time_to_first_token_seconds", "Time from request to the first streamed token", buckets=LATENCY_BUCKETS
+)
+UPSTREAM_SECONDS = Histogram(
+    "rag_upstream_seconds", "Upstream call latency (until headers for streams)", ["service", "endpoint"], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_REQUESTS = Counter("rag_upstream_requests", "Upstream calls by status code", ["service", "endpoint", "status"])
+CACHE_LOOKUPS = Counter("rag_cache_lookups", "Cache lookups by result", ["cache", "result"])
+TOKENS_USED = Counter("rag_tokens", "Tokens reported in OpenRouter usage", ["model", "kind"])
+INGEST_CHUNKS = Counter("rag_ingest_chunks", "Chunks handled by ingestion", ["result"])
+INGEST_QUEUE_DEPTH = Gauge("rag_ingest_queue_depth", "Entries in the ingestion streams", ["stream"], multiprocess_mode="mostrecent")
+ADMISSION_WAIT = Histogram(
+    "rag_admission_wait_seconds", "Time queued for an OpenRouter slot and budget", ["priority"], buckets=LATENCY_BUCKETS
+)
+ADMISSION_REJECTED = Counter("rag_admission_rejected", "Requests refused by admission control", ["reason"])
+CHAT_ATTEMPTS = Counter("rag_chat_attempts", "Chat model attempts by outcome", ["model", "outcome"])
+CHAT_HEDGES = Counter("rag_chat_hedges", "Second models started because the first was slow")
+SUPABASE_ROWS = Counter("rag_supabase_rows", "Rows handled by the Supabase writer", ["table", "result"])
+CIRCUIT_OPEN = Gauge("rag_circuit_open", "1 while a chat model's circuit breaker is open in any worker", ["model"], multiprocess_mode="max")
+EVENT_LOOP_LAG = Histogram(
+    "rag_event_loop_lag_seconds", "How late the event loop wakes a sleeping task",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+# Endpoints set the operation their stages are recorded under
+metrics_operation: contextvars.ContextVar[str] = contextvars.ContextVar("metrics_operation", default="background")
+tracer = None
+
+def initialize_tracing():
+    """Export spans over OTLP when tracing is enabled and opentelemetry is installed"""
+    global tracer
+    
+    if not OTEL_TRACING_ENABLED or tracer is not None:
+        return
+    if otel_trace is None:
+        logger.warning("OTEL_TRACING_ENABLED is set but opentelemetry-api is not installed")
+        return
+    
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        
+        # The exporter reads OTEL_EXPORTER_OTLP_ENDPOINT and related variables
+        provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        otel_trace.set_tracer_provider(provider)
+    except ImportError:
+        logger.warning("opentelemetry-sdk or the OTLP exporter is missing; spans go to the globally configured provider")
+    
+    tracer = otel_trace.get_tracer(OTEL_SERVICE_NAME)
+    logger.info("OpenTelemetry tracing enabled")
+
+@contextmanager
+def observe_stage(stage: str, operation: Optional[str] = None):
+    """Time a pipeline stage into rag_stage_seconds, inside a trace span when tracing is on"""
+    operation = operation or metrics_operation.get()
+    started = time.perf_counter()
+    
+    with tracer.start_as_current_span(f"{operation}.{stage}") if tracer else nullcontext():
+        try:
+            yield
+        finally:
+            STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - started)
+
+async def timed_stage(stage: str, awaitable):
+    """Await under observe_stage, for stages run concurrently with asyncio.gather"""
+    with observe_stage(stage):
+        return await awaitable
+
+def record_token_usage(model: str, usage: Optional[Dict[str, Any]], embedding: bool = False) -> Optional[int]:
+    """Count tokens from an OpenRouter usage object; returns the total"""
+    if not usage:
+        return None
+    
+    if embedding:
+        TOKENS_USED.labels(model, "embedding").inc(usage.get("prompt_tokens") or usage.get("total_tokens") or 0)
+    else:
+        TOKENS_USED.labels(model, "prompt").inc(usage.get("prompt_tokens") or 0)
+        TOKENS_USED.labels(model, "completion").inc(usage.get("completion_tokens") or 0)
+    
+    total = usage.get("total_tokens")
+    return int(total) if total is not None else (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+
+async def monitor_event_loop_lag():
+    """Sample scheduling delay; sustained lag means blocking work is running on the loop"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL, 0.0))
+
+def metrics_registry() -> CollectorRegistry:
+    """Registry to expose, aggregating over uvicorn workers in multiprocess mode"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording request latency by route template, including streamed bodies"""
+    
+    def __init__(self, app):
+        self.app = app
+        self.routes: Dict[Any, str] = {}
+    
+    def route_label(self, scope) -> str:
+        # Route templates keep document ids out of the label values
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if endpoint not in self.routes:
+            self.routes[endpoint] = next(
+                (route.path for route in app.routes if getattr(route, "endpoint", None) is endpoint),
+                endpoint.__name__
+            )
+        return self.routes[endpoint]
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        started = time.perf_counter()
+        status = {"code": 500}
+        
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_SECONDS.labels(scope["method"], self.route_label(scope), str(status["code"])).observe(
+                time.perf_counter() - started
+            )
+
+app.add_middleware(RequestMetricsMiddleware)
+
 # ==================== Client Initialization ====================
 
 async def initialize_clients():
     """Initialize external service clients"""
     global supabase_client, redis_client
     
+    initialize_tracing()
+    
     try:
         # Check OpenRouter API key
         if not OPENROUTER_API_KEY:
@@ -126,6 +607,9 @@ async def initialize_clients():
         logger.info(f"OpenRouter configured with embedding model: {OPENROUTER_EMBEDDING_MODEL}")
         logger.info(f"OpenRouter configured with chat model: {OPENROUTER_CHAT_MODEL}")
         
+        # Initialize shared OpenRouter HTTP client
+        get_openrouter_client()
+        
         # Initialize Supabase
         supabase_url = os.getenv("SUPABASE_URL")
         supabase_key = os.getenv("SUPABASE_SERVICE_KEY")
@@ -137,8 +621,13 @@ async def initialize_clients():
         
         # Initialize Redis
         redis_url = os.getenv("REDIS_URL", "redis://redis:6379")
-        redis_client = redis.from_url(redis_url, decode_responses=True)
-        redis_client.ping()
+        redis_client = aioredis.from_url(
+            redis_url,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+        )
+        await redis_client.ping()
         logger.info("Redis client initialized")
         
     except Exception as e:
@@ -146,7 +635,11 @@ async def initialize_clients():
 
 async def initialize_milvus_collection():
     """Initialize Milvus connection and create collection if needed"""
-    global milvus_connected
+    global milvus_connected, milvus_collection, milvus_fields
+    
+    if VECTOR_ENGINE == "local":
+        logger.info("Vector engine is local, skipping Milvus")
+        return
     
     try:
         # Connect to Milvus
@@ -159,38 +652,20 @@ async def initialize_milvus_collection():
         logger.info("Connected to Milvus")
         
         # Check if collection exists
-        collection_name = "legal_documents"
+        collection_name = MILVUS_COLLECTION
         if not utility.has_collection(collection_name):
-            # Create collection schema
-            fields = [
-                FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
-                FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=1536),
-                FieldSchema(name="content", dtype=DataType.VARCHAR, max_length=65535),
-                FieldSchema(name="title", dtype=DataType.VARCHAR, max_length=512),
-                FieldSchema(name="source", dtype=DataType.VARCHAR, max_length=512),
-                FieldSchema(name="chunk_index", dtype=DataType.INT64),
-                FieldSchema(name="created_at", dtype=DataType.INT64)
-            ]
-            
-            schema = CollectionSchema(
-                fields=fields,
-                description="Legal documents for RAG"
-            )
+            schema = milvus_collection_schema()
             
             collection = Collection(
                 name=collection_name,
-                schema=schema
+                schema=schema,
+                num_partitions=MILVUS_NUM_PARTITIONS
             )
             
             # Create index for vector field
-            index_params = {
-                "metric_type": "L2",
-                "index_type": "IVF_FLAT",
-                "params": {"nlist": 128}
-            }
             collection.create_index(
                 field_name="embedding",
-                index_params=index_params
+                index_params=vector_index_params()
             )
             
             collection.load()
@@ -199,366 +674,4064 @@ async def initialize_milvus_collection():
             collection = Collection(collection_name)
             collection.load()
             logger.info(f"Loaded existing collection: {collection_name}")
+        
+        # Reuse one collection handle for every search and insert
+        milvus_collection = collection
+        describe_milvus_collection(collection)
+        configured = vector_index_params()
+        if (milvus_index.get("index_type"), milvus_index.get("metric_type")) != (configured["index_type"], configured["metric_type"]):
+            logger.warning(
+                f"Collection {collection_name} has a {milvus_index.get('index_type')}/{milvus_index.get('metric_type')} index, "
+                f"configured {configured['index_type']}/{configured['metric_type']}; run milvus_reindex.py to migrate"
+            )
+        if milvus_index.get("dim") != EMBEDDING_DIM:
+            logger.warning(
+                f"Collection {collection_name} holds {milvus_index.get('dim')}-dimension vectors, configured {EMBEDDING_DIM}; "
+                f"queries follow the collection until milvus_reindex.py migrates it"
+            )
+        if not set(MILVUS_METADATA_FIELDS) <= milvus_fields:
+            logger.warning(
+                f"Collection {collection_name} predates metadata fields; "
+                f"search filters are limited to {sorted(milvus_fields & set(MILVUS_FILTER_FIELDS + ['title']))}"
+            )
             
     except Exception as e:
         logger.error(f"Error initializing Milvus: {e}")
         milvus_connected = False
+        milvus_collection = None
 
-# ==================== OpenRouter Integration ====================
+# ==================== Milvus Access ====================
 
-async def generate_embedding_openrouter(text: str) -> List[float]:
-    """Generate embeddings using OpenRouter API"""
-    try:
-        # Check cache first
-        cache_key = f"embed:{hashlib.md5(text.encode()).hexdigest()}"
-        if redis_client:
-            cached = redis_client.get(cache_key)
-            if cached:
-                return json.loads(cached)
-        
-        # Generate embedding via OpenRouter
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                f"{OPENROUTER_API_URL}/embeddings",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "HTTP-Referer": OPENROUTER_SITE_URL,
-                    "X-Title": OPENROUTER_APP_NAME,
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "input": text,
-                    "model": OPENROUTER_EMBEDDING_MODEL
-                }
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"OpenRouter embedding error: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail=f"Embedding generation failed: {response.text}")
-            
-            data = response.json()
-            embedding = data["data"][0]["embedding"]
-            
-            # Cache the result
-            if redis_client:
-                redis_client.setex(cache_key, 3600, json.dumps(embedding))
-            
-            return embedding
-            
-    except httpx.TimeoutException:
-        logger.error("OpenRouter API timeout")
-        raise HTTPException(status_code=504, detail="Embedding API timeout")
-    except Exception as e:
-        logger.error(f"Error generating embedding: {e}")
-        raise HTTPException(status_code=500, detail=f"Embedding generation failed: {str(e)}")
+# pymilvus calls are blocking gRPC requests, so they run on a bounded pool
+milvus_executor = ThreadPoolExecutor(max_workers=MILVUS_EXECUTOR_WORKERS, thread_name_prefix="milvus")
 
-async def generate_chat_response_openrouter(query: str, context: str, language: str = "es", model: Optional[str] = None) -> tuple[str, str]:
-    """Generate response using OpenRouter Chat API"""
-    try:
-        system_prompt = {
-            "es": """Eres un asistente legal experto en derecho mexicano. 
-                     Usa el contexto proporcionado para responder preguntas de manera precisa y profesional.
-                     Si el contexto no contiene información relevante, indícalo claramente.
-                     Cita las fuentes cuando sea posible.""",
-            "en": """You are a legal assistant expert in Mexican law. 
-                     Use the provided context to answer questions accurately and professionally.
-                     If the context doesn't contain relevant information, clearly indicate this.
-                     Cite sources when possible."""
-        }
-        
-        # Use provided model or default
-        chat_model = model or OPENROUTER_CHAT_MODEL
-        
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                f"{OPENROUTER_API_URL}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "HTTP-Referer": OPENROUTER_SITE_URL,
-                    "X-Title": OPENROUTER_APP_NAME,
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": chat_model,
-                    "messages": [
-                        {"role": "system", "content": system_prompt.get(language, system_prompt["es"])},
-                        {"role": "user", "content": f"Contexto:\n{context}\n\nPregunta: {query}"}
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 2000,
-                    "top_p": 0.9,
-                    "frequency_penalty": 0.1
-                }
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"OpenRouter chat error: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail=f"Chat generation failed: {response.text}")
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"], chat_model
-            
-    except httpx.TimeoutException:
-        logger.error("OpenRouter API timeout")
-        raise HTTPException(status_code=504, detail="Chat API timeout")
-    except Exception as e:
-        logger.error(f"Error generating chat response: {e}")
-        raise HTTPException(status_code=500, detail=f"Chat generation failed: {str(e)}")
+async def run_milvus(fn, *args, **kwargs):
+    """Run a blocking Milvus call on the Milvus executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(milvus_executor, functools.partial(fn, *args, **kwargs))
 
-async def search_similar_documents(embedding: List[float], top_k: int = 5) -> List[Dict]:
-    """Search for similar documents in Milvus"""
-    if not milvus_connected:
-        logger.warning("Milvus not connected, returning empty results")
-        return []
+def get_milvus_collection() -> Collection:
+    """Return the cached collection handle, creating it if startup did not"""
+    global milvus_collection
     
-    try:
-        collection = Collection("legal_documents")
-        
-        search_params = {
-            "metric_type": "L2",
-            "params": {"nprobe": 10}
-        }
-        
-        results = collection.search(
-            data=[embedding],
-            anns_field="embedding",
-            param=search_params,
-            limit=top_k,
-            output_fields=["content", "title", "source", "chunk_index"]
-        )
-        
-        documents = []
-        for hits in results:
-            for hit in hits:
-                documents.append({
-                    "content": hit.entity.get("content"),
-                    "title": hit.entity.get("title"),
-                    "source": hit.entity.get("source"),
-                    "chunk_index": hit.entity.get("chunk_index"),
-                    "score": float(hit.score)
-                })
-        
-        return documents
-        
-    except Exception as e:
-        logger.error(f"Error searching documents: {e}")
-        return []
+    if milvus_collection is None:
+        milvus_collection = Collection(MILVUS_COLLECTION)
+    return milvus_collection
 
-def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
-    """Split text into overlapping chunks"""
-    chunks = []
-    start = 0
-    text_length = len(text)
+def milvus_collection_schema(
+    dim: int = EMBEDDING_DIM,
+    quantization: str = VECTOR_QUANTIZATION,
+    store_content: bool = not CHUNK_STORE_ENABLED
+) -> CollectionSchema:
+    """Schema for new collections.
     
-    while start < text_length:
-        end = start + chunk_size
-        chunk = text[start:end]
-        
-        # Try to break at sentence boundary
-        if end < text_length:
-            last_period = chunk.rfind('.')
-            if last_period > chunk_size * 0.8:
-                end = start + last_period + 1
-                chunk = text[start:end]
-        
-        chunks.append(chunk.strip())
-        start = end - overlap if end < text_length else text_length
+    Ids are assigned by allocate_chunk_ids so the chunk store and other indexes
+    can be written first. Without store_content, chunk text lives in the chunk
+    store and only the fields searches filter on stay in memory.
+    """
+    if quantization == "binary" and store_content:
+        raise ValueError("Binary vectors are re-scored from the chunk store, so they need CHUNK_STORE_ENABLED")
+    
+    fields = [
+        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=False),
+        FieldSchema(
+            name="embedding",
+            dtype=DataType.BINARY_VECTOR if quantization == "binary" else DataType.FLOAT_VECTOR,
+            dim=dim
+        )
+    ]
+    if store_content:
+        fields.append(FieldSchema(name="content", dtype=DataType.VARCHAR, max_length=65535))
+    fields += [
+        FieldSchema(name="title", dtype=DataType.VARCHAR, max_length=512),
+        FieldSchema(name="source", dtype=DataType.VARCHAR, max_length=512),
+        FieldSchema(name="chunk_index", dtype=DataType.INT64),
+        FieldSchema(name="created_at", dtype=DataType.INT64),
+        FieldSchema(name="doc_id", dtype=DataType.VARCHAR, max_length=64),
+        # Partition key: filtered searches only scan the matching partitions
+        FieldSchema(name="jurisdiction", dtype=DataType.VARCHAR, max_length=64, is_partition_key=True),
+        FieldSchema(name="document_type", dtype=DataType.VARCHAR, max_length=64),
+        FieldSchema(name="legal_domain", dtype=DataType.VARCHAR, max_length=128),
+        FieldSchema(name="document_date", dtype=DataType.INT64),
+        # MD5 of content, so re-ingestion only embeds changed chunks
+        FieldSchema(name="content_hash", dtype=DataType.VARCHAR, max_length=32)
+    ]
     
-    return chunks
+    return CollectionSchema(
+        fields=fields,
+        description="Legal documents for RAG"
+    )
 
-# ==================== API Endpoints ====================
+def vector_index_params(quantization: str = VECTOR_QUANTIZATION) -> Dict[str, Any]:
+    """Embedding index for a vector layout: binary codes get a Hamming index, scalar quantization SQ8 (or PQ)"""
+    if quantization == "binary":
+        return milvus_index_params("BIN_IVF_FLAT", "HAMMING")
+    if quantization == "scalar" and MILVUS_INDEX_TYPE not in ("IVF_SQ8", "IVF_PQ"):
+        return milvus_index_params("IVF_SQ8")
+    return milvus_index_params()
 
-@app.get("/")
-async def root():
-    """Root endpoint"""
+def milvus_index_params(index_type: str = MILVUS_INDEX_TYPE, metric_type: str = MILVUS_METRIC_TYPE, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build parameters for the embedding index, configured defaults overridden by MILVUS_INDEX_PARAMS"""
+    if index_type not in MILVUS_DEFAULT_INDEX_PARAMS:
+        raise ValueError(f"Unsupported index type {index_type}; use one of {sorted(MILVUS_DEFAULT_INDEX_PARAMS)}")
+    if params is None:
+        params = MILVUS_INDEX_PARAMS if index_type == MILVUS_INDEX_TYPE else {}
     return {
-        "name": "LegalTracking RAG API",
-        "version": "1.0.0",
-        "status": "online",
-        "llm_provider": "OpenRouter",
-        "embedding_model": OPENROUTER_EMBEDDING_MODEL,
-        "chat_model": OPENROUTER_CHAT_MODEL,
-        "endpoints": {
-            "health": "/health",
-            "chat": "/api/chat",
-            "upload": "/api/documents/upload",
-            "search": "/api/search",
-            "models": "/api/models"
-        }
+        "index_type": index_type,
+        "metric_type": metric_type,
+        "params": dict(MILVUS_DEFAULT_INDEX_PARAMS[index_type], **params)
     }
 
-@app.get("/health")
-async def health_check():
-    """Health check endpoint"""
-    health_status = {
-        "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
-        "version": "1.0.0",
-        "llm_provider": "OpenRouter",
-        "services": {
-            "openrouter": OPENROUTER_API_KEY is not None,
-            "milvus": milvus_connected,
-            "redis": redis_client.ping() if redis_client else False,
-            "supabase": supabase_client is not None
-        }
-    }
+def describe_milvus_collection(collection: Collection):
+    """Cache the fields, primary key mode and embedding index of the collection behind MILVUS_COLLECTION"""
+    global milvus_fields, milvus_index, milvus_auto_id
     
-    # Check if all critical services are healthy
-    critical_services = ["openrouter", "milvus"]
-    all_critical_healthy = all(health_status["services"][s] for s in critical_services)
+    milvus_fields = {field.name for field in collection.schema.fields}
+    milvus_auto_id = bool(collection.schema.auto_id)
+    milvus_index = {}
+    for field in collection.schema.fields:
+        if field.name == "embedding":
+            milvus_index = {"dim": int(field.params["dim"]), "binary": field.dtype == DataType.BINARY_VECTOR}
+    for index in collection.indexes:
+        if index.field_name == "embedding":
+            params = dict(index.params)
+            build_params = params.get("params", {})
+            if isinstance(build_params, str):
+                build_params = json.loads(build_params)
+            milvus_index.update(
+                index_type=str(params.get("index_type", "")).upper(),
+                metric_type=str(params.get("metric_type", "L2")).upper(),
+                params=build_params
+            )
+
+def milvus_search_params(limit: int) -> Dict[str, Any]:
+    """Search parameters for the collection's actual index, tuned by MILVUS_SEARCH_PARAMS"""
+    index_type = milvus_index.get("index_type", MILVUS_INDEX_TYPE)
+    params = dict(MILVUS_DEFAULT_SEARCH_PARAMS.get(index_type, {}))
+    # Tuned values only apply to the index type they were tuned for
+    if index_type == MILVUS_INDEX_TYPE:
+        params.update(MILVUS_SEARCH_PARAMS)
+    if "ef" in params:
+        params["ef"] = max(int(params["ef"]), limit)
+    if "nprobe" in params and "nlist" in milvus_index.get("params", {}):
+        params["nprobe"] = min(int(params["nprobe"]), int(milvus_index["params"]["nlist"]))
+    return {"metric_type": milvus_index.get("metric_type", MILVUS_METRIC_TYPE), "params": params}
+
+def vector_metric() -> str:
+    """Metric that search scores are expressed in"""
+    if VECTOR_ENGINE == "local":
+        return MILVUS_METRIC_TYPE
+    if milvus_index.get("binary"):
+        # Hamming distances only pick the shortlist; results carry re-scored cosine similarities
+        return "COSINE"
+    return milvus_index.get("metric_type", MILVUS_METRIC_TYPE)
+
+def embedding_dimensions() -> int:
+    """Size of query and chunk embeddings: the live collection's, else EMBEDDING_DIM"""
+    if VECTOR_ENGINE != "local" and milvus_index.get("dim"):
+        return milvus_index["dim"]
+    return EMBEDDING_DIM
+
+def milvus_stores_content() -> bool:
+    """Whether chunk text lives in the collection rather than the chunk store"""
+    return "content" in milvus_fields
+
+def milvus_quantized() -> bool:
+    """Whether the collection searches lossy vectors whose shortlist should be re-scored"""
+    return bool(milvus_index.get("binary")) or milvus_index.get("index_type") in ("IVF_SQ8", "IVF_PQ")
+
+def fit_dimensions(vector: np.ndarray, dim: int) -> np.ndarray:
+    """Shorten embeddings to dim by truncating and renormalizing.
     
-    if not all_critical_healthy:
-        health_status["status"] = "degraded"
+    This is what the embedding API's dimensions parameter does for the
+    text-embedding-3 models, so full-size vectors stay usable after a collection
+    is migrated to fewer dimensions.
+    """
+    if vector.shape[-1] == dim:
+        return vector
+    if vector.shape[-1] < dim:
+        raise ValueError(f"Cannot widen {vector.shape[-1]}-dimension embeddings to {dim}")
+    vector = vector[..., :dim]
+    return vector / np.maximum(np.linalg.norm(vector, axis=-1, keepdims=True), 1e-12)
+
+def milvus_vectors(embeddings: List[List[float]]) -> List[Any]:
+    """Encode embeddings for the collection's vector field: float lists, or packed sign bits"""
+    vectors = fit_dimensions(np.asarray(embeddings, dtype=np.float32), milvus_index.get("dim") or EMBEDDING_DIM)
+    if milvus_index.get("binary"):
+        return [np.packbits(vector > 0).tobytes() for vector in vectors]
+    return vectors.tolist()
+
+def highest_chunk_id() -> int:
+    """Largest primary key already stored; runs on the Milvus executor"""
+    highest = 0
+    if milvus_stores_content():
+        iterator = get_milvus_collection().query_iterator(
+            batch_size=16384, expr="id >= 0", output_fields=["id"], consistency_level="Strong"
+        )
+        try:
+            while True:
+                batch = iterator.next()
+                if not batch:
+                    break
+                highest = max(highest, max(int(row["id"]) for row in batch))
+        finally:
+            iterator.close()
+    else:
+        highest = chunk_store.max_id()
+    if local_vector_store_enabled():
+        with local_vector_store.lock:
+            highest = max(highest, max(local_vector_store.positions, default=0))
+    return highest
+
+async def allocate_chunk_ids(count: int) -> List[int]:
+    """Primary keys for collections without auto_id, which milvus_reindex.py creates to keep ids stable"""
+    if redis_client:
+        try:
+            if not await redis_client.exists(MILVUS_ID_COUNTER_KEY):
+                # A lost counter (flushed or new Redis) would restart at 1 and overwrite existing
+                # chunks; seed it above the stored ids, NX so concurrent seeders agree
+                highest = await run_milvus(highest_chunk_id)
+                if await redis_client.set(MILVUS_ID_COUNTER_KEY, highest, nx=True):
+                    logger.warning(f"Chunk id counter was missing; continuing after id {highest}")
+            last = await redis_client.incrby(MILVUS_ID_COUNTER_KEY, count)
+            return list(range(last - count + 1, last + 1))
+        except Exception as e:
+            logger.warning(f"Chunk id counter unavailable, using time-based ids: {e}")
     
-    return health_status
+    # Milliseconds shifted like Milvus auto ids, far above the counter's range
+    start = (int(time.time() * 1000) << 18) + random.randrange(1 << 17)
+    return list(range(start, start + count))
 
-@app.get("/api/models")
-async def list_models():
-    """List available models from OpenRouter"""
+def milvus_output_fields() -> List[str]:
+    """Fields to return from searches, limited to those present in the collection"""
+    return [field for field in MILVUS_BASE_OUTPUT_FIELDS + MILVUS_METADATA_FIELDS if field in milvus_fields]
+
+def milvus_row_to_document(row_id: int, row: Any) -> Dict[str, Any]:
+    """Convert a Milvus hit entity or query row into a result document"""
     return {
-        "embedding_models": [
-            {"id": "openai/text-embedding-3-small", "name": "OpenAI Embedding Small", "cost": "$0.00002/1k tokens"},
-            {"id": "openai/text-embedding-3-large", "name": "OpenAI Embedding Large", "cost": "$0.00013/1k tokens"},
-            {"id": "voyage/voyage-2", "name": "Voyage 2", "cost": "$0.00012/1k tokens"}
-        ],
-        "chat_models": [
-            {"id": "deepseek/deepseek-chat", "name": "DeepSeek Chat", "cost": "$0.0001/1k tokens"},
-            {"id": "anthropic/claude-3-haiku", "name": "Claude 3 Haiku", "cost": "$0.00025/1k tokens"},
-            {"id": "meta-llama/llama-3-70b-instruct", "name": "Llama 3 70B", "cost": "Free tier available"},
-            {"id": "mistralai/mistral-7b-instruct", "name": "Mistral 7B", "cost": "$0.00007/1k tokens"},
-            {"id": "google/gemini-pro", "name": "Gemini Pro", "cost": "$0.000125/1k tokens"},
-            {"id": "openai/gpt-3.5-turbo", "name": "GPT-3.5 Turbo", "cost": "$0.0005/1k tokens"}
-        ],
-        "current_embedding_model": OPENROUTER_EMBEDDING_MODEL,
-        "current_chat_model": OPENROUTER_CHAT_MODEL
+        "id": int(row_id),
+        "content": row.get("content"),
+        "title": row.get("title"),
+        "source": row.get("source"),
+        "chunk_index": row.get("chunk_index"),
+        "metadata": {
+            field: row.get(field)
+            for field in MILVUS_METADATA_FIELDS if field in milvus_fields
+        }
     }
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest, background_tasks: BackgroundTasks):
-    """RAG-powered chat endpoint using OpenRouter"""
-    try:
-        logger.info(f"Chat request from user {request.user_id}: {request.message[:100]}...")
-        
-        # Generate embedding for the query
-        query_embedding = await generate_embedding_openrouter(request.message)
-        
-        # Search for relevant documents
-        relevant_docs = await search_similar_documents(query_embedding, top_k=5)
+def milvus_literal(value: Any) -> str:
+    """Quote a value for a Milvus boolean expression"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return json.dumps(str(value), ensure_ascii=False)
+
+def parse_document_date(value: Any) -> int:
+    """Convert an ISO date/datetime string or epoch seconds into epoch seconds"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    return int(datetime.fromisoformat(str(value)).timestamp())
+
+def build_filter_expression(filters: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Translate SearchRequest.filters into a Milvus boolean expression.
+    
+    Supported keys: doc_id, source, jurisdiction, document_type, legal_domain
+    (a value or list of values), title (prefix match), date_from and date_to
+    (ISO dates compared against document_date).
+    """
+    if not filters:
+        return None
+    
+    clauses = []
+    for key, value in filters.items():
+        if value is None or value == []:
+            continue
         
-        # Build context from relevant documents
-        context = "\n\n".join([
-            f"[{doc['title']}]:\n{doc['content']}"
-            for doc in relevant_docs
-        ])
+        if key in ("date_from", "date_to"):
+            field = "document_date"
+            try:
+                timestamp = parse_document_date(value)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid date for filter {key}: {value}")
+            clauses.append(f"document_date {'>=' if key == 'date_from' else '<='} {timestamp}")
+        elif key == "title":
+            field = "title"
+            clauses.append(f"title like {milvus_literal(str(value).replace('%', '') + '%')}")
+        elif key in MILVUS_FILTER_FIELDS:
+            field = key
+            if isinstance(value, list):
+                clauses.append(f"{key} in [{', '.join(milvus_literal(item) for item in value)}]")
+            else:
+                clauses.append(f"{key} == {milvus_literal(value)}")
+        else:
+            raise HTTPException(status_code=400, detail=f"Unsupported filter: {key}")
         
-        # Limit context length to avoid token limits
-        max_context_length = 6000
-        if len(context) > max_context_length:
-            context = context[:max_context_length] + "..."
+        if milvus_fields and field not in milvus_fields:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Filter {key} requires the {field} field, which this collection does not have"
+            )
+    
+    return " and ".join(f"({clause})" for clause in clauses) or None
+
+class MilvusSearchBatcher:
+    """Gather queries arriving within a short window into one multi-vector search.
+    
+    Each caller gets a future; when the window closes (or the batch is full) the
+    pending vectors are sent as a single collection.search(data=[...]) call and
+    the per-vector hits are handed back to their callers. Queries are grouped
+    by filter expression, since one search call applies a single expr.
+    """
+    
+    def __init__(self, window_ms: float, max_queries: int):
+        self.window = window_ms / 1000.0
+        self.max_queries = max_queries
+        self.pending: Dict[Optional[str], List[tuple[List[float], int, asyncio.Future]]] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # The event loop only keeps weak references to tasks; hold running searches until they finish
+        self.tasks: set[asyncio.Task] = set()
+        self.stats = {"queries": 0, "batches": 0}
+    
+    async def search(self, embedding: List[float], top_k: int, expr: Optional[str] = None) -> List[Dict]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        group = self.pending.setdefault(expr, [])
+        group.append((embedding, top_k, future))
+        self.stats["queries"] += 1
         
-        # Generate response using OpenRouter
-        response_text, model_used = await generate_chat_response_openrouter(
-            request.message,
-            context,
-            request.language,
-            request.model
-        )
+        if len(group) >= self.max_queries:
+            self.stats["batches"] += 1
+            self.start(self.pending.pop(expr), expr)
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
         
-        # Generate context ID if not provided
-        context_id = request.context_id or hashlib.md5(
-            f"{request.user_id}{datetime.utcnow().isoformat()}".encode()
-        ).hexdigest()
+        return await future
+    
+    def flush(self):
+        self.timer = None
+        groups, self.pending = self.pending, {}
+        for expr, batch in groups.items():
+            self.stats["batches"] += 1
+            self.start(batch, expr)
+    
+    def start(self, batch: List[tuple[List[float], int, asyncio.Future]], expr: Optional[str]):
+        task = asyncio.ensure_future(self.execute(batch, expr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def execute(self, batch: List[tuple[List[float], int, asyncio.Future]], expr: Optional[str]):
+        limit = max(top_k for _, top_k, _ in batch)
+        # Reranking compares hits by their vectors; compact collections read them from the chunk store instead
+        with_vectors = RERANK_ENABLED and milvus_stores_content()
         
-        # Store in Supabase asynchronously
-        if supabase_client:
-            background_tasks.add_task(
-                store_chat_history,
-                request.user_id,
-                request.message,
-                response_text,
-                relevant_docs,
-                context_id,
-                model_used
+        def search():
+            return get_milvus_collection().search(
+                data=milvus_vectors([embedding for embedding, _, _ in batch]),
+                anns_field="embedding",
+                param=milvus_search_params(limit),
+                limit=limit,
+                expr=expr,
+                output_fields=milvus_output_fields() + (["embedding"] if with_vectors else [])
             )
         
-        return ChatResponse(
-            response=response_text,
-            sources=relevant_docs,
-            context_id=context_id,
-            model_used=model_used
-        )
+        try:
+            try:
+                results = await run_milvus(search)
+            except MilvusException:
+                # The alias may have moved to a re-indexed collection with another metric
+                await run_milvus(describe_milvus_collection, get_milvus_collection())
+                results = await run_milvus(search)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
         
+        for hits, (_, top_k, future) in zip(results, batch):
+            if future.done():
+                continue
+            future.set_result([
+                dict(
+                    milvus_row_to_document(hit.id, hit.entity),
+                    score=float(hit.score),
+                    **({"embedding": hit.entity.get("embedding")} if with_vectors else {})
+                )
+                for hit in list(hits)[:top_k]
+            ])
+
+milvus_search_batcher = MilvusSearchBatcher(MILVUS_BATCH_WINDOW_MS, MILVUS_BATCH_MAX_QUERIES)
+
+# ==================== Redis Cache ====================
+
+def embedding_cache_key(text: str, model: Optional[str] = None) -> str:
+    """Redis key for a cached embedding, versioned by model, dimensions and storage format"""
+    digest = hashlib.md5(text.encode()).hexdigest()
+    model = model or OPENROUTER_EMBEDDING_MODEL
+    dimensions = embedding_request_options().get("dimensions")
+    if dimensions:
+        model = f"{model}@{dimensions}"
+    return f"embed:{EMBEDDING_CACHE_VERSION}:{model}:{EMBEDDING_CACHE_DTYPE}:{digest}"
+
+def encode_embedding(embedding: List[float]) -> bytes:
+    """Pack an embedding into compact binary form for Redis"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    
+    if EMBEDDING_CACHE_DTYPE == "float16":
+        return vector.astype(np.float16).tobytes()
+    if EMBEDDING_CACHE_DTYPE == "int8":
+        # Symmetric scalar quantization: float32 scale followed by int8 codes
+        scale = float(np.abs(vector).max()) / 127.0 or 1.0
+        codes = np.clip(np.round(vector / scale), -127, 127).astype(np.int8)
+        return np.float32(scale).tobytes() + codes.tobytes()
+    return vector.tobytes()
+
+def decode_embedding(data: bytes) -> List[float]:
+    """Unpack an embedding stored by encode_embedding"""
+    if EMBEDDING_CACHE_DTYPE == "float16":
+        return np.frombuffer(data, dtype=np.float16).astype(np.float32).tolist()
+    if EMBEDDING_CACHE_DTYPE == "int8":
+        scale = np.frombuffer(data[:4], dtype=np.float32)[0]
+        return (np.frombuffer(data[4:], dtype=np.int8).astype(np.float32) * scale).tolist()
+    return np.frombuffer(data, dtype=np.float32).tolist()
+
+async def get_cached_embeddings(texts: List[str]) -> List[Optional[List[float]]]:
+    """Fetch cached embeddings for many texts with a single MGET"""
+    if not redis_client or not texts:
+        return [None] * len(texts)
+    
+    try:
+        values = await redis_client.mget([embedding_cache_key(text) for text in texts])
     except Exception as e:
-        logger.error(f"Chat error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.warning(f"Embedding cache lookup failed: {e}")
+        CACHE_LOOKUPS.labels("embedding", "error").inc(len(texts))
+        return [None] * len(texts)
+    
+    hits = sum(1 for value in values if value)
+    CACHE_LOOKUPS.labels("embedding", "hit").inc(hits)
+    CACHE_LOOKUPS.labels("embedding", "miss").inc(len(values) - hits)
+    return [decode_embedding(value) if value else None for value in values]
 
-@app.post("/api/documents/upload", response_model=DocumentUploadResponse)
-async def upload_document(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
-    user_id: str = None,
-    title: Optional[str] = None
-):
-    """Upload and process a document"""
+async def cache_embeddings(texts: List[str], embeddings: List[List[float]]):
+    """Store embeddings in Redis with a pipelined SETEX per text"""
+    if not redis_client or not texts:
+        return
+    
     try:
-        # Validate file type
-        allowed_types = ['.pdf', '.txt', '.docx', '.md']
-        file_ext = os.path.splitext(file.filename)[1].lower()
-        if file_ext not in allowed_types:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File type {file_ext} not supported. Allowed: {allowed_types}"
-            )
-        
-        # Read file content
-        content = await file.read()
-        
-        # Extract text based on file type
-        if file_ext == '.txt' or file_ext == '.md':
-            text = content.decode('utf-8')
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for text, embedding in zip(texts, embeddings):
+                pipe.setex(embedding_cache_key(text), EMBEDDING_CACHE_TTL, encode_embedding(embedding))
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Embedding cache write failed: {e}")
+
+# ==================== Request Coalescing ====================
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one shared upstream call.
+    
+    The first caller starts the work as a task; later callers with the same key
+    await that task instead of repeating it and receive its result or error.
+    The task is shielded so a disconnecting caller never cancels it for others.
+    """
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.inflight: Dict[str, asyncio.Task] = {}
+        # Strong references to running tasks, released as each one finishes
+        self.tasks: set[asyncio.Task] = set()
+        self.stats = {"calls": 0, "executions": 0, "collapsed": 0}
+    
+    async def do(self, key: str, fn):
+        self.stats["calls"] += 1
+        task = self.inflight.get(key)
+        if task is None:
+            self.stats["executions"] += 1
+            task = asyncio.ensure_future(fn())
+            self.inflight[key] = task
+            self.tasks.add(task)
+            task.add_done_callback(lambda done: self.finished(key, done))
         else:
-            # For PDF and DOCX, you would implement proper extraction
-            # For now, returning a placeholder
-            text = f"Document content from {file.filename}"
-        
-        # Chunk the document
-        chunks = chunk_text(text)
-        
-        # Generate document ID
-        doc_id = hashlib.md5(
-            f"{file.filename}{datetime.utcnow().isoformat()}".encode()
-        ).hexdigest()
-        
-        # Process chunks asynchronously
-        background_tasks.add_task(
-            process_document_chunks,
-            chunks,
-            doc_id,
-            title or file.filename,
-            file.filename,
-            user_id
+            self.stats["collapsed"] += 1
+        return await asyncio.shield(task)
+    
+    def finished(self, key: str, task: asyncio.Task):
+        self.tasks.discard(task)
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+embedding_flight = SingleFlight("embedding")
+search_flight = SingleFlight("search")
+chat_flight = SingleFlight("chat")
+
+def vector_key(embedding: List[float]) -> str:
+    """Stable hash of an embedding for coalescing identical searches"""
+    return hashlib.md5(np.asarray(embedding, dtype=np.float32).tobytes()).hexdigest()
+
+# ==================== Answer Cache ====================
+
+class SemanticAnswerCache:
+    """In-process LRU cache of chat answers looked up by query embedding similarity.
+    
+    Vectors are kept normalized in a preallocated matrix so a lookup is a single
+    matrix-vector product. Entries only match requests with the same language,
+    model and retrieval settings. Each entry records the ingestion version of the
+    sources it used, so re-ingesting a source invalidates dependent answers.
+    """
+    
+    def __init__(self, max_entries: int, ttl: int, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.matrix: Optional[np.ndarray] = None
+        self.namespaces = np.full(max_entries, -1, dtype=np.int64)
+        self.namespace_ids: Dict[str, int] = {}
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+    
+    def _namespace(self, language: str, model: str, retrieval: str) -> int:
+        key = f"{OPENROUTER_EMBEDDING_MODEL}|{model}|{language}|{retrieval}"
+        if key not in self.namespace_ids:
+            self.namespace_ids[key] = len(self.namespace_ids)
+        return self.namespace_ids[key]
+    
+    def _remove(self, slot: int):
+        self.entries.pop(slot, None)
+        self.namespaces[slot] = -1
+        self.free_slots.append(slot)
+    
+    def lookup(self, embedding: List[float], language: str, model: str, retrieval: str = "") -> Optional[Dict[str, Any]]:
+        """Return the most similar live entry above the threshold, if any"""
+        if self.matrix is None or not self.entries:
+            self.stats["misses"] += 1
+            return None
+        
+        query = np.asarray(embedding, dtype=np.float32)
+        if query.shape[0] != self.matrix.shape[1]:
+            self.stats["misses"] += 1
+            return None
+        query = query / (np.linalg.norm(query) or 1.0)
+        
+        scores = self.matrix @ query
+        scores[self.namespaces != self._namespace(language, model, retrieval)] = -1.0
+        slot = int(np.argmax(scores))
+        
+        entry = self.entries.get(slot)
+        if entry is None or scores[slot] < self.threshold:
+            self.stats["misses"] += 1
+            return None
+        
+        if time.time() - entry["created"] > self.ttl:
+            self._remove(slot)
+            self.stats["evictions"] += 1
+            self.stats["misses"] += 1
+            return None
+        
+        self.entries.move_to_end(slot)
+        return dict(entry, slot=slot, similarity=float(scores[slot]))
+    
+    def store(
+        self,
+        embedding: List[float],
+        language: str,
+        model: str,
+        response: str,
+        sources: List[Dict],
+        source_versions: Dict[str, int],
+        retrieval: str = ""
+    ):
+        """Insert an answer, evicting the least recently used entry when full"""
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self.matrix is None:
+            self.matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        if vector.shape[0] != self.matrix.shape[1]:
+            return
+        
+        if not self.free_slots:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+        
+        slot = self.free_slots.pop()
+        self.matrix[slot] = vector / (np.linalg.norm(vector) or 1.0)
+        self.namespaces[slot] = self._namespace(language, model, retrieval)
+        self.entries[slot] = {
+            "response": response,
+            "sources": sources,
+            "model": model,
+            "source_versions": source_versions,
+            "created": time.time()
+        }
+        self.stats["stores"] += 1
+    
+    def invalidate(self, slot: int):
+        """Drop a single entry whose sources changed"""
+        if slot in self.entries:
+            self._remove(slot)
+            self.stats["invalidations"] += 1
+    
+    def invalidate_sources(self, sources: List[str]) -> int:
+        """Drop every entry that used any of the given sources"""
+        targets = set(sources)
+        stale = [
+            slot for slot, entry in self.entries.items()
+            if targets.intersection(entry["source_versions"])
+        ]
+        for slot in stale:
+            self.invalidate(slot)
+        return len(stale)
+
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD)
+
+def source_version_key(source: str) -> str:
+    """Redis key holding the ingestion version of a document source"""
+    return f"source_version:{hashlib.md5(source.encode()).hexdigest()}"
+
+async def get_source_versions(sources: List[str]) -> Dict[str, int]:
+    """Fetch the current ingestion version of each source"""
+    unique_sources = sorted(set(sources))
+    if not redis_client or not unique_sources:
+        return {source: 0 for source in unique_sources}
+    
+    try:
+        values = await redis_client.mget([source_version_key(source) for source in unique_sources])
+        return {source: int(value or 0) for source, value in zip(unique_sources, values)}
+    except Exception as e:
+        logger.warning(f"Source version lookup failed: {e}")
+        return {source: 0 for source in unique_sources}
+
+def retrieval_settings(vector_weight: float, lexical_weight: float, filters: Optional[Dict[str, Any]] = None) -> str:
+    """Answer cache key part: requests that retrieve differently may get different sources"""
+    return json.dumps([vector_weight, lexical_weight, filters or {}], sort_keys=True, default=str)
+
+async def lookup_cached_answer(
+    embedding: List[float],
+    language: str,
+    model: str,
+    retrieval: str = ""
+) -> Optional[Dict[str, Any]]:
+    """Find a cached answer for a semantically equivalent question"""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    
+    entry = answer_cache.lookup(embedding, language, model, retrieval)
+    if entry is None:
+        CACHE_LOOKUPS.labels("answer", "miss").inc()
+        return None
+    
+    # Answers built from re-ingested sources are stale, possibly from another worker
+    current_versions = await get_source_versions(list(entry["source_versions"]))
+    if current_versions != entry["source_versions"]:
+        answer_cache.invalidate(entry["slot"])
+        answer_cache.stats["misses"] += 1
+        CACHE_LOOKUPS.labels("answer", "stale").inc()
+        return None
+    
+    answer_cache.stats["hits"] += 1
+    CACHE_LOOKUPS.labels("answer", "hit").inc()
+    logger.info(f"Answer cache hit (similarity {entry['similarity']:.3f})")
+    return entry
+
+async def store_cached_answer(
+    embedding: List[float],
+    language: str,
+    model: str,
+    response: str,
+    sources: List[Dict],
+    retrieval: str = ""
+):
+    """Cache a generated answer together with the versions of its sources"""
+    source_names = [doc["source"] for doc in sources if doc.get("source")]
+    # Without sources nothing would invalidate the answer once relevant documents are ingested
+    if not ANSWER_CACHE_ENABLED or not response or not source_names:
+        return
+    
+    source_versions = await get_source_versions(source_names)
+    answer_cache.store(embedding, language, model, response, sources, source_versions, retrieval)
+
+async def invalidate_cached_answers(sources: List[str]):
+    """Bump source versions after ingestion so dependent answers are dropped everywhere"""
+    if redis_client and sources:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for source in set(sources):
+                    pipe.incr(source_version_key(source))
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Source version update failed: {e}")
+    
+    dropped = answer_cache.invalidate_sources(sources)
+    if dropped:
+        logger.info(f"Invalidated {dropped} cached answers for re-ingested sources")
+
+# ==================== Conversation Memory ====================
+
+CONVERSATION_SUMMARY_PROMPTS = {
+    "es": """Resume la conversación entre un usuario y un asistente legal. Integra los turnos nuevos
+             en el resumen existente y conserva hechos del caso, leyes y artículos citados y
+             preguntas pendientes. Responde solo con el resumen, en menos de {tokens} tokens.""",
+    "en": """Summarize the conversation between a user and a legal assistant. Merge the new turns
+             into the existing summary, keeping case facts, laws and articles cited and open
+             questions. Reply with the summary only, in fewer than {tokens} tokens."""
+}
+CONVERSATION_LABELS = {
+    "es": {"summary": "Resumen de la conversación anterior", "new_turns": "Turnos nuevos", "user": "Usuario", "assistant": "Asistente"},
+    "en": {"summary": "Summary of the earlier conversation", "new_turns": "New turns", "user": "User", "assistant": "Assistant"}
+}
+
+def conversation_key(context_id: str) -> str:
+    return f"{CONVERSATION_KEY_PREFIX}{context_id}"
+
+async def fetch_conversation(context_id: str) -> Optional[Dict[str, Any]]:
+    data = await redis_client.get(conversation_key(context_id))
+    return json.loads(data) if data else None
+
+async def load_conversation(context_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+    """Conversation state for a follow-up request, or None"""
+    if not CONVERSATION_MEMORY_ENABLED or not redis_client:
+        return None
+    try:
+        conversation = await fetch_conversation(context_id)
+    except Exception as e:
+        logger.warning(f"Conversation load error: {e}")
+        return None
+    if conversation and conversation.get("user_id") != user_id:
+        # Context ids travel in URLs and logs; never hand one user's conversation to another
+        logger.warning(f"Context {context_id} belongs to another user; answering without its history")
+        conversation = None
+    CACHE_LOOKUPS.labels("conversation", "hit" if conversation else "miss").inc()
+    return conversation
+
+def conversation_messages(conversation: Optional[Dict[str, Any]], language: str = "es") -> List[Dict[str, str]]:
+    """Summary and recent turns as chat messages to place before the current question"""
+    if not conversation:
+        return []
+    labels = CONVERSATION_LABELS.get(language, CONVERSATION_LABELS["es"])
+    messages = []
+    if conversation.get("summary"):
+        messages.append({"role": "system", "content": f"{labels['summary']}:\n{conversation['summary']}"})
+    for turn in conversation.get("turns", []):
+        messages.append({"role": "user", "content": turn["question"]})
+        messages.append({"role": "assistant", "content": turn["answer"]})
+    return messages
+
+def count_history_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(count_tokens(message["content"]) + 4 for message in messages)
+
+def reuses_previous_sources(conversation: Optional[Dict[str, Any]], message: str, embedding: List[float]) -> bool:
+    """Whether a follow-up can be answered from the sources already retrieved for the conversation"""
+    if not conversation or not conversation.get("sources") or not conversation.get("anchor"):
+        return False
+    anchor = np.asarray(conversation["anchor"], dtype=np.float32)
+    query = np.asarray(embedding, dtype=np.float32)
+    if anchor.shape != query.shape:
+        return False
+    similarity = float(anchor @ query) / ((float(np.linalg.norm(anchor)) * float(np.linalg.norm(query))) or 1.0)
+    if similarity >= CONVERSATION_REUSE_THRESHOLD:
+        return True
+    # Follow-ups whose terms all occur in those sources ("¿y el plazo?") refer back to them
+    terms = set(lexical_tokens(message))
+    source_terms = set(lexical_tokens(" ".join(doc.get("content") or "" for doc in conversation["sources"])))
+    return bool(terms) and terms <= source_terms
+
+async def summarize_turns(summary: str, turns: List[Dict[str, str]], language: str = "es") -> str:
+    """Fold turns that left the verbatim window into the running summary"""
+    labels = CONVERSATION_LABELS.get(language, CONVERSATION_LABELS["es"])
+    transcript = "\n\n".join(
+        f"{labels['user']}: {turn['question']}\n{labels['assistant']}: {turn['answer']}" for turn in turns
+    )
+    system_prompt = CONVERSATION_SUMMARY_PROMPTS.get(language, CONVERSATION_SUMMARY_PROMPTS["es"])
+    payload = {
+        "model": CONVERSATION_SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt.format(tokens=CONVERSATION_SUMMARY_TOKENS)},
+            {"role": "user", "content": f"{labels['summary']}:\n{summary or '-'}\n\n{labels['new_turns']}:\n{transcript}"}
+        ],
+        "temperature": 0.2,
+        "max_tokens": CONVERSATION_SUMMARY_TOKENS
+    }
+    
+    try:
+        # Summaries are written after the answer has been sent, so they yield to live requests
+        async with openrouter_admission(payload, PRIORITY_INGEST):
+            response = await openrouter_post("/chat/completions", payload, timeout=OPENROUTER_CHAT_TIMEOUT)
+        if response.status_code == 200:
+            data = response.json()
+            record_token_usage(CONVERSATION_SUMMARY_MODEL, data.get("usage"))
+            await openrouter_budget.charge((data.get("usage") or {}).get("completion_tokens") or 0)
+            content = (data["choices"][0]["message"]["content"] or "").strip()
+            if content:
+                return truncate_to_tokens(content, CONVERSATION_SUMMARY_TOKENS)
+        else:
+            logger.warning(f"Conversation summary failed: HTTP {response.status_code}")
+    except Exception as e:
+        logger.warning(f"Conversation summary failed: {e}")
+    
+    # Without a model summary keep the most recent text, so the budget still holds
+    recent = f"{summary}\n\n{transcript}".strip()[-CONVERSATION_SUMMARY_TOKENS * 4:]
+    return truncate_to_tokens(recent, CONVERSATION_SUMMARY_TOKENS)
+
+async def remember_turn(
+    context_id: str,
+    user_id: str,
+    question: str,
+    answer: str,
+    sources: List[Dict],
+    anchor: List[float],
+    language: str = "es"
+):
+    """Append a turn to the conversation, folding older turns into the summary.
+    
+    The summary and the verbatim turns together stay within CONVERSATION_MAX_TOKENS,
+    so the prompt does not grow over a long session. anchor is the embedding the
+    sources were retrieved for.
+    """
+    if not CONVERSATION_MEMORY_ENABLED or not redis_client or not answer:
+        return
+    
+    key = conversation_key(context_id)
+    # A single turn never takes more than half the verbatim budget
+    turns_budget = max(CONVERSATION_MAX_TOKENS - CONVERSATION_SUMMARY_TOKENS, 64)
+    turn = {
+        "question": truncate_to_tokens(question, turns_budget // 4),
+        "answer": truncate_to_tokens(answer, turns_budget // 4)
+    }
+    summaries = {}
+    try:
+        # Turns of the same conversation can finish concurrently; the write only lands if
+        # nobody else wrote the conversation since it was read, otherwise it is redone
+        for _ in range(CONVERSATION_WRITE_ATTEMPTS):
+            async with redis_client.pipeline(transaction=True) as pipe:
+                await pipe.watch(key)
+                data = await pipe.get(key)
+                conversation = json.loads(data) if data else {
+                    "user_id": user_id,
+                    "summary": "",
+                    "turns": [],
+                    "summarized_turns": 0
+                }
+                if conversation.get("user_id") != user_id:
+                    return
+                turns = conversation["turns"]
+                turns.append(turn)
+                
+                folded = []
+                while len(turns) > 1 and (
+                    len(turns) > CONVERSATION_RECENT_TURNS
+                    or count_history_tokens(conversation_messages({"turns": turns})) > turns_budget
+                ):
+                    folded.append(turns.pop(0))
+                if folded:
+                    # A retry that folds the same turns reuses the summary instead of asking the model again
+                    fold_key = json.dumps([conversation["summary"], folded], ensure_ascii=False)
+                    if fold_key not in summaries:
+                        summaries[fold_key] = await summarize_turns(conversation["summary"], folded, language)
+                    conversation["summary"] = summaries[fold_key]
+                    conversation["summarized_turns"] += len(folded)
+                
+                conversation["sources"] = sources
+                conversation["anchor"] = np.round(np.asarray(anchor, dtype=np.float32), 5).tolist()
+                conversation["updated_at"] = datetime.utcnow().isoformat()
+                pipe.multi()
+                pipe.setex(key, CONVERSATION_TTL, json.dumps(conversation, ensure_ascii=False))
+                try:
+                    await pipe.execute()
+                    return
+                except aioredis.WatchError:
+                    continue
+        logger.warning(f"Conversation store for context {context_id} kept conflicting; turn dropped")
+    except Exception as e:
+        logger.warning(f"Conversation store error for context {context_id}: {e}")
+
+# ==================== Admission Control ====================
+
+def overloaded(retry_after: float, detail: str) -> HTTPException:
+    """503 telling the client when to retry"""
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+class AdmissionRejected(HTTPException):
+    """503 from our own admission control, as opposed to an overloaded upstream"""
+    
+    def __init__(self, retry_after: float, detail: str):
+        super().__init__(status_code=503, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+class PrioritySemaphore:
+    """Concurrency limit that hands freed slots to the most urgent waiter first.
+    
+    Lower priority values are more urgent. Priorities other than the most urgent
+    may only fill the slots outside the reserve, so interactive calls find room
+    even while ingestion is saturating the pool.
+    """
+    
+    def __init__(self, limit: int, reserve: float):
+        self.limit = limit
+        self.reserved = int(limit * reserve)
+        self.active = 0
+        self.waiters: List[tuple[int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.hold_seconds = 0.5  # moving average of how long a slot is held
+    
+    def capacity(self, priority: int) -> int:
+        return self.limit if priority == PRIORITY_INTERACTIVE else max(self.limit - self.reserved, 1)
+    
+    def expected_wait(self, priority: int) -> float:
+        """Seconds a new waiter of this priority would likely queue"""
+        if self.active < self.capacity(priority):
+            return 0.0
+        ahead = sum(1 for waiter in self.waiters if waiter[0] <= priority and not waiter[2].done())
+        return (ahead + 1) * self.hold_seconds / self.capacity(priority)
+    
+    def _grant(self):
+        while self.waiters:
+            priority, _, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.active >= self.capacity(priority):
+                return
+            heapq.heappop(self.waiters)
+            self.active += 1
+            future.set_result(None)
+    
+    async def acquire(self, priority: int, timeout: Optional[float] = None):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self._grant()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except BaseException:
+            # A slot granted just as the wait was abandoned still has to be handed back
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+    
+    def release(self, held: Optional[float] = None):
+        self.active -= 1
+        if held is not None:
+            self.hold_seconds = 0.9 * self.hold_seconds + 0.1 * held
+        self._grant()
+
+class TokenBucket:
+    """A per-minute allowance refilled continuously, used when Redis is unavailable"""
+    
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+    
+    def shortfall(self, cost: float, reserve: float) -> float:
+        """Seconds until cost can be taken while leaving reserve of the capacity"""
+        self.refill()
+        cost = min(cost, self.capacity * (1 - reserve))
+        return max(cost + self.capacity * reserve - self.level, 0.0) * 60.0 / self.capacity
+
+# Takes from every bucket or from none; returns the milliseconds to wait otherwise.
+# ARGV: now_ms, reserve, then capacity and cost for each key
+BUDGET_TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local reserve = tonumber(ARGV[2])
+local wait = 0
+local levels = {}
+local costs = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[1 + 2 * i])
+    local state = redis.call('HMGET', key, 'level', 'updated')
+    local level = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    level = math.min(capacity, level + math.max(now - updated, 0) * capacity / 60000)
+    costs[i] = math.min(tonumber(ARGV[2 + 2 * i]), capacity * (1 - reserve))
+    levels[i] = level
+    local short = costs[i] + capacity * reserve - level
+    if short > 0 then
+        wait = math.max(wait, short * 60000 / capacity)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'level', tostring(levels[i] - costs[i]), 'updated', tostring(now))
+    redis.call('PEXPIRE', key, 120000)
+end
+return 0
+"""
+
+# Charges usage learned after the call; a bucket that expired meanwhile starts full again
+BUDGET_CHARGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'level', -tonumber(ARGV[1]))
+end
+return 0
+"""
+
+class UpstreamBudget:
+    """Requests-per-minute and tokens-per-minute budget for one upstream.
+    
+    The buckets live in Redis so API processes and ingest workers share one
+    budget; each process falls back to its own buckets when Redis is down.
+    Ingestion may only spend the budget above INTERACTIVE_RESERVE.
+    """
+    
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: int):
+        self.name = name
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.local = {kind: TokenBucket(limit) for kind, limit in self.limits.items() if limit > 0}
+        self.paused_until = 0.0
+    
+    def key(self, kind: str) -> str:
+        return f"{ADMISSION_BUDGET_KEY}:{self.name}:{kind}"
+    
+    def pause(self, seconds: float):
+        """Hold back calls from this process after the upstream answered 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def shortfall(self, tokens: int, reserve: float) -> float:
+        """Take the allowance for one call, or return the seconds to wait for it"""
+        paused = self.paused_until - time.monotonic()
+        if paused > 0:
+            return paused
+        if not self.local:
+            return 0.0
+        
+        costs = {"requests": 1, "tokens": tokens}
+        if redis_client:
+            try:
+                kinds = list(self.local)
+                arguments = [int(time.time() * 1000), reserve]
+                for kind in kinds:
+                    arguments += [self.limits[kind], costs[kind]]
+                wait_ms = await redis_client.eval(BUDGET_TAKE_SCRIPT, len(kinds), *[self.key(kind) for kind in kinds], *arguments)
+                return int(wait_ms) / 1000.0
+            except Exception as e:
+                logger.debug(f"Shared {self.name} budget unavailable, using this process's: {e}")
+        
+        wait = max(bucket.shortfall(costs[kind], reserve) for kind, bucket in self.local.items())
+        if wait == 0:
+            for kind, bucket in self.local.items():
+                bucket.level -= min(costs[kind], bucket.capacity * (1 - reserve))
+        return wait
+    
+    async def charge(self, tokens: int):
+        """Spend tokens only known after the call, such as completion tokens"""
+        if tokens <= 0 or "tokens" not in self.local:
+            return
+        if redis_client:
+            try:
+                await redis_client.eval(BUDGET_CHARGE_SCRIPT, 1, self.key("tokens"), tokens)
+                return
+            except Exception:
+                pass
+        self.local["tokens"].level -= tokens
+
+class UserConcurrencyLimiter:
+    """Caps in-flight requests per user in this process"""
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active: Dict[str, int] = {}
+    
+    def acquire(self, user_id: Optional[str]):
+        """Claim a slot or raise 429; returns an idempotent release function.
+        
+        Anonymous requests are not capped here: behind the nginx proxy they all
+        share its address, so admission control is what bounds them.
+        """
+        if user_id is None:
+            return lambda: None
+        if self.limit and self.active.get(user_id, 0) >= self.limit:
+            ADMISSION_REJECTED.labels("user_limit").inc()
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many concurrent requests (limit {self.limit} per user)",
+                headers={"Retry-After": "1"}
+            )
+        self.active[user_id] = self.active.get(user_id, 0) + 1
+        released = False
+        
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.active[user_id] -= 1
+            if not self.active[user_id]:
+                del self.active[user_id]
+        
+        return release
+
+openrouter_slots = PrioritySemaphore(OPENROUTER_MAX_CONCURRENCY, INTERACTIVE_RESERVE)
+openrouter_budget = UpstreamBudget("openrouter", OPENROUTER_REQUESTS_PER_MINUTE, OPENROUTER_TOKENS_PER_MINUTE)
+user_limiter = UserConcurrencyLimiter(USER_MAX_CONCURRENT_REQUESTS)
+
+def estimate_request_tokens(payload: Dict[str, Any]) -> int:
+    """Cheap token estimate charged before a call; completions are charged from usage afterwards"""
+    if "messages" in payload:
+        return sum(len(str(message.get("content", ""))) for message in payload["messages"]) // 4 + 1
+    inputs = payload.get("input")
+    return sum(len(text) for text in (inputs if isinstance(inputs, list) else [inputs or ""])) // 4 + 1
+
+@asynccontextmanager
+async def openrouter_admission(payload: Dict[str, Any], priority: int = PRIORITY_INTERACTIVE):
+    """Hold an OpenRouter slot and budget for one call.
+    
+    Interactive calls that would wait longer than ADMISSION_QUEUE_TARGET_MS are
+    refused at once with a 503 and a Retry-After hint; ingestion waits its turn.
+    """
+    interactive = priority == PRIORITY_INTERACTIVE
+    label = "interactive" if interactive else "ingest"
+    started = time.perf_counter()
+    deadline = started + ADMISSION_QUEUE_TARGET_MS / 1000 if interactive else None
+    
+    expected = openrouter_slots.expected_wait(priority)
+    if deadline and started + expected > deadline:
+        ADMISSION_REJECTED.labels("queue").inc()
+        raise AdmissionRejected(expected, "Server busy, retry later")
+    try:
+        await openrouter_slots.acquire(priority, deadline - started if deadline else None)
+    except asyncio.TimeoutError:
+        ADMISSION_REJECTED.labels("queue").inc()
+        raise AdmissionRejected(openrouter_slots.expected_wait(priority), "Server busy, retry later")
+    
+    acquired = time.perf_counter()
+    try:
+        reserve = 0.0 if interactive else INTERACTIVE_RESERVE
+        tokens = estimate_request_tokens(payload)
+        while True:
+            wait = await openrouter_budget.shortfall(tokens, reserve)
+            if not wait:
+                break
+            if deadline and time.perf_counter() + wait > deadline:
+                ADMISSION_REJECTED.labels("budget").inc()
+                raise AdmissionRejected(wait, "OpenRouter rate budget exhausted, retry later")
+            await asyncio.sleep(min(wait, 1.0))
+        
+        ADMISSION_WAIT.labels(label).observe(time.perf_counter() - started)
+        yield
+    finally:
+        openrouter_slots.release(time.perf_counter() - acquired)
+
+class UpstreamRetryable(Exception):
+    """A 429 or 5xx answer worth retrying"""
+    
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+def wait_for_retry(retry_state) -> float:
+    """tenacity wait honoring Retry-After, else exponential backoff with jitter"""
+    error = retry_state.outcome.exception()
+    response = error.response if isinstance(error, UpstreamRetryable) else None
+    return min(retry_delay(response, retry_state.attempt_number - 1), OPENROUTER_RETRY_MAX_DELAY)
+
+async def openrouter_request(path: str, payload: Dict[str, Any], timeout: float) -> httpx.Response:
+    """Interactive POST through admission control, retrying 429s, 5xx answers and timeouts"""
+    try:
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(OPENROUTER_MAX_RETRIES + 1),
+            wait=wait_for_retry,
+            retry=retry_if_exception_type((UpstreamRetryable, httpx.TimeoutException, httpx.TransportError)),
+            reraise=True
+        ):
+            with attempt:
+                async with openrouter_admission(payload):
+                    response = await openrouter_post(path, payload, timeout)
+                if response.status_code == 429:
+                    openrouter_budget.pause(retry_delay(response, 0))
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise UpstreamRetryable(response)
+                return response
+    except UpstreamRetryable as e:
+        raise overloaded(
+            retry_delay(e.response, 0),
+            f"OpenRouter unavailable (HTTP {e.response.status_code}), retry later"
+        )
+
+# ==================== OpenRouter Integration ====================
+
+def get_openrouter_client() -> httpx.AsyncClient:
+    """Return the shared pooled OpenRouter client, creating it on first use"""
+    global openrouter_client
+    
+    if openrouter_client is None or openrouter_client.is_closed:
+        openrouter_client = httpx.AsyncClient(
+            base_url=OPENROUTER_API_URL,
+            http2=OPENROUTER_HTTP2,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "HTTP-Referer": OPENROUTER_SITE_URL,
+                "X-Title": OPENROUTER_APP_NAME,
+                "Content-Type": "application/json"
+            },
+            limits=httpx.Limits(
+                max_connections=OPENROUTER_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE,
+                keepalive_expiry=OPENROUTER_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(
+                OPENROUTER_CHAT_TIMEOUT,
+                connect=OPENROUTER_CONNECT_TIMEOUT,
+                pool=OPENROUTER_POOL_TIMEOUT
+            )
+        )
+        logger.info(
+            f"OpenRouter client initialized (http2={OPENROUTER_HTTP2}, "
+            f"max_connections={OPENROUTER_MAX_CONNECTIONS}, max_keepalive={OPENROUTER_MAX_KEEPALIVE})"
+        )
+    
+    return openrouter_client
+
+async def close_openrouter_client():
+    """Close the shared OpenRouter client and release pooled connections"""
+    global openrouter_client
+    
+    if openrouter_client is not None:
+        await openrouter_client.aclose()
+        openrouter_client = None
+        logger.info(f"OpenRouter client closed: {openrouter_stats}")
+
+def endpoint_timeout(read_timeout: float) -> httpx.Timeout:
+    """Build a per-endpoint timeout sharing the pool-wide connect and pool limits"""
+    return httpx.Timeout(
+        read_timeout,
+        connect=OPENROUTER_CONNECT_TIMEOUT,
+        pool=OPENROUTER_POOL_TIMEOUT
+    )
+
+def connection_tracer():
+    """Build an httpcore trace callback that records whether a new socket was opened"""
+    opened = {"connection": False}
+    
+    async def trace(event_name: str, info: Dict[str, Any]):
+        # httpcore only emits connect events when the pool has to open a new socket
+        if event_name == "connection.connect_tcp.complete":
+            opened["connection"] = True
+            openrouter_stats["new_connections"] += 1
+        elif event_name == "connection.start_tls.complete":
+            openrouter_stats["tls_handshakes"] += 1
+    
+    def record():
+        openrouter_stats["requests"] += 1
+        if not opened["connection"]:
+            openrouter_stats["reused_connections"] += 1
+    
+    return trace, record
+
+def upstream_error_label(error: Exception) -> str:
+    return "timeout" if isinstance(error, httpx.TimeoutException) else "error"
+
+async def openrouter_post(path: str, payload: Dict[str, Any], timeout: float) -> httpx.Response:
+    """POST to OpenRouter through the shared client, tracking connection reuse"""
+    trace, record = connection_tracer()
+    started = time.perf_counter()
+    
+    try:
+        response = await get_openrouter_client().post(
+            path,
+            json=payload,
+            timeout=endpoint_timeout(timeout),
+            extensions={"trace": trace}
+        )
+    except Exception as e:
+        UPSTREAM_REQUESTS.labels("openrouter", path, upstream_error_label(e)).inc()
+        raise
+    finally:
+        UPSTREAM_SECONDS.labels("openrouter", path).observe(time.perf_counter() - started)
+    record()
+    UPSTREAM_REQUESTS.labels("openrouter", path, str(response.status_code)).inc()
+    
+    return response
+
+@asynccontextmanager
+async def openrouter_stream(path: str, payload: Dict[str, Any], timeout: float):
+    """Open a streaming POST to OpenRouter through the shared client"""
+    trace, record = connection_tracer()
+    started = time.perf_counter()
+    opened = False
+    
+    try:
+        async with get_openrouter_client().stream(
+            "POST",
+            path,
+            json=payload,
+            timeout=endpoint_timeout(timeout),
+            extensions={"trace": trace}
+        ) as response:
+            opened = True
+            record()
+            UPSTREAM_SECONDS.labels("openrouter", path).observe(time.perf_counter() - started)
+            UPSTREAM_REQUESTS.labels("openrouter", path, str(response.status_code)).inc()
+            yield response
+    except Exception as e:
+        # Errors raised while the caller reads the body are not upstream failures to open the stream
+        if not opened:
+            UPSTREAM_SECONDS.labels("openrouter", path).observe(time.perf_counter() - started)
+            UPSTREAM_REQUESTS.labels("openrouter", path, upstream_error_label(e)).inc()
+        raise
+
+def embedding_request_options() -> Dict[str, Any]:
+    """Ask for shortened embeddings when the vector store uses fewer dimensions than the model.
+    
+    Many embedding models reject the dimensions parameter, so it is only sent when
+    EMBEDDING_DIMENSIONS asks for it or the model is known to produce another size.
+    """
+    native = next((model["dimensions"] for model in EMBEDDING_MODELS if model["id"] == OPENROUTER_EMBEDDING_MODEL), None)
+    dimensions = embedding_dimensions()
+    if EMBEDDING_DIMENSIONS or (native is not None and dimensions != native):
+        return {"dimensions": dimensions}
+    return {}
+
+async def generate_embedding_openrouter(text: str) -> List[float]:
+    """Generate embeddings using OpenRouter API, coalescing identical in-flight requests"""
+    return await embedding_flight.do(embedding_cache_key(text), lambda: fetch_embedding_openrouter(text))
+
+async def fetch_embedding_openrouter(text: str) -> List[float]:
+    """Fetch a single embedding from the cache or OpenRouter"""
+    try:
+        # Check cache first
+        cached = (await get_cached_embeddings([text]))[0]
+        if cached is not None:
+            return cached
+        
+        # Generate embedding via the shared OpenRouter client
+        response = await openrouter_request(
+            "/embeddings",
+            {
+                "input": text,
+                "model": OPENROUTER_EMBEDDING_MODEL,
+                **embedding_request_options()
+            },
+            timeout=OPENROUTER_EMBEDDING_TIMEOUT
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"OpenRouter embedding error: {response.text}")
+            raise HTTPException(status_code=502, detail=f"Embedding generation failed: {response.text}")
+        
+        data = response.json()
+        embedding = data["data"][0]["embedding"]
+        record_token_usage(OPENROUTER_EMBEDDING_MODEL, data.get("usage"), embedding=True)
+        
+        # Cache the result
+        await cache_embeddings([text], [embedding])
+        
+        return embedding
+        
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        logger.error("OpenRouter API timeout")
+        raise HTTPException(status_code=504, detail="Embedding API timeout")
+    except Exception as e:
+        logger.error(f"Error generating embedding: {e}")
+        raise HTTPException(status_code=500, detail=f"Embedding generation failed: {str(e)}")
+
+_token_encoder = None
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken, falling back to a character estimate"""
+    global _token_encoder
+    
+    if _token_encoder is None:
+        try:
+            _token_encoder = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"tiktoken unavailable, estimating tokens from length: {e}")
+            _token_encoder = False
+    
+    if _token_encoder:
+        return len(_token_encoder.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def pack_embedding_batches(items: List[tuple[int, str]]) -> List[List[tuple[int, str]]]:
+    """Group (position, text) pairs into request batches under item and token limits"""
+    batches = []
+    current = []
+    current_tokens = 0
+    
+    for position, text in items:
+        tokens = min(count_tokens(text), EMBEDDING_MAX_INPUT_TOKENS)
+        if current and (
+            len(current) >= EMBEDDING_BATCH_MAX_ITEMS
+            or current_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append((position, text))
+        current_tokens += tokens
+    
+    if current:
+        batches.append(current)
+    
+    return batches
+
+def retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    """Seconds to wait before retrying, honoring Retry-After when present"""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+    return min(2 ** attempt, 30) + random.uniform(0, 1)
+
+class EmbeddingInputRejected(Exception):
+    """OpenRouter refused a batch's input; unlike overload errors, splitting the batch can help"""
+
+async def embed_batch_openrouter(texts: List[str]) -> List[List[float]]:
+    """Embed a list of texts in a single /embeddings request with retries"""
+    last_error = None
+    payload = {
+        "input": texts,
+        "model": OPENROUTER_EMBEDDING_MODEL,
+        **embedding_request_options()
+    }
+    
+    for attempt in range(EMBEDDING_BATCH_MAX_RETRIES):
+        response = None
+        try:
+            # Ingestion yields slots and budget to chat and search
+            async with openrouter_admission(payload, PRIORITY_INGEST):
+                response = await openrouter_post("/embeddings", payload, timeout=OPENROUTER_EMBEDDING_TIMEOUT)
+            
+            if response.status_code == 200:
+                body = response.json()
+                record_token_usage(OPENROUTER_EMBEDDING_MODEL, body.get("usage"), embedding=True)
+                data = body["data"]
+                data.sort(key=lambda item: item["index"])
+                if len(data) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(data)}")
+                return [item["embedding"] for item in data]
+            
+            last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+            if response.status_code in (400, 413, 422):
+                raise EmbeddingInputRejected(last_error)
+            if response.status_code == 429:
+                openrouter_budget.pause(min(retry_delay(response, attempt), EMBEDDING_RETRY_MAX_DELAY))
+            if response.status_code != 429 and response.status_code < 500:
+                break
+                
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            last_error = str(e) or type(e).__name__
+        
+        if attempt == EMBEDDING_BATCH_MAX_RETRIES - 1:
+            break
+        delay = min(retry_delay(response, attempt), EMBEDDING_RETRY_MAX_DELAY)
+        logger.warning(f"Embedding batch of {len(texts)} failed ({last_error}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    
+    raise RuntimeError(f"Embedding batch failed: {last_error}")
+
+async def generate_embeddings_batch(texts: List[str]) -> List[Optional[List[float]]]:
+    """Embed many texts using bulk cache lookups and bounded concurrent batches.
+    
+    Returns one embedding per input text, or None for texts that could not be
+    embedded after retries.
+    """
+    # Bulk cache lookup so only missing chunks are sent upstream
+    results = await get_cached_embeddings(texts)
+    
+    missing = [(i, texts[i]) for i in range(len(texts)) if results[i] is None]
+    if not missing:
+        return results
+    
+    semaphore = asyncio.Semaphore(EMBEDDING_BATCH_CONCURRENCY)
+    failed = 0
+    
+    async def run_batch(batch: List[tuple[int, str]]):
+        nonlocal failed
+        try:
+            async with semaphore:
+                embeddings = await embed_batch_openrouter([text for _, text in batch])
+        except EmbeddingInputRejected as e:
+            if len(batch) > 1:
+                # Split so one bad input doesn't fail the whole batch
+                middle = len(batch) // 2
+                await asyncio.gather(run_batch(batch[:middle]), run_batch(batch[middle:]))
+            else:
+                failed += 1
+                logger.error(f"Embedding failed for chunk {batch[0][0]}: {e}")
+            return
+        except Exception as e:
+            # Overload and outages were already retried; splitting would only multiply the requests
+            failed += len(batch)
+            logger.error(f"Embedding failed for {len(batch)} chunks: {e}")
+            return
+        
+        for (position, _), embedding in zip(batch, embeddings):
+            results[position] = embedding
+        
+        await cache_embeddings([text for _, text in batch], embeddings)
+    
+    batches = pack_embedding_batches(missing)
+    await asyncio.gather(*(run_batch(batch) for batch in batches))
+    
+    logger.info(
+        f"Embedded {len(texts)} texts: {len(texts) - len(missing)} cached, "
+        f"{len(missing) - failed} generated in {len(batches)} batches, {failed} failed"
+    )
+    
+    return results
+
+CHAT_SYSTEM_PROMPTS = {
+    "es": """Eres un asistente legal experto en derecho mexicano. 
+             Usa el contexto proporcionado para responder preguntas de manera precisa y profesional.
+             Si el contexto no contiene información relevante, indícalo claramente.
+             Cita las fuentes cuando sea posible.""",
+    "en": """You are a legal assistant expert in Mexican law. 
+             Use the provided context to answer questions accurately and professionally.
+             If the context doesn't contain relevant information, clearly indicate this.
+             Cite sources when possible."""
+}
+
+def build_chat_payload(
+    query: str,
+    context: str,
+    language: str,
+    chat_model: str,
+    stream: bool = False,
+    history: Optional[List[Dict[str, str]]] = None
+) -> Dict[str, Any]:
+    """Build the OpenRouter chat completion request body; history goes before the question"""
+    payload = {
+        "model": chat_model,
+        "messages": [
+            {"role": "system", "content": CHAT_SYSTEM_PROMPTS.get(language, CHAT_SYSTEM_PROMPTS["es"])},
+            *(history or []),
+            {"role": "user", "content": f"Contexto:\n{context}\n\nPregunta: {query}"}
+        ],
+        "temperature": 0.7,
+        "max_tokens": CHAT_MAX_TOKENS,
+        "top_p": 0.9,
+        "frequency_penalty": 0.1
+    }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+async def generate_chat_response_openrouter(
+    query: str,
+    context: str,
+    language: str = "es",
+    model: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None
+) -> tuple[str, str, Optional[int]]:
+    """Generate response using OpenRouter Chat API, optionally coalescing identical requests.
+    
+    Returns the response text, the model used and the total tokens OpenRouter reported.
+    """
+    if not CHAT_COALESCING_ENABLED:
+        return await fetch_chat_response_openrouter(query, context, language, model, history)
+    
+    chat_model = model or OPENROUTER_CHAT_MODEL
+    key = hashlib.md5(f"{chat_model}|{language}|{query}|{context}|{json.dumps(history or [])}".encode()).hexdigest()
+    return await chat_flight.do(key, lambda: fetch_chat_response_openrouter(query, context, language, chat_model, history))
+
+async def fetch_chat_response_openrouter(
+    query: str,
+    context: str,
+    language: str = "es",
+    model: Optional[str] = None,
+    history: Optional[List[Dict[str, str]]] = None
+) -> tuple[str, str, Optional[int]]:
+    """Collect a complete answer from the chat model fallback chain"""
+    try:
+        result: Dict[str, Any] = {}
+        parts = [token async for token in stream_chat_with_fallback(query, context, language, model, result, history)]
+        return "".join(parts), result["model"], result.get("tokens_used")
+        
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        logger.error("OpenRouter API timeout")
+        raise HTTPException(status_code=504, detail="Chat API timeout")
+    except Exception as e:
+        logger.error(f"Error generating chat response: {e}")
+        raise HTTPException(status_code=500, detail=f"Chat generation failed: {str(e)}")
+
+async def stream_chat_response_openrouter(
+    query: str,
+    context: str,
+    language: str = "es",
+    model: Optional[str] = None,
+    usage: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None
+):
+    """Stream response tokens from OpenRouter Chat API as they are generated.
+    
+    OpenRouter reports usage in the final chunk; it is copied into usage when given.
+    """
+    chat_model = model or OPENROUTER_CHAT_MODEL
+    payload = build_chat_payload(query, context, language, chat_model, stream=True, history=history)
+    
+    # The slot is held for the whole stream
+    async with openrouter_admission(payload), openrouter_stream(
+        "/chat/completions",
+        payload,
+        timeout=OPENROUTER_CHAT_TIMEOUT
+    ) as response:
+        if response.status_code != 200:
+            body = (await response.aread()).decode(errors="replace")
+            logger.error(f"OpenRouter chat stream error: {body}")
+            if response.status_code == 429 or response.status_code >= 500:
+                if response.status_code == 429:
+                    openrouter_budget.pause(retry_delay(response, 0))
+                raise overloaded(retry_delay(response, 0), f"OpenRouter unavailable (HTTP {response.status_code}), retry later")
+            raise HTTPException(status_code=502, detail=f"Chat generation failed: {body}")
+        
+        async for line in response.aiter_lines():
+            # OpenRouter sends ": OPENROUTER PROCESSING" comments as keep-alives
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            
+            chunk = json.loads(data)
+            if chunk.get("error"):
+                raise HTTPException(status_code=502, detail=f"Chat generation failed: {chunk['error']}")
+            if chunk.get("usage"):
+                tokens_used = record_token_usage(chat_model, chunk["usage"])
+                await openrouter_budget.charge(chunk["usage"].get("completion_tokens") or 0)
+                if usage is not None:
+                    usage.update(chunk["usage"], tokens_used=tokens_used)
+            
+            choices = chunk.get("choices") or []
+            content = choices[0].get("delta", {}).get("content") if choices else None
+            if content:
+                yield content
+
+async def search_similar_documents(
+    embedding: List[float],
+    top_k: int = 5,
+    filters: Optional[Dict[str, Any]] = None
+) -> List[Dict]:
+    """Search for similar documents, coalescing identical in-flight searches"""
+    documents = await search_flight.do(
+        f"{vector_key(embedding)}:{top_k}:{json.dumps(filters, sort_keys=True, default=str)}",
+        lambda: search_vectors(embedding, top_k, filters)
+    )
+    return list(documents)
+
+async def search_vectors(embedding: List[float], top_k: int = 5, filters: Optional[Dict[str, Any]] = None) -> List[Dict]:
+    """Search Milvus, or the local vector store when configured or when Milvus is down"""
+    if VECTOR_ENGINE == "local":
+        return await search_local_vectors(embedding, top_k, filters)
+    
+    if milvus_connected:
+        try:
+            return await search_milvus(embedding, top_k, build_filter_expression(filters))
+        except Exception as e:
+            logger.error(f"Error searching documents: {e}")
+            if VECTOR_ENGINE != "auto":
+                return []
+    
+    if VECTOR_ENGINE == "auto" and local_vector_store.count:
+        logger.warning("Milvus unavailable, searching local vector store")
+        return await search_local_vectors(embedding, top_k, filters)
+    
+    logger.warning("Milvus not connected, returning empty results")
+    return []
+
+async def search_milvus(embedding: List[float], top_k: int = 5, expr: Optional[str] = None) -> List[Dict]:
+    """Search for similar documents in Milvus, filtering during the ANN search"""
+    if milvus_stores_content():
+        # Concurrent queries are micro-batched into one off-loop search
+        return await milvus_search_batcher.search(embedding, top_k, expr)
+    
+    # Quantized vectors pick a wider shortlist, ranked again at full precision
+    if milvus_quantized():
+        shortlist = await milvus_search_batcher.search(embedding, top_k * RESCORE_MULTIPLIER, expr)
+        return await attach_chunk_text(shortlist, embedding, top_k, with_vectors=RERANK_ENABLED)
+    return await attach_chunk_text(await milvus_search_batcher.search(embedding, top_k, expr), with_vectors=RERANK_ENABLED)
+
+# ==================== Chat Model Fallback ====================
+
+class CircuitBreaker:
+    """Error and latency breaker for one chat model over its last CIRCUIT_WINDOW calls.
+    
+    Errors, and first tokens slower than CIRCUIT_SLOW_CALL_MS, count as failures.
+    Once CIRCUIT_ERROR_THRESHOLD of the window fails the model is skipped for
+    CIRCUIT_OPEN_SECONDS, then a single trial call decides whether it closes again.
+    """
+    
+    def __init__(self, model: str):
+        self.model = model
+        self.outcomes: deque = deque(maxlen=CIRCUIT_WINDOW)
+        self.first_token_seconds: deque = deque(maxlen=100)
+        self.opened_at: Optional[float] = None
+        self.trial_started: Optional[float] = None
+    
+    def is_open(self) -> bool:
+        """True while calls should skip this model"""
+        if self.opened_at is None:
+            return False
+        now = time.monotonic()
+        if now - self.opened_at < CIRCUIT_OPEN_SECONDS:
+            return True
+        # Half-open: one trial at a time, and a trial that never reported back expires
+        return self.trial_started is not None and now - self.trial_started < CIRCUIT_OPEN_SECONDS
+    
+    def allow(self) -> bool:
+        """Claim a call; in the half-open state only the trial call is allowed"""
+        if self.is_open():
+            return False
+        if self.opened_at is not None:
+            self.trial_started = time.monotonic()
+        return True
+    
+    def record_first_token(self, seconds: float):
+        self.first_token_seconds.append(seconds)
+    
+    def record_success(self, first_token_seconds: Optional[float]):
+        if first_token_seconds is not None and first_token_seconds * 1000 > CIRCUIT_SLOW_CALL_MS:
+            self.record_failure()
+            return
+        self.outcomes.append(True)
+        if self.opened_at is not None:
+            logger.info(f"Circuit for chat model {self.model} closed")
+            self.opened_at = None
+            self.trial_started = None
+            self.outcomes.clear()
+            CIRCUIT_OPEN.labels(self.model).set(0)
+    
+    def record_failure(self):
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if self.opened_at is not None:
+            if self.trial_started is not None:
+                # The trial failed
+                self.opened_at = time.monotonic()
+                self.trial_started = None
+            return
+        if len(self.outcomes) >= CIRCUIT_MIN_CALLS and failures / len(self.outcomes) >= CIRCUIT_ERROR_THRESHOLD:
+            logger.warning(
+                f"Circuit for chat model {self.model} opened: {failures} of the last {len(self.outcomes)} calls failed"
+            )
+            self.opened_at = time.monotonic()
+            CIRCUIT_OPEN.labels(self.model).set(1)
+    
+    def hedge_delay(self) -> float:
+        """Seconds to wait for a first token before hedging: this model's recent p95"""
+        if len(self.first_token_seconds) < CIRCUIT_MIN_CALLS:
+            delay = CHAT_HEDGE_DELAY_MS / 1000
+        else:
+            delay = float(np.percentile(self.first_token_seconds, 95))
+        return min(max(delay, CHAT_HEDGE_MIN_DELAY_MS / 1000), CHAT_FIRST_TOKEN_TIMEOUT)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        state = "closed" if self.opened_at is None else "open" if self.is_open() else "half_open"
+        return {
+            "state": state,
+            "calls": len(self.outcomes),
+            "failures": self.outcomes.count(False),
+            "hedge_delay_ms": round(self.hedge_delay() * 1000)
+        }
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def circuit_breaker(model: str) -> CircuitBreaker:
+    if model not in circuit_breakers:
+        circuit_breakers[model] = CircuitBreaker(model)
+    return circuit_breakers[model]
+
+def chat_model_chain(model: Optional[str] = None) -> List[str]:
+    """The requested model then the fallbacks, without models whose circuit is open"""
+    chain = list(dict.fromkeys([model or OPENROUTER_CHAT_MODEL] + CHAT_FALLBACK_MODELS))
+    available = [candidate for candidate in chain if not circuit_breaker(candidate).is_open()]
+    # With every circuit open, trying the requested model beats failing outright
+    return available or chain[:1]
+
+class ChatAttempt:
+    """One streamed completion from one model, read by a task so attempts can race"""
+    
+    def __init__(
+        self,
+        model: str,
+        query: str,
+        context: str,
+        language: str,
+        history: Optional[List[Dict[str, str]]] = None
+    ):
+        self.model = model
+        self.usage: Dict[str, Any] = {}
+        self.started = time.perf_counter()
+        self.first_token_seconds: Optional[float] = None
+        self.first = asyncio.get_running_loop().create_future()
+        self.tokens: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run(query, context, language, history))
+    
+    async def run(self, query: str, context: str, language: str, history: Optional[List[Dict[str, str]]]):
+        try:
+            async for token in stream_chat_response_openrouter(query, context, language, self.model, self.usage, history):
+                if not self.first.done():
+                    self.first_token_seconds = time.perf_counter() - self.started
+                    self.first.set_result(None)
+                self.tokens.put_nowait(token)
+            if not self.first.done():
+                self.first.set_result(None)
+            self.tokens.put_nowait(None)
+        except Exception as e:
+            if not self.first.done():
+                self.first.set_exception(e)
+            else:
+                self.tokens.put_nowait(e)
+    
+    async def stream(self):
+        while True:
+            item = await self.tokens.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def cancel(self):
+        """Stop the attempt, closing its upstream stream and admission slot"""
+        self.task.cancel()
+        if not self.first.done():
+            self.first.cancel()
+        elif not self.first.cancelled():
+            self.first.exception()
+
+async def stream_chat_with_fallback(
+    query: str,
+    context: str,
+    language: str = "es",
+    model: Optional[str] = None,
+    result: Optional[Dict[str, Any]] = None,
+    history: Optional[List[Dict[str, str]]] = None
+):
+    """Stream the answer of the first model in the fallback chain that starts answering.
+    
+    Each model gets CHAT_FIRST_TOKEN_TIMEOUT to produce a first token before the
+    next one is tried. With hedging, the next model is also started once the
+    current one passes its p95 time to first token, and the slower one is cancelled.
+    The model used and the tokens it reported are copied into result.
+    """
+    result = result if result is not None else {}
+    chain = chat_model_chain(model)
+    position = 0
+    running: List[ChatAttempt] = []
+    errors: List[str] = []
+    overloaded_only = True
+    winner: Optional[ChatAttempt] = None
+    
+    def launch() -> bool:
+        nonlocal position
+        while position < len(chain):
+            candidate = chain[position]
+            position += 1
+            if circuit_breaker(candidate).allow():
+                if errors or running:
+                    logger.info(f"Trying chat model {candidate} after {', '.join(errors) or 'a slow first token'}")
+                running.append(ChatAttempt(candidate, query, context, language, history))
+                return True
+        return False
+    
+    def fail(attempt: ChatAttempt, error: BaseException, outcome: str):
+        nonlocal overloaded_only
+        overloaded_only = overloaded_only and isinstance(error, HTTPException) and error.status_code == 503
+        reason = error.detail if isinstance(error, HTTPException) else str(error) or type(error).__name__
+        circuit_breaker(attempt.model).record_failure()
+        CHAT_ATTEMPTS.labels(attempt.model, outcome).inc()
+        errors.append(f"{attempt.model}: {reason}")
+        logger.warning(f"Chat model {attempt.model} failed: {reason}")
+    
+    try:
+        if not launch():
+            # Another request holds every trial slot; go ahead with the requested model
+            running.append(ChatAttempt(chain[0], query, context, language, history))
+        
+        while winner is None and (running or launch()):
+            hedge = CHAT_HEDGING_ENABLED and len(running) == 1 and position < len(chain)
+            now = time.perf_counter()
+            timeout = min(attempt.started + CHAT_FIRST_TOKEN_TIMEOUT for attempt in running) - now
+            if hedge:
+                timeout = min(timeout, running[0].started + circuit_breaker(running[0].model).hedge_delay() - now)
+            done, _ = await asyncio.wait(
+                [attempt.first for attempt in running],
+                timeout=max(timeout, 0.0),
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            
+            for attempt in [attempt for attempt in running if attempt.first.done()]:
+                running.remove(attempt)
+                error = attempt.first.exception()
+                if error is None:
+                    winner = attempt
+                    break
+                if isinstance(error, AdmissionRejected):
+                    # Our own overload, not the model's; another model would fare no better
+                    raise error
+                fail(attempt, error, "error")
+            if done:
+                continue
+            
+            now = time.perf_counter()
+            expired = [attempt for attempt in running if now - attempt.started >= CHAT_FIRST_TOKEN_TIMEOUT]
+            for attempt in expired:
+                running.remove(attempt)
+                attempt.cancel()
+                fail(attempt, asyncio.TimeoutError(f"no first token within {CHAT_FIRST_TOKEN_TIMEOUT:g}s"), "timeout")
+            if not expired and hedge and launch():
+                CHAT_HEDGES.inc()
+        
+        if winner is None:
+            detail = f"Chat generation failed: {'; '.join(errors) or 'no model available'}"
+            if errors and overloaded_only:
+                raise overloaded(1, detail)
+            raise HTTPException(status_code=502, detail=detail)
+        for attempt in running:
+            attempt.cancel()
+            if attempt.started < winner.started:
+                # Beaten by a model started after it: slow enough to count against its breaker
+                circuit_breaker(attempt.model).record_failure()
+                CHAT_ATTEMPTS.labels(attempt.model, "outrun").inc()
+            else:
+                CHAT_ATTEMPTS.labels(attempt.model, "cancelled").inc()
+        running.clear()
+        
+        breaker = circuit_breaker(winner.model)
+        if winner.first_token_seconds is not None:
+            breaker.record_first_token(winner.first_token_seconds)
+        result["model"] = winner.model
+        try:
+            async for token in winner.stream():
+                yield token
+        except Exception as e:
+            # Tokens were already sent, so there is no falling back mid-answer
+            fail(winner, e, "error")
+            raise
+        breaker.record_success(winner.first_token_seconds)
+        CHAT_ATTEMPTS.labels(winner.model, "success").inc()
+        result["tokens_used"] = winner.usage.get("tokens_used")
+    finally:
+        for attempt in running + ([winner] if winner else []):
+            attempt.cancel()
+
+# ==================== Local Vector Store ====================
+
+class LocalVectorStore:
+    """Embedded vector index that needs no server: a memory-mapped float32
+    matrix plus an append-only JSON-lines metadata sidecar.
+    
+    Search is exact top-k (one matrix-vector product and argpartition), with
+    an optional IVF layer of k-means centroids once the store grows past
+    LOCAL_VECTOR_IVF_THRESHOLD rows; the layer is built on a background thread
+    and swapped in when ready. Filters are evaluated over metadata columns kept
+    as arrays. Scores are squared L2 distances so results
+    are interchangeable with Milvus hits. Appends take a file lock, and other
+    processes pick up new rows by tailing the sidecar.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.sidecar_path = os.path.join(directory, "metadata.jsonl")
+        self.lock_path = os.path.join(directory, ".lock")
+        self.lock = threading.RLock()
+        self.dim: Optional[int] = None
+        self.capacity = 0
+        self.matrix: Optional[np.memmap] = None
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.rows: List[Dict[str, Any]] = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.positions: Dict[int, int] = {}
+        self.sidecar_offset = 0
+        self.next_id = 1
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self.ivf_rows = 0
+        self.ivf_building = False
+        self.columns: Dict[str, np.ndarray] = {}
+        self.column_rows = 0
+    
+    @property
+    def count(self) -> int:
+        return len(self.rows)
+    
+    @property
+    def live_count(self) -> int:
+        return int(self.alive[:self.count].sum())
+    
+    def _open_matrix(self, capacity: int):
+        mode = "r+" if os.path.exists(self.vectors_path) else "w+"
+        if mode == "r+" and os.path.getsize(self.vectors_path) < capacity * self.dim * 4:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(capacity * self.dim * 4)
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(capacity, self.dim))
+        self.capacity = capacity
+        if len(self.alive) < capacity:
+            self.alive = np.concatenate([self.alive, np.zeros(capacity - len(self.alive), dtype=bool)])
+            self.norms = np.concatenate([self.norms, np.zeros(capacity - len(self.norms), dtype=np.float32)])
+    
+    def refresh(self):
+        """Read sidecar records appended since the last refresh (possibly by another process)"""
+        with self.lock:
+            if not os.path.exists(self.sidecar_path) or os.path.getsize(self.sidecar_path) == self.sidecar_offset:
+                return
+            
+            with open(self.sidecar_path, "rb") as f:
+                f.seek(self.sidecar_offset)
+                data = f.read()
+            # Only consume complete lines; a writer may be mid-append
+            complete = data[:data.rfind(b"\n") + 1]
+            self.sidecar_offset += len(complete)
+            
+            new_rows = []
+            for line in complete.splitlines():
+                record = json.loads(line)
+                if record.get("op") == "delete":
+                    for row_id in record["ids"]:
+                        position = self.positions.pop(int(row_id), None)
+                        if position is not None:
+                            self.alive[position] = False
+                    continue
+                if record.get("op") == "init":
+                    self.dim = record["dim"]
+                    continue
+                new_rows.append(record)
+            
+            if not new_rows:
+                return
+            
+            needed = self.count + len(new_rows)
+            if self.matrix is None or needed > self.capacity:
+                self._open_matrix(max(needed, os.path.getsize(self.vectors_path) // (self.dim * 4)))
+            
+            start = self.count
+            for offset, record in enumerate(new_rows):
+                position = start + offset
+                self.rows.append(record)
+                self.positions[int(record["id"])] = position
+                self.alive[position] = True
+                self.next_id = max(self.next_id, int(record["id"]) + 1)
+            end = start + len(new_rows)
+            self.norms[start:end] = np.einsum("ij,ij->i", self.matrix[start:end], self.matrix[start:end])
+    
+    def add(self, embeddings: List[List[float]], documents: List[Dict[str, Any]], ids: Optional[List[int]] = None) -> List[int]:
+        """Append vectors and their metadata; returns the row ids"""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        os.makedirs(self.directory, exist_ok=True)
+        
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    with open(self.sidecar_path, "a") as f:
+                        f.write(json.dumps({"op": "init", "dim": self.dim}) + "\n")
+                if vectors.shape[1] != self.dim:
+                    raise ValueError(f"Vector dimension {vectors.shape[1]} does not match store dimension {self.dim}")
+                
+                if ids is None:
+                    ids = list(range(self.next_id, self.next_id + len(vectors)))
+                
+                needed = self.count + len(vectors)
+                if self.matrix is None or needed > self.capacity:
+                    self._open_matrix(max(needed, self.capacity * 2, 1024))
+                
+                # Vectors are flushed before the sidecar, which defines the row count
+                self.matrix[self.count:needed] = vectors
+                self.matrix.flush()
+                with open(self.sidecar_path, "a", encoding="utf-8") as f:
+                    for row_id, document in zip(ids, documents):
+                        f.write(json.dumps(dict(document, id=int(row_id)), ensure_ascii=False) + "\n")
+                self.refresh()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        
+        return [int(row_id) for row_id in ids]
+    
+    def delete(self, ids: List[int]):
+        """Tombstone rows so they are skipped by searches"""
+        if not ids:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.sidecar_path, "a") as f:
+                    f.write(json.dumps({"op": "delete", "ids": [int(row_id) for row_id in ids]}) + "\n")
+                self.refresh()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def get(self, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """Look up live rows by id"""
+        self.refresh()
+        return {
+            int(row_id): self.rows[self.positions[int(row_id)]]
+            for row_id in ids if int(row_id) in self.positions
+        }
+    
+    def build_ivf(self, nlist: int, iterations: int = 10):
+        """Cluster the live vectors with k-means so searches only scan the nearest lists.
+        
+        Stored vectors never change, so the clustering runs on a snapshot without
+        the lock; the finished layer is swapped in at once. Rows appended in the
+        meantime are scanned exactly until the next build.
+        """
+        with self.lock:
+            n = self.count
+            matrix = self.matrix
+            live = np.flatnonzero(self.alive[:n])
+        if len(live) < nlist * 4:
+            return
+        
+        rng = np.random.default_rng(0)
+        sample = np.asarray(matrix[np.sort(rng.choice(live, size=min(len(live), nlist * 256), replace=False))])
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = self._nearest_centroids(sample, centroids, 1)[:, 0]
+            for c in range(nlist):
+                members = sample[labels == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        
+        assignments = np.full(n, -1, dtype=np.int32)
+        for start in range(0, n, 65536):
+            block = np.arange(start, min(start + 65536, n))
+            assignments[block] = self._nearest_centroids(matrix[block], centroids, 1)[:, 0]
+        
+        with self.lock:
+            self.centroids = centroids
+            self.assignments = assignments
+            self.ivf_rows = n
+        logger.info(f"Built local IVF index: {nlist} lists over {len(live)} vectors")
+    
+    def start_ivf_build(self, nlist: int) -> bool:
+        """Build the IVF layer on a background thread; until it is ready searches keep the current layout"""
+        with self.lock:
+            if self.ivf_building:
+                return False
+            self.ivf_building = True
+        
+        def run():
+            try:
+                self.build_ivf(nlist)
+            except Exception as e:
+                logger.error(f"Error building local IVF index: {e}")
+            finally:
+                self.ivf_building = False
+        
+        threading.Thread(target=run, name="local-ivf", daemon=True).start()
+        return True
+    
+    @staticmethod
+    def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, n: int) -> np.ndarray:
+        distances = (
+            np.einsum("ij,ij->i", centroids, centroids)[None, :]
+            - 2.0 * (vectors @ centroids.T)
+        )
+        if n >= centroids.shape[0]:
+            return np.argsort(distances, axis=1)
+        nearest = np.argpartition(distances, n, axis=1)[:, :n]
+        return np.take_along_axis(nearest, np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1), axis=1)
+    
+    def search(self, embedding: List[float], top_k: int, mask: Optional[np.ndarray] = None, nprobe: Optional[int] = None) -> List[tuple[int, float]]:
+        """Return (row_id, squared L2 distance) pairs, nearest first"""
+        self.refresh()
+        with self.lock:
+            n = self.count
+            if n == 0:
+                return []
+            query = np.asarray(embedding, dtype=np.float32)
+            if mask is not None and len(mask) < n:
+                # Rows appended after the mask was computed have not been checked against the filters
+                mask = np.concatenate([mask, np.zeros(n - len(mask), dtype=bool)])
+            allowed = self.alive[:n] if mask is None else self.alive[:n] & mask[:n]
+            
+            if self.centroids is not None and nprobe:
+                lists = self._nearest_centroids(query[None, :], self.centroids, nprobe)[0]
+                # Rows appended after the IVF build are always scanned exactly
+                in_lists = np.zeros(n, dtype=bool)
+                in_lists[:self.ivf_rows] = np.isin(self.assignments[:self.ivf_rows], lists)
+                in_lists[self.ivf_rows:] = True
+                candidates = np.flatnonzero(allowed & in_lists)
+            else:
+                candidates = np.flatnonzero(allowed) if mask is not None or not allowed.all() else None
+            
+            if candidates is None:
+                distances = self.norms[:n] - 2.0 * (self.matrix[:n] @ query)
+                positions = np.arange(n)
+            else:
+                if len(candidates) == 0:
+                    return []
+                distances = self.norms[candidates] - 2.0 * (self.matrix[candidates] @ query)
+                positions = candidates
+            distances = distances + float(query @ query)
+            
+            if len(distances) > top_k:
+                best = np.argpartition(distances, top_k)[:top_k]
+            else:
+                best = np.arange(len(distances))
+            best = best[np.argsort(distances[best])]
+            return [(int(self.rows[positions[i]]["id"]), float(distances[i])) for i in best]
+    
+    def metadata_columns(self) -> Dict[str, np.ndarray]:
+        """Filterable fields as one array per field, extended as rows are appended"""
+        with self.lock:
+            if self.columns and self.column_rows == self.count:
+                return self.columns
+            
+            rows = self.rows[self.column_rows:self.count]
+            metadata = [row.get("metadata") or {} for row in rows]
+            added = {
+                "document_date": np.array([int(fields.get("document_date") or 0) for fields in metadata], dtype=np.int64),
+                "title": np.array([str(row.get("title") or "") for row in rows], dtype=str)
+            }
+            for key in MILVUS_FILTER_FIELDS:
+                column = np.empty(len(rows), dtype=object)
+                column[:] = [row.get(key, fields.get(key)) for row, fields in zip(rows, metadata)]
+                added[key] = column
+            self.columns = {
+                key: np.concatenate([self.columns[key], column]) if key in self.columns else column
+                for key, column in added.items()
+            }
+            self.column_rows = self.count
+            return self.columns
+    
+    def filter_mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Evaluate SearchRequest.filters against the sidecar metadata"""
+        if not filters:
+            return None
+        
+        columns = self.metadata_columns()
+        mask = np.ones(len(columns["title"]), dtype=bool)
+        for key, value in filters.items():
+            if value is None or value == []:
+                continue
+            if key == "date_from":
+                mask &= columns["document_date"] >= parse_document_date(value)
+            elif key == "date_to":
+                mask &= columns["document_date"] <= parse_document_date(value)
+            elif key == "title":
+                mask &= np.char.startswith(columns["title"], str(value))
+            elif key in MILVUS_FILTER_FIELDS:
+                matches = np.zeros(len(mask), dtype=bool)
+                for item in (value if isinstance(value, list) else [value]):
+                    matches |= columns[key] == item
+                mask &= matches
+        return mask
+
+local_vector_store = LocalVectorStore(LOCAL_VECTOR_DIR)
+
+def local_vector_store_enabled() -> bool:
+    return VECTOR_ENGINE in ("local", "auto")
+
+def local_row_to_document(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": int(row["id"]),
+        "content": row.get("content"),
+        "title": row.get("title"),
+        "source": row.get("source"),
+        "chunk_index": row.get("chunk_index"),
+        "metadata": dict(row.get("metadata") or {}, doc_id=row.get("doc_id"))
+    }
+
+def local_vector_score(store: LocalVectorStore, embedding: List[float], row_id: int, distance: float) -> float:
+    """Express a squared L2 distance in the Milvus metric, so scores agree across engines.
+    
+    Ranking by L2 matches IP and COSINE for the unit-length vectors embedding models return.
+    """
+    metric = vector_metric()
+    if metric == "L2":
+        return distance
+    query_norm = float(np.dot(embedding, embedding))
+    row_norm = float(store.norms[store.positions[row_id]])
+    inner_product = (query_norm + row_norm - distance) / 2.0
+    if metric == "IP":
+        return inner_product
+    return float(inner_product / max(np.sqrt(query_norm * row_norm), 1e-12))
+
+async def search_local_vectors(embedding: List[float], top_k: int, filters: Optional[Dict[str, Any]] = None) -> List[Dict]:
+    """Search the embedded vector store off the event loop"""
+    def run():
+        store = local_vector_store
+        store.refresh()
+        if LOCAL_VECTOR_IVF_THRESHOLD and store.live_count >= LOCAL_VECTOR_IVF_THRESHOLD and store.count >= 2 * max(store.ivf_rows, 1):
+            store.start_ivf_build(LOCAL_VECTOR_IVF_NLIST)
+        hits = store.search(embedding, top_k, store.filter_mask(filters), nprobe=LOCAL_VECTOR_IVF_NPROBE)
+        rows = store.get([row_id for row_id, _ in hits])
+        documents = [
+            dict(local_row_to_document(rows[row_id]), score=local_vector_score(store, embedding, row_id, distance))
+            for row_id, distance in hits if row_id in rows
+        ]
+        if RERANK_ENABLED:
+            with store.lock:
+                for doc in documents:
+                    doc["embedding"] = np.array(store.matrix[store.positions[doc["id"]]])
+        return documents
+    
+    return await asyncio.get_running_loop().run_in_executor(None, run)
+
+async def add_local_vectors(
+    embeddings: List[List[float]],
+    documents: List[Dict[str, Any]],
+    ids: Optional[List[int]] = None
+) -> List[int]:
+    """Append chunks to the embedded vector store off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, local_vector_store.add, embeddings, documents, ids
+    )
+
+async def load_local_vector_store():
+    """Load the embedded vector store sidecar at startup"""
+    if not local_vector_store_enabled():
+        return
+    
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, local_vector_store.refresh)
+        logger.info(f"Local vector store ready: {local_vector_store.live_count} vectors ({VECTOR_ENGINE} mode)")
+    except Exception as e:
+        logger.error(f"Error loading local vector store: {e}")
+
+# ==================== Chunk Store ====================
+
+class ChunkStore:
+    """Chunk text and full-precision vectors kept outside the in-memory Milvus collection.
+    
+    A SQLite file keyed by Milvus primary key, shared by the API and ingestion
+    workers through the cache volume (WAL mode, so readers never wait on a
+    writer). Searches fetch the text of their hits from here, and quantized
+    collections re-score their shortlist with the stored float32 vectors.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+    
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections belong to the thread that opened them
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, content TEXT NOT NULL, embedding BLOB)")
+            self.local.connection = connection
+        return connection
+    
+    def put(self, ids: List[int], contents: List[str], embeddings: List[Any]):
+        rows = [
+            (int(row_id), content, np.asarray(embedding, dtype=np.float32).tobytes())
+            for row_id, content, embedding in zip(ids, contents, embeddings)
+        ]
+        with self.connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO chunks (id, content, embedding) VALUES (?, ?, ?)", rows)
+    
+    def get(self, ids: List[int], vectors: bool = False) -> Dict[int, Dict[str, Any]]:
+        """Rows by id; with vectors, each row also carries its float32 embedding"""
+        columns = "id, content, embedding" if vectors else "id, content"
+        found = {}
+        ids = [int(row_id) for row_id in ids]
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            cursor = self.connection().execute(
+                f"SELECT {columns} FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch
+            )
+            for row in cursor:
+                found[row[0]] = {"content": row[1]}
+                if vectors:
+                    found[row[0]]["embedding"] = np.frombuffer(row[2], dtype=np.float32)
+        return found
+    
+    def delete(self, ids: List[int]):
+        ids = [int(row_id) for row_id in ids]
+        with self.connection() as connection:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                connection.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+    
+    def count(self) -> int:
+        return self.connection().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    
+    def max_id(self) -> int:
+        return self.connection().execute("SELECT COALESCE(MAX(id), 0) FROM chunks").fetchone()[0]
+
+chunk_store = ChunkStore(CHUNK_STORE_PATH)
+
+def full_precision_scores(query: np.ndarray, vectors: np.ndarray, metric: str) -> np.ndarray:
+    """Scores in the given Milvus metric; L2 is a squared distance, lower is nearer"""
+    products = vectors @ query
+    if metric == "L2":
+        return (vectors * vectors).sum(axis=1) - 2.0 * products + float(query @ query)
+    if metric == "IP":
+        return products
+    return products / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(query), 1e-12)
+
+async def attach_chunk_text(
+    documents: List[Dict],
+    embedding: Optional[List[float]] = None,
+    top_k: Optional[int] = None,
+    with_vectors: bool = False
+) -> List[Dict]:
+    """Fill in content from the chunk store for collections that do not hold it.
+    
+    Given the query embedding, the (over-fetched) hits are also re-scored with
+    full-precision vectors and cut to top_k. with_vectors keeps those vectors
+    on the hits for reranking.
+    """
+    if not documents:
+        return documents
+    
+    rows = await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(chunk_store.get, [doc["id"] for doc in documents], vectors=embedding is not None or with_vectors)
+    )
+    missing = [doc["id"] for doc in documents if doc["id"] not in rows]
+    if missing:
+        logger.warning(f"{len(missing)} chunks missing from the chunk store: {missing[:5]}")
+    documents = [
+        dict(
+            doc,
+            content=rows[doc["id"]]["content"],
+            **({"embedding": rows[doc["id"]]["embedding"]} if with_vectors else {})
+        )
+        for doc in documents if doc["id"] in rows
+    ]
+    
+    if embedding is not None and documents:
+        metric = vector_metric()
+        # Shortest common prefix, in case a re-index to fewer dimensions is rewriting the store
+        vectors = [rows[doc["id"]]["embedding"] for doc in documents]
+        dim = min(len(embedding), min(len(vector) for vector in vectors))
+        query = fit_dimensions(np.asarray(embedding, dtype=np.float32), dim)
+        scores = full_precision_scores(query, np.stack([fit_dimensions(vector, dim) for vector in vectors]), metric)
+        order = np.argsort(scores if metric == "L2" else -scores)[:top_k]
+        documents = [dict(documents[i], score=float(scores[i])) for i in order]
+    
+    return documents
+
+# ==================== Lexical Retrieval ====================
+
+LEXICAL_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+LEXICAL_STOPWORDS = frozenset(
+    "a al con de del el en es la las lo los o para por que se su sus un una y "
+    "the of and or to in is for on by with as an be this that".split()
+)
+
+def lexical_tokens(text: str) -> List[str]:
+    """Lowercase, strip accents and split text into index terms"""
+    normalized = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode()
+    return [token for token in LEXICAL_TOKEN_PATTERN.findall(normalized) if token not in LEXICAL_STOPWORDS]
+
+class LexicalIndex:
+    """Incremental in-memory BM25 inverted index over chunk contents.
+    
+    Postings are append-only typed arrays (internal doc number, term frequency)
+    read as zero-copy NumPy views, so scoring a query is a handful of vectorized
+    operations over the matching postings. Documents are identified by their
+    Milvus primary key; removed documents are masked out rather than rewritten.
+    """
+    
+    k1 = 1.2
+    b = 0.75
+    # Last LEXICAL_UPDATES_STREAM entry applied; a class default so older snapshots load
+    stream_id: Optional[str] = None
+    
+    def __init__(self):
+        self.postings: Dict[str, tuple[array, array]] = {}
+        self.milvus_ids = array("q")
+        self.lengths = array("f")
+        self.alive = bytearray()
+        self.sources: List[str] = []
+        self.positions: Dict[int, int] = {}
+        self.total_length = 0.0
+        self.live_docs = 0
+    
+    def add(self, milvus_id: int, text: str, source: str):
+        """Index one chunk"""
+        if milvus_id in self.positions:
+            self.remove([milvus_id])
+        
+        tokens = lexical_tokens(text)
+        doc = len(self.milvus_ids)
+        self.milvus_ids.append(milvus_id)
+        self.lengths.append(float(len(tokens)))
+        self.alive.append(1)
+        self.sources.append(source)
+        self.positions[milvus_id] = doc
+        self.total_length += len(tokens)
+        self.live_docs += 1
+        
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = (array("i"), array("f"))
+            posting[0].append(doc)
+            posting[1].append(float(count))
+    
+    def remove(self, milvus_ids: List[int]) -> int:
+        """Mask chunks out of future results"""
+        removed = 0
+        for milvus_id in milvus_ids:
+            doc = self.positions.pop(milvus_id, None)
+            if doc is None or not self.alive[doc]:
+                continue
+            self.alive[doc] = 0
+            self.total_length -= self.lengths[doc]
+            self.live_docs -= 1
+            removed += 1
+        return removed
+    
+    def search(self, query: str, top_k: int) -> List[tuple[int, float]]:
+        """Return (milvus_id, bm25_score) pairs for the best matching chunks"""
+        if not self.live_docs:
+            return []
+        
+        lengths = np.frombuffer(self.lengths, dtype=np.float32)
+        average_length = max(self.total_length / self.live_docs, 1.0)
+        doc_parts = []
+        score_parts = []
+        
+        for term in set(lexical_tokens(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            docs = np.frombuffer(posting[0], dtype=np.int32)
+            frequencies = np.frombuffer(posting[1], dtype=np.float32)
+            df = len(docs)
+            idf = np.log(1.0 + (self.live_docs - df + 0.5) / (df + 0.5))
+            norm = frequencies + self.k1 * (1.0 - self.b + self.b * lengths[docs] / average_length)
+            doc_parts.append(docs)
+            score_parts.append(idf * frequencies * (self.k1 + 1.0) / norm)
+        
+        if not doc_parts:
+            return []
+        
+        docs = np.concatenate(doc_parts)
+        scores = np.concatenate(score_parts)
+        alive = np.frombuffer(self.alive, dtype=np.uint8)
+        
+        # Dense accumulation is cheaper once postings cover a large part of the corpus
+        if len(docs) * 8 > len(lengths):
+            totals = np.bincount(docs, weights=scores, minlength=len(lengths)) * alive
+            candidates = np.flatnonzero(totals)
+            totals = totals[candidates]
+        else:
+            candidates, inverse = np.unique(docs, return_inverse=True)
+            totals = np.bincount(inverse, weights=scores) * alive[candidates]
+        
+        if len(candidates) > top_k:
+            best = np.argpartition(-totals, top_k)[:top_k]
+            candidates, totals = candidates[best], totals[best]
+        order = np.argsort(-totals)
+        
+        milvus_ids = np.frombuffer(self.milvus_ids, dtype=np.int64)
+        return [
+            (int(milvus_ids[candidates[i]]), float(totals[i]))
+            for i in order if totals[i] > 0
+        ]
+    
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if key != "positions"}
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.positions = {
+            int(milvus_id): doc
+            for doc, milvus_id in enumerate(self.milvus_ids) if self.alive[doc]
+        }
+
+lexical_index = LexicalIndex()
+lexical_index_lock = asyncio.Lock()
+lexical_state = {"loaded_mtime": 0.0, "checked": 0.0, "saved": 0.0, "dirty": False, "publish": False}
+
+def read_lexical_snapshot(path: str) -> LexicalIndex:
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def write_lexical_snapshot(index: LexicalIndex, path: str):
+    # Write to a temporary file first so readers never see a partial snapshot
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, path)
+
+async def load_lexical_index():
+    """Load the persisted lexical index if one exists"""
+    global lexical_index
+    
+    if not LEXICAL_INDEX_ENABLED or not os.path.exists(LEXICAL_INDEX_PATH):
+        return
+    
+    try:
+        async with lexical_index_lock:
+            mtime = os.path.getmtime(LEXICAL_INDEX_PATH)
+            lexical_index = await asyncio.get_running_loop().run_in_executor(
+                None, read_lexical_snapshot, LEXICAL_INDEX_PATH
+            )
+            lexical_state["loaded_mtime"] = mtime
+        logger.info(f"Loaded lexical index: {lexical_index.live_docs} chunks, {len(lexical_index.postings)} terms")
+    except Exception as e:
+        logger.error(f"Error loading lexical index: {e}")
+
+async def save_lexical_index(force: bool = False):
+    """Persist the lexical index, at most once per snapshot interval unless forced"""
+    if not LEXICAL_INDEX_ENABLED or not lexical_state["dirty"]:
+        return
+    if not force and time.time() - lexical_state["saved"] < LEXICAL_SNAPSHOT_INTERVAL:
+        return
+    
+    try:
+        async with lexical_index_lock:
+            os.makedirs(os.path.dirname(LEXICAL_INDEX_PATH) or ".", exist_ok=True)
+            await asyncio.get_running_loop().run_in_executor(
+                None, write_lexical_snapshot, lexical_index, LEXICAL_INDEX_PATH
+            )
+            lexical_state["saved"] = time.time()
+            lexical_state["loaded_mtime"] = os.path.getmtime(LEXICAL_INDEX_PATH)
+            lexical_state["dirty"] = False
+    except Exception as e:
+        logger.error(f"Error saving lexical index: {e}")
+
+async def refresh_lexical_index():
+    """Pick up snapshots written by other worker processes"""
+    now = time.time()
+    if now - lexical_state["checked"] < 5 or lexical_state["dirty"]:
+        return
+    lexical_state["checked"] = now
+    
+    try:
+        if os.path.getmtime(LEXICAL_INDEX_PATH) > lexical_state["loaded_mtime"]:
+            await load_lexical_index()
+    except OSError:
+        pass
+
+async def index_lexical_chunks(milvus_ids: List[int], contents: List[str], sources: List[str]):
+    """Add freshly inserted chunks to the lexical index"""
+    if not LEXICAL_INDEX_ENABLED:
+        return
+    
+    if lexical_state["publish"]:
+        # Every API process applies it from the updates stream
+        await publish_lexical_update("add", milvus_ids)
+        return
+    
+    async with lexical_index_lock:
+        for milvus_id, content, source in zip(milvus_ids, contents, sources):
+            lexical_index.add(int(milvus_id), content, source)
+        lexical_state["dirty"] = True
+    
+    await save_lexical_index()
+
+async def publish_lexical_update(op: str, milvus_ids: List[int]):
+    """Share an index change with every API process through a Redis stream"""
+    try:
+        await redis_client.xadd(
+            LEXICAL_UPDATES_STREAM,
+            {"op": op, "ids": json.dumps([int(milvus_id) for milvus_id in milvus_ids])},
+            maxlen=LEXICAL_UPDATES_MAXLEN,
+            approximate=True
+        )
+    except Exception as e:
+        logger.error(f"Error publishing lexical {op} of {len(milvus_ids)} chunks: {e}")
+
+async def apply_lexical_updates(entries: List[tuple[bytes, Dict[bytes, bytes]]]):
+    """Apply published adds and removes to this process's index"""
+    if local_vector_store_enabled():
+        # Chunks written by another process only become visible after a refresh
+        await asyncio.get_running_loop().run_in_executor(None, local_vector_store.refresh)
+    
+    for entry_id, fields in entries:
+        milvus_ids = json.loads(fields[b"ids"])
+        if fields[b"op"] == b"add":
+            # Strong consistency so chunks inserted moments ago are visible
+            chunks = await fetch_chunks_by_ids(milvus_ids, consistency_level="Strong")
+            async with lexical_index_lock:
+                for milvus_id, chunk in chunks.items():
+                    lexical_index.add(milvus_id, chunk["content"] or "", chunk["source"] or "")
+        else:
+            async with lexical_index_lock:
+                lexical_index.remove(milvus_ids)
+        
+        lexical_index.stream_id = entry_id.decode()
+        lexical_state["dirty"] = True
+
+async def follow_lexical_updates():
+    """Tail LEXICAL_UPDATES_STREAM for changes made by ingestion workers and other API processes"""
+    if lexical_index.stream_id is None:
+        # No recorded position: everything still in the stream is newer than a missing snapshot
+        lexical_index.stream_id = "0-0"
+    
+    while True:
+        try:
+            response = await redis_client.xread(
+                {LEXICAL_UPDATES_STREAM: lexical_index.stream_id}, count=100, block=INGEST_BLOCK_MS
+            )
+            if response:
+                await apply_lexical_updates(response[0][1])
+            await save_lexical_index()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error following lexical updates: {e}")
+            await asyncio.sleep(5)
+
+async def start_lexical_follower() -> Optional[asyncio.Task]:
+    """Route lexical index changes through Redis when it is reachable"""
+    if not LEXICAL_INDEX_ENABLED or not redis_client:
+        return None
+    try:
+        await redis_client.ping()
+    except Exception:
+        logger.warning("Redis unavailable, lexical index updates stay local to this process")
+        return None
+    
+    lexical_state["publish"] = True
+    return asyncio.create_task(follow_lexical_updates())
+
+async def remove_lexical_chunks(milvus_ids: List[int]):
+    """Drop deleted chunks from the lexical index"""
+    if not LEXICAL_INDEX_ENABLED or not milvus_ids:
+        return
+    
+    if lexical_state["publish"]:
+        await publish_lexical_update("remove", milvus_ids)
+        return
+    
+    async with lexical_index_lock:
+        lexical_index.remove([int(milvus_id) for milvus_id in milvus_ids])
+        lexical_state["dirty"] = True
+    
+    await save_lexical_index()
+
+async def search_lexical(query: str, top_k: int) -> List[tuple[int, float]]:
+    """BM25 search over chunk contents"""
+    if not LEXICAL_INDEX_ENABLED:
+        return []
+    
+    await refresh_lexical_index()
+    return lexical_index.search(query, top_k)
+
+async def fetch_chunks_by_ids(
+    milvus_ids: List[int],
+    filters: Optional[Dict[str, Any]] = None,
+    consistency_level: Optional[str] = None
+) -> Dict[int, Dict]:
+    """Load chunk fields by primary key, optionally applying search filters"""
+    if not milvus_ids:
+        return {}
+    
+    def read_local() -> Dict[int, Dict]:
+        rows = local_vector_store.get(milvus_ids)
+        if filters:
+            mask = local_vector_store.filter_mask(filters)
+            rows = {
+                row_id: row for row_id, row in rows.items()
+                if local_vector_store.positions[row_id] < len(mask) and mask[local_vector_store.positions[row_id]]
+            }
+        return {row_id: local_row_to_document(row) for row_id, row in rows.items()}
+    
+    if VECTOR_ENGINE == "local" or (not milvus_connected and VECTOR_ENGINE == "auto"):
+        return read_local()
+    
+    if not milvus_connected:
+        return {}
+    
+    expr = build_filter_expression(filters)
+    id_expr = f"id in {[int(milvus_id) for milvus_id in milvus_ids]}"
+    query_options = {"consistency_level": consistency_level} if consistency_level else {}
+    try:
+        rows = await run_milvus(
+            lambda: get_milvus_collection().query(
+                expr=f"({id_expr}) and ({expr})" if expr else id_expr,
+                output_fields=["id"] + milvus_output_fields(),
+                **query_options
+            )
+        )
+    except Exception as e:
+        # Connected but failing: searches have failed over to the local store, so lookups follow
+        if VECTOR_ENGINE != "auto":
+            raise
+        logger.warning(f"Reading chunks from the local store: {e}")
+        return read_local()
+    documents = [milvus_row_to_document(row["id"], row) for row in rows]
+    if not milvus_stores_content():
+        documents = await attach_chunk_text(documents)
+    return {doc["id"]: doc for doc in documents}
+
+def reciprocal_rank_fusion(rankings: List[tuple[List[int], float]], k: int = 60) -> Dict[int, float]:
+    """Fuse ranked id lists: score = sum(weight / (k + rank))"""
+    scores: Dict[int, float] = {}
+    for ids, weight in rankings:
+        for rank, doc_id in enumerate(ids, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank)
+    return scores
+
+async def retrieve_documents(
+    query: str,
+    embedding: List[float],
+    top_k: int = 5,
+    vector_weight: float = 1.0,
+    lexical_weight: float = 1.0,
+    filters: Optional[Dict[str, Any]] = None
+) -> List[Dict]:
+    """Hybrid retrieval: fuse Milvus vector hits with BM25 hits using reciprocal rank fusion.
+    
+    With reranking, RERANK_CANDIDATE_MULTIPLIER times top_k candidates are
+    fetched and diversified down to top_k.
+    """
+    fetch_k = top_k * RERANK_CANDIDATE_MULTIPLIER if RERANK_ENABLED else top_k
+    if lexical_weight <= 0 or not LEXICAL_INDEX_ENABLED:
+        with observe_stage("vector_search"):
+            documents = await search_similar_documents(embedding, top_k=fetch_k, filters=filters)
+        if not RERANK_ENABLED:
+            return documents
+        return await rerank_documents(documents, top_k, distances=vector_metric() == "L2")
+    
+    candidates = max(top_k * HYBRID_CANDIDATE_MULTIPLIER, fetch_k)
+    vector_task = (
+        timed_stage("vector_search", search_similar_documents(embedding, top_k=candidates, filters=filters))
+        if vector_weight > 0 else asyncio.sleep(0, result=[])
+    )
+    vector_docs, lexical_hits = await asyncio.gather(
+        vector_task,
+        timed_stage("lexical_search", search_lexical(query, candidates))
+    )
+    
+    vector_docs = [doc for doc in vector_docs if doc.get("id") is not None]
+    prefetched: Dict[int, Dict] = {}
+    if filters and lexical_hits:
+        # The BM25 index has no metadata, so push the filter down to the vector store for its hits
+        prefetched = await fetch_chunks_by_ids([milvus_id for milvus_id, _ in lexical_hits], filters)
+        lexical_hits = [(milvus_id, score) for milvus_id, score in lexical_hits if milvus_id in prefetched]
+    
+    fused = reciprocal_rank_fusion([
+        ([doc["id"] for doc in vector_docs], vector_weight),
+        ([milvus_id for milvus_id, _ in lexical_hits], lexical_weight)
+    ], k=HYBRID_RRF_K)
+    
+    top_ids = sorted(fused, key=fused.get, reverse=True)[:fetch_k]
+    documents = dict(prefetched)
+    documents.update({doc["id"]: doc for doc in vector_docs})
+    missing = [doc_id for doc_id in top_ids if doc_id not in documents]
+    if missing:
+        documents.update(await fetch_chunks_by_ids(missing))
+    
+    lexical_scores = dict(lexical_hits)
+    results = []
+    for doc_id in top_ids:
+        if doc_id not in documents:
+            continue
+        doc = dict(documents[doc_id])
+        if "score" in doc:
+            doc["vector_score"] = doc["score"]
+        if doc_id in lexical_scores:
+            doc["lexical_score"] = lexical_scores[doc_id]
+        doc["score"] = fused[doc_id]
+        results.append(doc)
+    
+    if RERANK_ENABLED:
+        return await rerank_documents(results, top_k)
+    return results
+
+def context_token_budget(model: str, query: str = "", language: str = "es", history_tokens: int = 0) -> int:
+    """Tokens available for retrieved context given the model's context window and conversation history"""
+    window = next(
+        (entry["context_window"] for entry in CHAT_MODELS if entry["id"] == model),
+        DEFAULT_CONTEXT_WINDOW
+    )
+    reserved = (
+        CHAT_MAX_TOKENS
+        + count_tokens(CHAT_SYSTEM_PROMPTS.get(language, CHAT_SYSTEM_PROMPTS["es"]))
+        + count_tokens(query)
+        + history_tokens
+        + 64  # message framing and the "Contexto/Pregunta" scaffolding
+    )
+    return max(0, min(CONTEXT_MAX_TOKENS, window - reserved))
+
+def merge_overlapping_text(previous: str, following: str, max_overlap: int = 400) -> Optional[str]:
+    """Join two adjacent chunks, dropping the text they share; None if they don't overlap"""
+    probe = following[:40]
+    if not probe:
+        return previous
+    position = previous.find(probe, max(0, len(previous) - max_overlap))
+    while position != -1:
+        if following.startswith(previous[position:]):
+            return previous + following[len(previous) - position:]
+        position = previous.find(probe, position + 1)
+    return None
+
+def merge_adjacent_chunks(documents: List[Dict]) -> List[Dict]:
+    """Merge consecutive chunks of the same source and drop duplicated text.
+    
+    Passages keep the rank of their best-ranked chunk, so the packing order
+    still follows retrieval relevance.
+    """
+    seen_chunks = set()
+    by_source: Dict[str, List[tuple[int, Dict]]] = {}
+    for rank, doc in enumerate(documents):
+        content = (doc.get("content") or "").strip()
+        source = doc.get("source") or doc.get("title") or ""
+        key = (source, doc.get("chunk_index")) if doc.get("chunk_index") is not None else content
+        if not content or key in seen_chunks:
+            continue
+        seen_chunks.add(key)
+        by_source.setdefault(source, []).append((rank, doc))
+    
+    passages = []
+    for source_docs in by_source.values():
+        source_docs.sort(key=lambda item: item[1].get("chunk_index") or 0)
+        current = None
+        for rank, doc in source_docs:
+            content = doc["content"].strip()
+            index = doc.get("chunk_index")
+            if current is not None and index is not None and index == current["last_index"] + 1:
+                merged = merge_overlapping_text(current["content"], content)
+                if merged is not None:
+                    current["content"] = merged
+                    current["last_index"] = index
+                    current["rank"] = min(current["rank"], rank)
+                    continue
+            if current is not None:
+                passages.append(current)
+            current = {
+                "title": doc.get("title") or "",
+                "content": content,
+                "last_index": index if index is not None else -2,
+                "rank": rank
+            }
+        if current is not None:
+            passages.append(current)
+    
+    # Drop passages duplicated by, or wholly contained in, another passage
+    unique = []
+    for passage in sorted(passages, key=lambda passage: (-len(passage["content"]), passage["rank"])):
+        if not any(passage["content"] in other["content"] for other in unique):
+            unique.append(passage)
+    passages = unique
+    passages.sort(key=lambda passage: passage["rank"])
+    return passages
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to a token budget, ending at a sentence or line boundary when possible"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _token_encoder:
+        truncated = _token_encoder.decode(_token_encoder.encode(text, disallowed_special=())[:max_tokens])
+    else:
+        truncated = text[:max_tokens * 4]
+    boundary = max(truncated.rfind(". "), truncated.rfind(".\n"), truncated.rfind("\n"))
+    if boundary > len(truncated) // 2:
+        truncated = truncated[:boundary + 1]
+    return truncated.rstrip() + " ..."
+
+def build_context(
+    documents: List[Dict],
+    model: Optional[str] = None,
+    query: str = "",
+    language: str = "es",
+    history_tokens: int = 0
+) -> str:
+    """Pack retrieved documents into the prompt context within the model's token budget"""
+    budget = context_token_budget(model or OPENROUTER_CHAT_MODEL, query, language, history_tokens)
+    
+    sections = []
+    used = 0
+    for passage in merge_adjacent_chunks(documents):
+        section = f"[{passage['title']}]:\n{passage['content']}"
+        tokens = count_tokens(section) + 2
+        if used + tokens <= budget:
+            sections.append(section)
+            used += tokens
+            continue
+        
+        # Fill what is left with the start of the next passage, if it is worth it
+        remaining = budget - used
+        if remaining > 100:
+            sections.append(truncate_to_tokens(section, remaining - 2))
+        break
+    
+    return "\n\n".join(sections)
+
+def new_context_id(user_id: str) -> str:
+    """Generate a conversation context ID"""
+    return hashlib.md5(f"{user_id}{datetime.utcnow().isoformat()}".encode()).hexdigest()
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# ==================== Reranking ====================
+
+async def fetch_candidate_vectors(ids: List[int]) -> Dict[int, np.ndarray]:
+    """Stored vectors of candidates that came without one (lexical-only hits)"""
+    if not ids:
+        return {}
+    loop = asyncio.get_running_loop()
+    
+    def read_local():
+        store = local_vector_store
+        store.refresh()
+        with store.lock:
+            return {row_id: np.array(store.matrix[store.positions[row_id]]) for row_id in ids if row_id in store.positions}
+    
+    if VECTOR_ENGINE == "local" or (VECTOR_ENGINE == "auto" and not milvus_connected):
+        return await loop.run_in_executor(None, read_local)
+    
+    try:
+        if not milvus_stores_content():
+            # Compact and quantized collections keep full-precision vectors in the chunk store
+            rows = await loop.run_in_executor(None, functools.partial(chunk_store.get, ids, vectors=True))
+            return {row_id: np.asarray(row["embedding"], dtype=np.float32) for row_id, row in rows.items()}
+        
+        rows = await run_milvus(lambda: get_milvus_collection().query(expr=f"id in {ids}", output_fields=["id", "embedding"]))
+        return {int(row["id"]): np.asarray(row["embedding"], dtype=np.float32) for row in rows}
+    except Exception as e:
+        # Milvus is connected but failing, as when searches fail over to the local store
+        if VECTOR_ENGINE != "auto":
+            raise
+        logger.warning(f"Reading candidate vectors from the local store: {e}")
+        return await loop.run_in_executor(None, read_local)
+
+def without_vectors(documents: List[Dict]) -> List[Dict]:
+    """Drop the vectors hits carry for reranking before documents leave retrieval"""
+    return [{key: value for key, value in doc.items() if key != "embedding"} if "embedding" in doc else doc for doc in documents]
+
+def authority_level(document_type: Optional[str]) -> float:
+    normalized = " ".join(lexical_tokens(document_type or ""))
+    return max(
+        (level for prefix, level in RERANK_AUTHORITY_LEVELS.items() if normalized.startswith(" ".join(lexical_tokens(prefix)))),
+        default=0.0
+    )
+
+def metadata_boosts(documents: List[Dict]) -> np.ndarray:
+    """Optional relevance boosts for recent documents and authoritative document types"""
+    boosts = np.zeros(len(documents))
+    metadata = [doc.get("metadata") or {} for doc in documents]
+    if RERANK_RECENCY_WEIGHT:
+        dates = np.array([float(fields.get("document_date") or 0) for fields in metadata])
+        age_days = np.maximum(time.time() - dates, 0.0) / 86400
+        boosts += np.where(dates > 0, RERANK_RECENCY_WEIGHT * 0.5 ** (age_days / RERANK_RECENCY_HALF_LIFE_DAYS), 0.0)
+    if RERANK_AUTHORITY_WEIGHT:
+        boosts += RERANK_AUTHORITY_WEIGHT * np.array([authority_level(fields.get("document_type")) for fields in metadata])
+    return boosts
+
+def mmr_order(
+    relevance: np.ndarray,
+    vectors: np.ndarray,
+    groups: np.ndarray,
+    top_k: int,
+    diversity_lambda: float = RERANK_LAMBDA,
+    max_per_group: int = RERANK_MAX_PER_SOURCE,
+    cap_margin: float = RERANK_SOURCE_CAP_MARGIN
+) -> List[int]:
+    """Greedy maximal marginal relevance over unit-length candidate vectors.
+    
+    Each pick maximizes lambda * relevance - (1 - lambda) * its highest similarity
+    to the picks so far. A group that reached max_per_group is passed over only
+    while another group has a candidate within cap_margin of the most relevant
+    one left, so the cap never trades a strong chunk for a weak one.
+    """
+    n = len(relevance)
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(n)
+    available = np.ones(n, dtype=bool)
+    capped = np.zeros(n, dtype=bool)
+    counts = np.zeros(int(groups.max()) + 1 if n else 0, dtype=np.int64)
+    order: List[int] = []
+    
+    while len(order) < min(top_k, n):
+        scores = diversity_lambda * relevance - (1 - diversity_lambda) * redundancy
+        alternatives = available & ~capped & (relevance >= relevance[available].max() - cap_margin)
+        eligible = available & ~capped if alternatives.any() else available
+        scores[~eligible] = -np.inf
+        pick = int(np.argmax(scores))
+        order.append(pick)
+        available[pick] = False
+        redundancy = np.maximum(redundancy, similarity[pick])
+        counts[groups[pick]] += 1
+        if max_per_group and counts[groups[pick]] >= max_per_group:
+            capped |= groups == groups[pick]
+    return order
+
+async def rerank_documents(documents: List[Dict], top_k: int, distances: bool = False) -> List[Dict]:
+    """Diversify over-fetched candidates down to top_k.
+    
+    Relevance is the retrieval score scaled to [0, 1] (negated first when scores
+    are L2 distances) plus metadata boosts; redundancy is the cosine similarity of
+    the candidates' vectors, which vector hits bring along from the search. Scores
+    are left as retrieval returned them. If reranking fails, the candidates keep
+    their retrieval order.
+    """
+    if len(documents) <= 1:
+        return without_vectors(documents[:top_k])
+    
+    try:
+        with observe_stage("rerank"):
+            order = await mmr_rerank_order(documents, top_k, distances)
+    except Exception as e:
+        logger.warning(f"Reranking failed, keeping retrieval order: {e}")
+        return without_vectors(documents[:top_k])
+    
+    return without_vectors([documents[i] for i in order])
+
+async def mmr_rerank_order(documents: List[Dict], top_k: int, distances: bool) -> List[int]:
+    """Positions of the documents to keep, in MMR order"""
+    vectors = {
+        doc["id"]: np.asarray(doc["embedding"], dtype=np.float32)
+        for doc in documents if doc.get("id") is not None and doc.get("embedding") is not None
+    }
+    vectors.update(await fetch_candidate_vectors([
+        doc["id"] for doc in documents if doc.get("id") is not None and doc["id"] not in vectors
+    ]))
+    dim = max((len(vector) for vector in vectors.values()), default=1)
+    matrix = np.zeros((len(documents), dim), dtype=np.float32)
+    for row, doc in enumerate(documents):
+        vector = vectors.get(doc.get("id"))
+        if vector is not None and len(vector) == dim:
+            matrix[row] = vector
+    # Candidates without a stored vector count as novel
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    
+    scores = np.array([float(doc.get("score") or 0.0) for doc in documents])
+    if distances:
+        scores = -scores
+    span = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / span if span > 0 else np.ones(len(documents))
+    relevance += metadata_boosts(documents)
+    
+    sources = [doc.get("source") or doc.get("title") or str(doc.get("id")) for doc in documents]
+    groups = np.unique(sources, return_inverse=True)[1].ravel()
+    return mmr_order(relevance, matrix, groups, top_k)
+
+# ==================== Document Extraction ====================
+
+extraction_executor: Optional[ProcessPoolExecutor] = None
+extraction_stats: Dict[str, float] = {
+    "documents": 0,
+    "pages": 0,
+    "seconds": 0.0,
+    "failures": 0,
+    "timeouts": 0
+}
+
+class ExtractionTimeout(TimeoutError):
+    """A document took longer to extract than its time budget"""
+
+class ExtractionDeadline(BaseException):
+    """Raised inside a worker when its deadline passes; not an Exception so parsers can't swallow it"""
+
+def init_extraction_worker(memory_limit_mb: int):
+    """Cap the address space an extraction worker may grow by"""
+    if memory_limit_mb <= 0:
+        return
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[0]) * resource.getpagesize()
+        limit = current + memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (OSError, ValueError) as e:
+        logging.getLogger(__name__).warning(f"Could not cap extraction worker memory: {e}")
+
+def get_extraction_executor() -> ProcessPoolExecutor:
+    """Return the process pool for document parsing, starting it on first use"""
+    global extraction_executor
+    
+    if extraction_executor is None:
+        # Spawned rather than forked: the API process holds threads and open sockets
+        extraction_executor = ProcessPoolExecutor(
+            max_workers=EXTRACTION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_extraction_worker,
+            initargs=(EXTRACTION_MEMORY_LIMIT_MB,)
+        )
+    
+    return extraction_executor
+
+@contextmanager
+def extraction_deadline(seconds: float):
+    """Abort the enclosed work in an extraction worker once seconds have elapsed"""
+    def expire(signum, frame):
+        raise ExtractionDeadline(f"Extraction exceeded {seconds:.0f}s")
+    
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def open_pdf(path: str) -> PdfReader:
+    reader = PdfReader(path)
+    if reader.is_encrypted:
+        # Many official PDFs are "encrypted" with an empty user password
+        reader.decrypt("")
+    return reader
+
+def count_pdf_pages(path: str, timeout: float) -> int:
+    """Runs in an extraction worker"""
+    with extraction_deadline(timeout):
+        return len(open_pdf(path).pages)
+
+def extract_pdf_pages(path: str, start: int, stop: int, timeout: float) -> List[str]:
+    """Runs in an extraction worker: text of pages [start, stop)"""
+    with extraction_deadline(timeout):
+        reader = open_pdf(path)
+        pages = []
+        for number in range(start, min(stop, len(reader.pages))):
+            try:
+                pages.append(reader.pages[number].extract_text() or "")
+            except MemoryError:
+                raise
+            except Exception as e:
+                # One malformed page shouldn't lose the rest of the document
+                logging.getLogger(__name__).warning(f"Skipping unreadable page {number + 1} of {path}: {e}")
+                pages.append("")
+        return pages
+
+def extract_docx_text(path: str, output_path: str, timeout: float) -> int:
+    """Runs in an extraction worker: write a DOCX's paragraphs and tables, in order, to a text file"""
+    with extraction_deadline(timeout):
+        document = DocxDocument(path)
+        blocks = 0
+        with open(output_path, "w", encoding="utf-8") as output:
+            for element in document.element.body.iterchildren():
+                if element.tag.endswith("}p"):
+                    text = DocxParagraph(element, document).text
+                elif element.tag.endswith("}tbl"):
+                    table = DocxTable(element, document)
+                    text = "\n".join(" | ".join(cell.text.strip() for cell in row.cells) for row in table.rows)
+                else:
+                    continue
+                output.write(text + "\n")
+                blocks += 1
+        return blocks
+
+def wait_for_extraction(future: Future, timeout: float, path: str):
+    """Block the calling (non-event-loop) thread on an extraction task"""
+    try:
+        # Workers enforce their own deadline; the grace period covers a wedged worker
+        return future.result(timeout=timeout + 5)
+    except (ExtractionDeadline, FuturesTimeoutError):
+        extraction_stats["timeouts"] += 1
+        raise ExtractionTimeout(f"Timed out extracting {path}")
+    except MemoryError:
+        raise MemoryError(f"Extraction of {path} exceeded {EXTRACTION_MEMORY_LIMIT_MB} MB")
+
+def iter_pdf_lines(path: str) -> Iterator[str]:
+    """Yield a PDF's text page by page, extracting page ranges in parallel workers"""
+    executor = get_extraction_executor()
+    started = time.perf_counter()
+    deadline = started + EXTRACTION_FILE_TIMEOUT
+    
+    def remaining() -> float:
+        left = deadline - time.perf_counter()
+        if left <= 0:
+            extraction_stats["timeouts"] += 1
+            raise ExtractionTimeout(f"Extraction of {path} exceeded {EXTRACTION_FILE_TIMEOUT:.0f}s")
+        return min(left, EXTRACTION_TASK_TIMEOUT)
+    
+    timeout = remaining()
+    page_count = wait_for_extraction(executor.submit(count_pdf_pages, path, timeout), timeout, path)
+    ranges = [
+        (start, min(start + EXTRACTION_PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, EXTRACTION_PAGES_PER_TASK)
+    ]
+    
+    # Keep one range per worker in flight; pages are yielded strictly in order
+    pending = deque()
+    next_range = 0
+    pages_done = 0
+    try:
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < EXTRACTION_WORKERS:
+                start, stop = ranges[next_range]
+                timeout = remaining()
+                pending.append((executor.submit(extract_pdf_pages, path, start, stop, timeout), timeout))
+                next_range += 1
+            
+            future, timeout = pending.popleft()
+            for page in wait_for_extraction(future, timeout, path):
+                pages_done += 1
+                yield from page.split("\n")
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        record_extraction(path, pages_done, time.perf_counter() - started)
+
+def iter_docx_lines(path: str) -> Iterator[str]:
+    """Yield a DOCX's text, converted in a worker to a text file that is then streamed"""
+    started = time.perf_counter()
+    text_path = f"{path}.txt"
+    blocks = 0
+    try:
+        timeout = min(EXTRACTION_TASK_TIMEOUT * 10, EXTRACTION_FILE_TIMEOUT)
+        future = get_extraction_executor().submit(extract_docx_text, path, text_path, timeout)
+        blocks = wait_for_extraction(future, timeout, path)
+        yield from iter_text_lines(text_path)
+    finally:
+        # A DOCX has no fixed pages; its paragraphs and tables stand in for them
+        record_extraction(path, blocks, time.perf_counter() - started)
+        if os.path.exists(text_path):
+            os.remove(text_path)
+
+def record_extraction(path: str, pages: int, seconds: float):
+    extraction_stats["documents"] += 1
+    extraction_stats["pages"] += pages
+    extraction_stats["seconds"] += seconds
+    rate = pages / seconds if seconds > 0 else 0.0
+    logger.info(f"Extracted {pages} pages from {os.path.basename(path)} in {seconds:.2f}s ({rate:.1f} pages/s)")
+
+def detect_text_encoding(path: str) -> str:
+    """Guess a text file's encoding from its first bytes, preferring UTF-8"""
+    with open(path, "rb") as f:
+        sample = f.read(ENCODING_DETECTION_BYTES)
+    
+    try:
+        # final=False tolerates a multi-byte character cut at the end of the sample
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        pass
+    
+    # Not UTF-8: trust chardet's best guess, else the usual Windows Latin-1 of Mexican sources
+    encoding = chardet.detect(sample).get("encoding") or "cp1252"
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = "cp1252"
+    return encoding
+
+def iter_document_lines(path: str, file_ext: str, filename: str) -> Iterator[str]:
+    """Yield the text lines of an uploaded document"""
+    try:
+        if file_ext == '.pdf':
+            yield from iter_pdf_lines(path)
+        elif file_ext == '.docx':
+            yield from iter_docx_lines(path)
+        else:
+            yield from iter_text_lines(path, detect_text_encoding(path))
+    except Exception as e:
+        extraction_stats["failures"] += 1
+        logger.error(f"Could not extract text from {filename}: {e}")
+        raise
+
+# ==================== Document Chunking ====================
+
+# Structural headings of Mexican legislation; a section heading always starts a new chunk
+LEGAL_SECTION_PATTERN = re.compile(
+    r"^\s*((LIBRO|T[IÍ]TULO|CAP[IÍ]TULO|SECCI[OÓ]N)\s+(\d+|[IVXLCDM]+\b|[^\W\d_]+[oO]\b)"
+    r"|(ART[IÍ]CULOS\s+)?TRANSITORIOS?\s*$)",
+    re.IGNORECASE
+)
+LEGAL_ARTICLE_PATTERN = re.compile(r"^\s*(ART[IÍ]CULO|ART\.)\s+(\d+|[^\W\d_]+[oO]\b)", re.IGNORECASE)
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"(?<=[.;:!?])\s+")
+
+def iter_text_lines(path: str, encoding: str = "utf-8-sig") -> Iterator[str]:
+    """Decode a text file incrementally and yield its lines"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pending = ""
+    
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(UPLOAD_READ_SIZE)
+            pending += decoder.decode(block, final=not block)
+            lines = pending.split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip("\r")
+            
+            # Text without line breaks must not pile up in memory
+            while len(pending) > TEXT_MAX_LINE_CHARS:
+                cut = pending.rfind(" ", 0, TEXT_MAX_LINE_CHARS)
+                if cut <= 0:
+                    cut = TEXT_MAX_LINE_CHARS
+                yield pending[:cut]
+                pending = pending[cut:].lstrip()
+            
+            if not block:
+                break
+    
+    if pending:
+        yield pending.rstrip("\r")
+
+def iter_legal_units(lines: Iterable[str], max_unit_chars: int) -> Iterator[tuple[str, str]]:
+    """Group lines into (kind, text) units split at headings, articles and blank lines.
+    
+    kind is "section" for Libro/Título/Capítulo/Sección headings, "article"
+    for Artículo starts, "paragraph" after a blank line and "continuation"
+    when a unit is cut only to bound its size.
+    """
+    kind = "paragraph"
+    buffer: List[str] = []
+    size = 0
+    
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            # A blank line ends a paragraph, but not a heading still waiting for its text
+            if buffer and not (kind in ("section", "article") and len(buffer) == 1):
+                yield kind, "\n".join(buffer)
+                buffer = []
+                size = 0
+                kind = "paragraph"
+            continue
+        
+        if LEGAL_SECTION_PATTERN.match(stripped):
+            boundary = "section"
+        elif LEGAL_ARTICLE_PATTERN.match(stripped):
+            boundary = "article"
+        elif size > max_unit_chars:
+            boundary = "continuation"
+        else:
+            boundary = None
+        
+        if boundary:
+            if buffer:
+                yield kind, "\n".join(buffer)
+                buffer = []
+                size = 0
+            kind = boundary
+        
+        buffer.append(stripped)
+        size += len(stripped) + 1
+    
+    if buffer:
+        yield kind, "\n".join(buffer)
+
+def cut_to_tokens(text: str, max_tokens: int) -> Iterator[tuple[str, int]]:
+    """Cut text without spaces (a URL, base64, a table row) into (piece, tokens) of at most max_tokens"""
+    while text:
+        tokens = count_tokens(text)
+        if tokens <= max_tokens:
+            yield text, tokens
+            return
+        # Cut on characters rather than token ids so multi-byte characters stay whole
+        end = max(1, len(text) * max_tokens // tokens)
+        while end > 1 and count_tokens(text[:end]) > max_tokens:
+            end = min(end - 1, end * 9 // 10)
+        yield text[:end], count_tokens(text[:end])
+        text = text[end:]
+
+def split_oversized_unit(text: str, max_tokens: int) -> Iterator[tuple[str, int]]:
+    """Split text larger than max_tokens into (piece, tokens) at sentence, then word, boundaries.
+    
+    A single word over the budget is cut on token count as a last resort.
+    """
+    for sentence in SENTENCE_BOUNDARY_PATTERN.split(text):
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            yield sentence, tokens
+            continue
+        
+        words: List[str] = []
+        words_tokens = 0
+        for word in sentence.split():
+            word_tokens = count_tokens(" " + word)
+            if word_tokens > max_tokens:
+                if words:
+                    yield " ".join(words), words_tokens
+                    words = []
+                    words_tokens = 0
+                yield from cut_to_tokens(word, max_tokens)
+                continue
+            if words and words_tokens + word_tokens > max_tokens:
+                yield " ".join(words), words_tokens
+                words = []
+                words_tokens = 0
+            words.append(word)
+            words_tokens += word_tokens
+        if words:
+            yield " ".join(words), words_tokens
+
+def overlap_tail(chunk: str, overlap_tokens: int) -> str:
+    """Longest run of whole trailing sentences of chunk within overlap_tokens"""
+    if overlap_tokens <= 0:
+        return ""
+    
+    tail = ""
+    boundaries = [match.end() for match in re.finditer(r"[.;:!?]\s+|\n", chunk)]
+    for position in reversed(boundaries):
+        candidate = chunk[position:]
+        if count_tokens(candidate) > overlap_tokens:
+            break
+        tail = candidate
+    return tail
+
+def chunk_legal_text(
+    lines: Iterable[str],
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS
+) -> Iterator[str]:
+    """Lazily pack lines of a legal text into chunks of at most max_tokens tokens.
+    
+    Chunks break at Título/Capítulo headings and prefer to break before an
+    Artículo; only text split mid-article carries trailing sentences over as
+    overlap, so the next chunk starts with the exact end of the previous one.
+    """
+    parts: List[str] = []
+    tokens = 0
+    has_body = False
+    
+    for kind, text in iter_legal_units(lines, max_tokens * 8):
+        unit_tokens = count_tokens(text)
+        if unit_tokens <= max_tokens:
+            pieces = [(text, unit_tokens)]
+        else:
+            pieces = split_oversized_unit(text, max_tokens)
+        
+        for position, (piece, piece_tokens) in enumerate(pieces):
+            piece_kind = kind if position == 0 else "continuation"
+            separator = "\n" if position == 0 else " "
+            
+            # Headings stay with the text that follows them
+            breaks_section = piece_kind == "section" and has_body
+            if parts and (breaks_section or tokens + piece_tokens + 1 > max_tokens):
+                chunk = "".join(parts).strip()
+                yield chunk
+                
+                tail = ""
+                if piece_kind in ("paragraph", "continuation"):
+                    tail = overlap_tail(chunk, overlap_tokens)
+                tail_tokens = count_tokens(tail) if tail else 0
+                if tail and tail_tokens + piece_tokens + 1 <= max_tokens:
+                    parts = [tail]
+                    tokens = tail_tokens
+                else:
+                    parts = []
+                    tokens = 0
+                has_body = False
+            
+            parts.append(separator + piece if parts else piece)
+            tokens += piece_tokens + 1
+            has_body = has_body or piece_kind != "section"
+    
+    if parts:
+        chunk = "".join(parts).strip()
+        if chunk:
+            yield chunk
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """Split in-memory text into token-sized chunks"""
+    return list(chunk_legal_text(text.split("\n"), max_tokens, overlap_tokens))
+
+def next_chunk_window(chunks: Iterator[str], size: int) -> List[str]:
+    """Pull the next size chunks from a chunk iterator"""
+    return list(itertools.islice(chunks, size))
+
+# ==================== API Endpoints ====================
+
+@app.get("/")
+async def root():
+    """Root endpoint"""
+    return {
+        "name": "LegalTracking RAG API",
+        "version": "1.0.0",
+        "status": "online",
+        "llm_provider": "OpenRouter",
+        "embedding_model": OPENROUTER_EMBEDDING_MODEL,
+        "chat_model": OPENROUTER_CHAT_MODEL,
+        "endpoints": {
+            "health": "/health",
+            "chat": "/api/chat",
+            "chat_stream": "/api/chat/stream",
+            "upload": "/api/documents/upload",
+            "search": "/api/search",
+            "models": "/api/models",
+            "metrics": "/metrics"
+        }
+    }
+
+@app.get("/health")
+async def health_check():
+    """Health check endpoint"""
+    redis_healthy = False
+    if redis_client:
+        try:
+            redis_healthy = await redis_client.ping()
+        except Exception:
+            redis_healthy = False
+    
+    health_status = {
+        "status": "healthy",
+        "timestamp": datetime.utcnow().isoformat(),
+        "version": "1.0.0",
+        "llm_provider": "OpenRouter",
+        "services": {
+            "openrouter": OPENROUTER_API_KEY is not None,
+            "milvus": milvus_connected,
+            "redis": redis_healthy,
+            "supabase": supabase_client is not None
+        },
+        "openrouter_pool": dict(openrouter_stats),
+        "answer_cache": dict(answer_cache.stats, entries=len(answer_cache.entries)),
+        "milvus_batching": dict(milvus_search_batcher.stats),
+        "admission": {
+            "active": openrouter_slots.active,
+            "waiting": sum(1 for waiter in openrouter_slots.waiters if not waiter[2].done()),
+            "paused_seconds": round(max(openrouter_budget.paused_until - time.monotonic(), 0.0), 1)
+        },
+        "milvus_index": dict(milvus_index, search=milvus_search_params(1)["params"]) if milvus_index else None,
+        "vector_engine": VECTOR_ENGINE,
+        "local_vectors": local_vector_store.live_count if local_vector_store_enabled() else None,
+        "lexical_index": {"chunks": lexical_index.live_docs, "terms": len(lexical_index.postings)},
+        "ingest_queue": await get_ingest_queue_stats(),
+        "extraction": dict(
+            extraction_stats,
+            pages_per_second=round(extraction_stats["pages"] / extraction_stats["seconds"], 2)
+            if extraction_stats["seconds"] else 0.0
+        ),
+        "coalescing": {
+            flight.name: dict(flight.stats)
+            for flight in (embedding_flight, search_flight, chat_flight)
+        },
+        "chat_models": {model: breaker.snapshot() for model, breaker in circuit_breakers.items()},
+        "supabase_writer": supabase_writer.snapshot() if supabase_client else None
+    }
+    
+    # Check if all critical services are healthy
+    critical_services = ["openrouter"] if VECTOR_ENGINE == "local" else ["openrouter", "milvus"]
+    all_critical_healthy = all(health_status["services"][s] for s in critical_services)
+    
+    if not all_critical_healthy:
+        health_status["status"] = "degraded"
+    
+    return health_status
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    queue = await get_ingest_queue_stats()
+    if queue.get("queued") is not None:
+        INGEST_QUEUE_DEPTH.labels(INGEST_STREAM).set(queue["queued"])
+        INGEST_QUEUE_DEPTH.labels(INGEST_DEAD_LETTER_STREAM).set(queue["dead_letters"])
+    
+    return Response(generate_latest(metrics_registry()), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/api/models")
+async def list_models():
+    """List available models from OpenRouter"""
+    return {
+        "embedding_models": EMBEDDING_MODELS,
+        "chat_models": CHAT_MODELS,
+        "current_embedding_model": OPENROUTER_EMBEDDING_MODEL,
+        "current_chat_model": OPENROUTER_CHAT_MODEL,
+        "fallback_chat_models": CHAT_FALLBACK_MODELS
+    }
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks):
+    """RAG-powered chat endpoint using OpenRouter"""
+    metrics_operation.set("chat")
+    release_user = user_limiter.acquire(request.user_id)
+    try:
+        logger.info(f"Chat request from user {request.user_id}: {request.message[:100]}...")
+        
+        # Generate embedding for the query
+        with observe_stage("embedding"):
+            query_embedding = await generate_embedding_openrouter(request.message)
+        chat_model = request.model or OPENROUTER_CHAT_MODEL
+        
+        # Generate context ID if not provided; a known one brings back the conversation so far
+        context_id = request.context_id or new_context_id(request.user_id)
+        with observe_stage("memory"):
+            conversation = await load_conversation(context_id, request.user_id) if request.context_id else None
+        history = conversation_messages(conversation, request.language)
+        anchor = query_embedding
+        
+        # Reuse the answer to a near-identical earlier question when possible; follow-ups depend on what came before
+        cached = None
+        if not history:
+            with observe_stage("answer_cache"):
+                cached = await lookup_cached_answer(
+                    query_embedding,
+                    request.language,
+                    chat_model,
+                    retrieval_settings(request.vector_weight, request.lexical_weight)
+                )
+        if cached:
+            response_text = cached["response"]
+            relevant_docs = cached["sources"]
+            model_used = cached["model"]
+            tokens_used = 0
+        else:
+            if reuses_previous_sources(conversation, request.message, query_embedding):
+                relevant_docs = conversation["sources"]
+                anchor = conversation["anchor"]
+            else:
+                # Search for relevant documents
+                with observe_stage("retrieval"):
+                    relevant_docs = await retrieve_documents(
+                        request.message,
+                        query_embedding,
+                        top_k=5,
+                        vector_weight=request.vector_weight,
+                        lexical_weight=request.lexical_weight
+                    )
+            
+            # Build context from relevant documents
+            with observe_stage("context"):
+                context = build_context(
+                    relevant_docs, chat_model, request.message, request.language, count_history_tokens(history)
+                )
+            
+            # Generate response using OpenRouter
+            with observe_stage("llm"):
+                response_text, model_used, tokens_used = await generate_chat_response_openrouter(
+                    request.message,
+                    context,
+                    request.language,
+                    chat_model,
+                    history
+                )
+            
+            if not history:
+                await store_cached_answer(
+                    query_embedding,
+                    request.language,
+                    chat_model,
+                    response_text,
+                    relevant_docs,
+                    retrieval_settings(request.vector_weight, request.lexical_weight)
+                )
+        
+        background_tasks.add_task(
+            remember_turn,
+            context_id,
+            request.user_id,
+            request.message,
+            response_text,
+            relevant_docs,
+            anchor,
+            request.language
+        )
+        
+        # Store in Supabase asynchronously
+        if supabase_client:
+            background_tasks.add_task(
+                store_chat_history,
+                request.user_id,
+                request.message,
+                response_text,
+                relevant_docs,
+                context_id,
+                model_used
+            )
+        
+        return ChatResponse(
+            response=response_text,
+            sources=relevant_docs,
+            context_id=context_id,
+            tokens_used=tokens_used,
+            model_used=model_used
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Chat error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_user()
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks):
+    """RAG-powered chat endpoint streaming tokens as Server-Sent Events"""
+    metrics_operation.set("chat_stream")
+    release_user = user_limiter.acquire(request.user_id)
+    try:
+        logger.info(f"Chat stream request from user {request.user_id}: {request.message[:100]}...")
+        started = time.perf_counter()
+        
+        # Retrieval happens before streaming so sources can be sent immediately
+        with observe_stage("embedding"):
+            query_embedding = await generate_embedding_openrouter(request.message)
+        model_used = request.model or OPENROUTER_CHAT_MODEL
+        
+        context_id = request.context_id or new_context_id(request.user_id)
+        with observe_stage("memory"):
+            conversation = await load_conversation(context_id, request.user_id) if request.context_id else None
+        history = conversation_messages(conversation, request.language)
+        anchor = query_embedding
+        
+        cached = None
+        if not history:
+            with observe_stage("answer_cache"):
+                cached = await lookup_cached_answer(
+                    query_embedding,
+                    request.language,
+                    model_used,
+                    retrieval_settings(request.vector_weight, request.lexical_weight)
+                )
+        if cached:
+            relevant_docs = cached["sources"]
+            context = ""
+        else:
+            if reuses_previous_sources(conversation, request.message, query_embedding):
+                relevant_docs = conversation["sources"]
+                anchor = conversation["anchor"]
+            else:
+                with observe_stage("retrieval"):
+                    relevant_docs = await retrieve_documents(
+                        request.message,
+                        query_embedding,
+                        top_k=5,
+                        vector_weight=request.vector_weight,
+                        lexical_weight=request.lexical_weight
+                    )
+            with observe_stage("context"):
+                context = build_context(
+                    relevant_docs, model_used, request.message, request.language, count_history_tokens(history)
+                )
+        
+    except Exception as e:
+        release_user()
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"Chat stream error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    response_parts: List[str] = []
+    usage: Dict[str, Any] = {}
+    completed = asyncio.Event()
+    
+    async def event_stream():
+        yield sse_event("sources", {"sources": relevant_docs, "context_id": context_id})
+        
+        first_token_ms = None
+        if cached:
+            first_token_ms = (time.perf_counter() - started) * 1000
+            response_parts.append(cached["response"])
+            usage["tokens_used"] = 0
+            yield sse_event("token", {"content": cached["response"]})
+        else:
+            try:
+                with observe_stage("llm"):
+                    async for token in stream_chat_with_fallback(
+                        request.message,
+                        context,
+                        request.language,
+                        model_used,
+                        usage,
+                        history
+                    ):
+                        if first_token_ms is None:
+                            first_token_ms = (time.perf_counter() - started) * 1000
+                            TIME_TO_FIRST_TOKEN.observe(first_token_ms / 1000)
+                        response_parts.append(token)
+                        yield sse_event("token", {"content": token})
+            except Exception as e:
+                logger.error(f"Chat stream error: {e}")
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                yield sse_event("error", {"error": detail})
+                return
+            
+            if not history:
+                await store_cached_answer(
+                    query_embedding,
+                    request.language,
+                    model_used,
+                    "".join(response_parts),
+                    relevant_docs,
+                    retrieval_settings(request.vector_weight, request.lexical_weight)
+                )
+        
+        duration_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"Chat stream for context {context_id}: time to first token "
+            f"{first_token_ms or 0:.0f} ms, total {duration_ms:.0f} ms"
         )
+        completed.set()
+        yield sse_event("done", {
+            "context_id": context_id,
+            "model_used": usage.get("model", model_used),
+            "cached": cached is not None,
+            "tokens_used": usage.get("tokens_used"),
+            "time_to_first_token_ms": round(first_token_ms or 0),
+            "duration_ms": round(duration_ms)
+        })
+    
+    async def store_streamed_history():
+        if response_parts:
+            await store_chat_history(
+                request.user_id,
+                request.message,
+                "".join(response_parts),
+                relevant_docs,
+                context_id,
+                usage.get("model", model_used)
+            )
+    
+    async def remember_streamed_turn():
+        # An interrupted answer is not worth remembering
+        if completed.is_set():
+            await remember_turn(
+                context_id,
+                request.user_id,
+                request.message,
+                "".join(response_parts),
+                relevant_docs,
+                anchor,
+                request.language
+            )
+    
+    async def release_after(events):
+        # The user's slot is held until the stream ends or the client goes away
+        try:
+            async for event in events:
+                yield event
+        finally:
+            release_user()
+    
+    # Runs after the stream finishes, once the full response is known
+    if supabase_client:
+        background_tasks.add_task(store_streamed_history)
+    background_tasks.add_task(remember_streamed_turn)
+    background_tasks.add_task(release_user)
+    
+    return StreamingResponse(
+        release_after(event_stream()),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/documents/upload", response_model=DocumentUploadResponse, response_model_exclude_none=True)
+async def upload_document(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    user_id: str = None,
+    title: Optional[str] = None,
+    jurisdiction: Optional[str] = None,
+    document_type: Optional[str] = None,
+    legal_domain: Optional[str] = None,
+    document_date: Optional[str] = None
+):
+    """Upload and process a document; re-uploading the same file name as the same user updates it"""
+    try:
+        file_ext = validate_upload_type(file)
+        metadata = upload_metadata(jurisdiction, document_type, legal_domain, document_date)
         
-        return DocumentUploadResponse(
-            success=True,
-            document_id=doc_id,
-            chunks_processed=len(chunks),
-            message=f"Document queued for processing: {len(chunks)} chunks"
-        )
+        # Stable per user and file name, so a re-upload only re-embeds what changed. Anonymous
+        # uploads have no owner to scope the name by, so their id is derived from the content
+        doc_id = hashlib.md5(f"{user_id}:{file.filename}".encode()).hexdigest() if user_id else None
         
+        return await queue_document(background_tasks, file, file_ext, doc_id, title, user_id, metadata)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.put("/api/documents/{document_id}", response_model=DocumentUploadResponse, response_model_exclude_none=True)
+async def update_document(
+    document_id: str,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    user_id: str = None,
+    title: Optional[str] = None,
+    jurisdiction: Optional[str] = None,
+    document_type: Optional[str] = None,
+    legal_domain: Optional[str] = None,
+    document_date: Optional[str] = None
+):
+    """Replace a document's content; only new or changed chunks are embedded"""
+    try:
+        file_ext = validate_upload_type(file)
+        metadata = upload_metadata(jurisdiction, document_type, legal_domain, document_date)
+        
+        return await queue_document(background_tasks, file, file_ext, document_id, title, user_id, metadata)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Update error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/documents/{document_id}", response_model=DocumentDeleteResponse)
+async def remove_document(document_id: str):
+    """Delete a document from the vector stores, caches and Supabase"""
+    try:
+        chunks_deleted = await delete_document(document_id)
+    except DocumentBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Delete error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if not chunks_deleted:
+        raise HTTPException(status_code=404, detail=f"Document {document_id} not found")
+    
+    return DocumentDeleteResponse(
+        success=True,
+        document_id=document_id,
+        chunks_deleted=chunks_deleted,
+        message=f"Deleted {chunks_deleted} chunks"
+    )
+
+@app.get("/api/documents/{document_id}/status", response_model=DocumentStatusResponse)
+async def document_status(document_id: str):
+    """Report ingestion progress of an uploaded document"""
+    if not redis_client:
+        raise HTTPException(status_code=503, detail="Ingestion status unavailable")
+    
+    try:
+        status = await get_ingest_status(document_id)
+    except Exception as e:
+        logger.error(f"Status lookup error: {e}")
+        raise HTTPException(status_code=503, detail="Ingestion status unavailable")
+    
+    if not status:
+        raise HTTPException(status_code=404, detail=f"Document {document_id} not found")
+    
+    return DocumentStatusResponse(
+        document_id=document_id,
+        state=status.get("state", "unknown"),
+        filename=status.get("filename"),
+        chunks_processed=int(status.get("chunks_processed") or 0),
+        chunks_unchanged=int(status.get("chunks_unchanged") or 0),
+        chunks_embedded=int(status.get("chunks_embedded") or 0),
+        chunks_inserted=int(status.get("chunks_inserted") or 0),
+        chunks_failed=int(status.get("chunks_failed") or 0),
+        chunks_deleted=int(status.get("chunks_deleted") or 0),
+        attempts=int(status.get("attempts") or 0),
+        error=status.get("error") or None,
+        updated_at=status.get("updated_at")
+    )
+
 @app.post("/api/search", response_model=List[SearchResult])
-async def search(request: SearchRequest):
+async def search(request: SearchRequest, http_request: Request, background_tasks: BackgroundTasks):
     """Search for documents using OpenRouter embeddings"""
+    started = time.perf_counter()
+    # Filters are applied inside the ANN search rather than after retrieval;
+    # translating them up front rejects invalid filters with a 400
+    build_filter_expression(request.filters)
+    metrics_operation.set("search")
+    release_user = user_limiter.acquire(request.user_id)
+    
     try:
         # Generate embedding for search query
-        query_embedding = await generate_embedding_openrouter(request.query)
+        with observe_stage("embedding"):
+            query_embedding = await generate_embedding_openrouter(request.query)
         
-        # Search in Milvus
-        results = await search_similar_documents(query_embedding, top_k=request.limit)
+        # Hybrid search over Milvus and the lexical index
+        with observe_stage("retrieval"):
+            results = await retrieve_documents(
+                request.query,
+                query_embedding,
+                top_k=request.limit,
+                vector_weight=request.vector_weight,
+                lexical_weight=request.lexical_weight,
+                filters=request.filters
+            )
         
         # Format results
         search_results = [
@@ -566,16 +4739,587 @@ async def search(request: SearchRequest):
                 content=doc["content"],
                 title=doc["title"],
                 source=doc["source"],
-                score=doc["score"]
+                score=doc["score"],
+                metadata=dict(doc.get("metadata") or {}, chunk_index=doc.get("chunk_index"))
             )
             for doc in results
         ]
         
+        if supabase_client:
+            background_tasks.add_task(
+                store_search_history,
+                request,
+                results,
+                round((time.perf_counter() - started) * 1000),
+                http_request.client.host if http_request.client else None,
+                http_request.headers.get("user-agent")
+            )
+        
         return search_results
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Search error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        release_user()
+
+# ==================== Document Versioning ====================
+
+def chunk_content_hash(content: str) -> str:
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+def chunk_signature(chunk_index: int, title: str, source: str, metadata: Dict[str, Any]) -> tuple:
+    """Stored fields besides content; a chunk whose signature changed is rewritten with its old vector"""
+    return (
+        int(chunk_index),
+        title,
+        source,
+        str(metadata.get("jurisdiction") or ""),
+        str(metadata.get("document_type") or ""),
+        str(metadata.get("legal_domain") or ""),
+        int(metadata.get("document_date") or 0)
+    )
+
+class DocumentInventory:
+    """Chunks currently stored for a document, keyed by content hash.
+    
+    Re-ingestion claims a stored chunk for every new chunk with the same
+    content; whatever is left unclaimed at the end is stale.
+    """
+    
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.by_hash: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            self.by_hash.setdefault(row["content_hash"], []).append(row)
+        self.size = len(rows)
+        self.sources = sorted({row["signature"][2] for row in rows})
+    
+    def claim(self, content_hash: str, signature: tuple) -> Optional[Dict[str, Any]]:
+        """Take a stored chunk with this content, preferring one whose other fields also match"""
+        candidates = self.by_hash.get(content_hash)
+        if not candidates:
+            return None
+        for position, row in enumerate(candidates):
+            if row["signature"] == signature:
+                return candidates.pop(position)
+        return candidates.pop()
+    
+    def unclaimed_ids(self) -> List[int]:
+        return [row["id"] for rows in self.by_hash.values() for row in rows]
+
+def inventory_row(row_id: int, content_hash: str, row: Dict[str, Any], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": int(row_id),
+        "content_hash": content_hash,
+        "signature": chunk_signature(
+            row.get("chunk_index") or 0, row.get("title") or "", row.get("source") or "", metadata
+        )
+    }
+
+def milvus_document_expr(doc_id: str, source: str) -> str:
+    # Collections created before doc_id existed can only be matched by file name
+    if "doc_id" in milvus_fields:
+        return f"doc_id == {milvus_literal(doc_id)}"
+    if not source:
+        raise RuntimeError(f"Collection {MILVUS_COLLECTION} has no doc_id field; documents can only be matched by source")
+    return f"source == {milvus_literal(source[:512])}"
+
+def query_milvus_inventory(doc_id: str, source: str) -> List[Dict[str, Any]]:
+    """Runs on the Milvus executor"""
+    has_hash = "content_hash" in milvus_fields
+    output_fields = ["id", "chunk_index", "title", "source", "content_hash" if has_hash else "content"]
+    output_fields += [field for field in MILVUS_METADATA_FIELDS if field in milvus_fields and field != "doc_id"]
+    
+    # Strong consistency so chunks written by an interrupted attempt are seen
+    iterator = get_milvus_collection().query_iterator(
+        batch_size=1000,
+        expr=milvus_document_expr(doc_id, source),
+        output_fields=output_fields,
+        consistency_level="Strong"
+    )
+    rows = []
+    try:
+        while True:
+            batch = iterator.next()
+            if not batch:
+                break
+            for row in batch:
+                content_hash = row["content_hash"] if has_hash else chunk_content_hash(row["content"])
+                rows.append(inventory_row(row["id"], content_hash, row, row))
+    finally:
+        iterator.close()
+    return rows
+
+def scan_local_inventory(doc_id: str) -> List[Dict[str, Any]]:
+    """Runs in a worker thread"""
+    store = local_vector_store
+    store.refresh()
+    with store.lock:
+        return [
+            inventory_row(
+                row["id"],
+                row.get("content_hash") or chunk_content_hash(row.get("content") or ""),
+                row,
+                row.get("metadata") or {}
+            )
+            for position, row in enumerate(store.rows)
+            if store.alive[position] and row.get("doc_id") == doc_id
+        ]
+
+async def load_document_inventory(doc_id: str, source: str) -> DocumentInventory:
+    """Chunks already stored for a document, from the primary vector store"""
+    if VECTOR_ENGINE == "local":
+        rows = await asyncio.get_running_loop().run_in_executor(None, scan_local_inventory, doc_id)
+    else:
+        rows = await run_milvus(query_milvus_inventory, doc_id, source)
+    return DocumentInventory(rows)
+
+async def fetch_chunk_vectors(chunk_ids: List[int]) -> Dict[int, List[float]]:
+    """Stored vectors by chunk id, so rewritten chunks need not be embedded again"""
+    if not chunk_ids:
+        return {}
+    
+    if VECTOR_ENGINE == "local":
+        def read():
+            store = local_vector_store
+            with store.lock:
+                return {
+                    int(chunk_id): store.matrix[store.positions[int(chunk_id)]].tolist()
+                    for chunk_id in chunk_ids if int(chunk_id) in store.positions
+                }
+        return await asyncio.get_running_loop().run_in_executor(None, read)
+    
+    if not milvus_stores_content():
+        # Milvus may only hold shortened or quantized copies
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(chunk_store.get, chunk_ids, vectors=True)
+        )
+        return {chunk_id: row["embedding"].tolist() for chunk_id, row in rows.items()}
+    
+    rows = await run_milvus(
+        get_milvus_collection().query,
+        expr=f"id in {[int(chunk_id) for chunk_id in chunk_ids]}",
+        output_fields=["id", "embedding"],
+        consistency_level="Strong"
+    )
+    return {int(row["id"]): list(row["embedding"]) for row in rows}
+
+async def delete_chunks(chunk_ids: List[int]):
+    """Remove chunks from every store that holds them"""
+    if not chunk_ids:
+        return
+    
+    if VECTOR_ENGINE != "local":
+        collection = get_milvus_collection()
+        for start in range(0, len(chunk_ids), 1000):
+            batch = [int(chunk_id) for chunk_id in chunk_ids[start:start + 1000]]
+            await run_milvus(collection.delete, f"id in {batch}")
+        if not milvus_stores_content():
+            await asyncio.get_running_loop().run_in_executor(None, chunk_store.delete, chunk_ids)
+    
+    if local_vector_store_enabled():
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, local_vector_store.delete, chunk_ids)
+        except Exception as e:
+            if VECTOR_ENGINE == "local":
+                raise
+            logger.error(f"Error deleting {len(chunk_ids)} chunks from local vector store: {e}")
+    
+    await remove_lexical_chunks(chunk_ids)
+
+class DocumentBusyError(RuntimeError):
+    """Another process is ingesting or deleting the same document"""
+
+@asynccontextmanager
+async def document_lock(doc_id: str):
+    """Serialize ingestion and deletion of one document across processes.
+    
+    The lock expires after DOCUMENT_LOCK_TTL so a crashed holder cannot block the
+    document forever; while it is held, a heartbeat keeps extending it.
+    """
+    key = f"ingest:lock:{doc_id}"
+    token = os.urandom(8).hex()
+    locked = False
+    
+    if redis_client:
+        try:
+            locked = bool(await redis_client.set(key, token, nx=True, ex=DOCUMENT_LOCK_TTL))
+        except Exception as e:
+            logger.warning(f"Could not lock document {doc_id}, continuing without a lock: {e}")
+        else:
+            if not locked:
+                raise DocumentBusyError(f"Document {doc_id} is being processed")
+    
+    heartbeat = asyncio.create_task(keep_document_lock(key, token)) if locked else None
+    try:
+        yield
+    finally:
+        if heartbeat:
+            heartbeat.cancel()
+        if locked:
+            try:
+                if (await redis_client.get(key) or b"").decode() == token:
+                    await redis_client.delete(key)
+            except Exception as e:
+                logger.warning(f"Could not release lock on document {doc_id}: {e}")
+
+async def keep_document_lock(key: str, token: str):
+    """Extend a held document lock, for as long as it is still ours"""
+    while True:
+        await asyncio.sleep(DOCUMENT_LOCK_TTL / 3)
+        try:
+            if (await redis_client.get(key) or b"").decode() != token:
+                logger.warning(f"Lost document lock {key}")
+                return
+            await redis_client.expire(key, DOCUMENT_LOCK_TTL)
+        except Exception as e:
+            logger.warning(f"Could not refresh document lock {key}: {e}")
+
+async def upsert_document_record(doc_id: str, user_id: str, title: str, source: str, chunks_count: int):
+    """Queue an upsert of the Supabase documents row; created_at is left to the column default.
+    
+    The columns and the unique constraint on document_id come from
+    supabase/migrations/002_backend_document_records.sql.
+    """
+    await supabase_writer.write("documents", {
+        "document_id": doc_id,
+        "user_id": user_id,
+        "title": title,
+        "source": source,
+        "chunks_count": chunks_count,
+        "updated_at": datetime.utcnow().isoformat()
+    })
+
+async def delete_document(doc_id: str) -> int:
+    """Delete a document's chunks, cached answers, status and Supabase row; returns chunks deleted"""
+    if VECTOR_ENGINE != "local" and not milvus_connected:
+        raise RuntimeError("Cannot delete document: Milvus not connected")
+    
+    async with document_lock(doc_id):
+        inventory = await load_document_inventory(doc_id, "")
+        chunk_ids = inventory.unclaimed_ids()
+        await delete_chunks(chunk_ids)
+        if chunk_ids and VECTOR_ENGINE != "local":
+            await run_milvus(get_milvus_collection().flush)
+        
+        await invalidate_cached_answers(inventory.sources)
+        
+        if supabase_client:
+            # A queued upsert landing after the delete would bring the row back
+            await supabase_writer.wait_idle(SUPABASE_DRAIN_TIMEOUT)
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: supabase_client.table("documents").delete().eq("document_id", doc_id).execute()
+            )
+        if redis_client:
+            await redis_client.delete(ingest_status_key(doc_id))
+    
+    logger.info(f"Deleted document {doc_id}: {len(chunk_ids)} chunks")
+    return len(chunk_ids)
+
+# ==================== Supabase Writer ====================
+
+def supabase_error_is_permanent(error: Exception) -> bool:
+    """Whether the rows themselves were refused (or could not be serialized), so sending them again cannot succeed"""
+    if isinstance(error, TypeError):
+        return True
+    code = str(getattr(error, "code", None) or "")
+    return isinstance(error, APIError) and bool(code) and not code.startswith(SUPABASE_TRANSIENT_CODES)
+
+class SupabaseWriter:
+    """Write-behind buffer turning single-row Supabase writes into bulk inserts.
+    
+    Rows are queued and flushed by one background task once batch_size rows
+    are waiting or the oldest has waited interval seconds; the supabase client
+    is synchronous, so each bulk request runs on the default executor. The
+    queue is bounded and writers wait for room when Supabase falls behind.
+    A batch that still fails after its retries is appended to this process's
+    JSONL spill file and replayed once writes succeed again, so delivery is
+    at least once. Rows PostgREST rejects outright are isolated and dropped
+    rather than holding back the rest of their batch.
+    """
+    
+    def __init__(self, batch_size: int, interval: float, queue_size: int, spill_dir: str):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue_size = queue_size
+        self.spill_dir = spill_dir
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+        self.last_replay = 0.0
+        # Tables whose upsert key turned out to have no unique constraint
+        self.row_by_row: set = set()
+        self.stats = {"written": 0, "batches": 0, "retries": 0, "spilled": 0, "replayed": 0, "rejected": 0, "lost": 0}
+    
+    def start(self):
+        if self.task is None or self.task.done():
+            self.closing = False
+            if self.queue is None:
+                self.queue = asyncio.Queue(maxsize=self.queue_size)
+            self.task = asyncio.create_task(self.run())
+    
+    async def write(self, table: str, row: Dict[str, Any]):
+        """Queue a row for bulk insert, waiting while the queue is full"""
+        self.start()
+        try:
+            await asyncio.wait_for(self.queue.put((table, row)), SUPABASE_WRITE_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Supabase has been behind for a while; keep the row on disk rather than stall the caller
+            self.spill(table, [row])
+    
+    async def wait_idle(self, timeout: float):
+        """Wait until rows queued so far have been written or spilled"""
+        if self.queue is not None and self.task is not None and not self.task.done():
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Supabase writer still has {self.queue.qsize()} rows queued after {timeout:g}s")
+    
+    async def close(self, timeout: float = SUPABASE_DRAIN_TIMEOUT):
+        """Flush what is queued; whatever cannot be written in time is spilled"""
+        if self.task is None:
+            return
+        self.closing = True
+        await self.wait_idle(timeout)
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        leftover: Dict[str, List[Dict[str, Any]]] = {}
+        while not self.queue.empty():
+            table, row = self.queue.get_nowait()
+            leftover.setdefault(table, []).append(row)
+        for table, rows in leftover.items():
+            self.spill(table, rows)
+        self.task = None
+        self.queue = None
+    
+    async def run(self):
+        while True:
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), SUPABASE_SPILL_REPLAY_INTERVAL)]
+            except asyncio.TimeoutError:
+                # Quiet spells are when rows spilled earlier, here or by an exited process, get written back
+                await self.replay()
+                continue
+            
+            try:
+                deadline = time.monotonic() + (0.0 if self.closing else self.interval)
+                while len(batch) < self.batch_size:
+                    try:
+                        if self.closing or time.monotonic() >= deadline:
+                            batch.append(self.queue.get_nowait())
+                        else:
+                            batch.append(await asyncio.wait_for(self.queue.get(), deadline - time.monotonic()))
+                    except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                        break
+                
+                await self.flush(batch)
+            except asyncio.CancelledError:
+                # Cancelled while collecting or mid-request: the rows are off the queue and may or
+                # may not have landed, so keep a copy
+                for table, row in batch:
+                    self.spill(table, [row])
+                raise
+            except Exception as e:
+                logger.error(f"Supabase writer failed on a batch of {len(batch)} rows: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+    
+    async def flush(self, batch: List[tuple[str, Dict[str, Any]]]):
+        tables: Dict[str, List[Dict[str, Any]]] = {}
+        for table, row in batch:
+            tables.setdefault(table, []).append(row)
+        
+        reachable = False
+        for table, rows in tables.items():
+            failed = await self.write_rows(table, rows, SUPABASE_WRITE_MAX_RETRIES)
+            self.spill(table, failed)
+            reachable = reachable or len(failed) < len(rows)
+        if reachable:
+            await self.replay()
+    
+    async def write_rows(self, table: str, rows: List[Dict[str, Any]], retries: int) -> List[Dict[str, Any]]:
+        """Bulk-write rows, retrying transient failures; returns the rows still unwritten"""
+        key = SUPABASE_UPSERT_KEYS.get(table)
+        if key:
+            # One upsert cannot touch the same row twice; the latest version wins
+            rows = list({row[key]: row for row in rows}.values())
+        loop = asyncio.get_running_loop()
+        
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, self.execute, table, rows)
+            except Exception as e:
+                UPSTREAM_SECONDS.labels("supabase", table).observe(time.perf_counter() - started)
+                UPSTREAM_REQUESTS.labels("supabase", table, str(getattr(e, "code", None) or "error")).inc()
+                if supabase_error_is_permanent(e):
+                    if len(rows) > 1:
+                        # Find the offending rows instead of dropping the whole batch
+                        failed = []
+                        for row in rows:
+                            failed += await self.write_rows(table, [row], 0)
+                        return failed
+                    logger.error(f"Supabase rejected a {table} row: {e}")
+                    self.stats["rejected"] += 1
+                    SUPABASE_ROWS.labels(table, "rejected").inc()
+                    return []
+                if attempt == retries:
+                    logger.warning(f"Could not write {len(rows)} {table} rows to Supabase: {e}")
+                    return rows
+                self.stats["retries"] += 1
+                await asyncio.sleep(min(0.5 * 2 ** attempt, SUPABASE_WRITE_RETRY_MAX_DELAY) * random.uniform(0.5, 1.0))
+            else:
+                UPSTREAM_SECONDS.labels("supabase", table).observe(time.perf_counter() - started)
+                UPSTREAM_REQUESTS.labels("supabase", table, "ok").inc()
+                self.stats["written"] += len(rows)
+                self.stats["batches"] += 1
+                SUPABASE_ROWS.labels(table, "written").inc(len(rows))
+                return []
+        return rows
+    
+    def execute(self, table: str, rows: List[Dict[str, Any]]):
+        """One blocking bulk request; runs on the executor"""
+        key = SUPABASE_UPSERT_KEYS.get(table)
+        if not key:
+            supabase_client.table(table).insert(rows).execute()
+            return
+        
+        if table not in self.row_by_row:
+            try:
+                supabase_client.table(table).upsert(rows, on_conflict=key).execute()
+                return
+            except APIError as e:
+                # 42P10: no unique constraint on the key, which ON CONFLICT requires
+                if e.code != "42P10":
+                    raise
+                logger.warning(f"{table}.{key} is not unique; writing {table} rows one at a time")
+                self.row_by_row.add(table)
+        
+        for row in rows:
+            changes = {column: value for column, value in row.items() if column not in (key, "user_id")}
+            updated = supabase_client.table(table).update(changes).eq(key, row[key]).execute()
+            if not updated.data:
+                supabase_client.table(table).insert(dict(row, created_at=row.get("updated_at"))).execute()
+    
+    def spill_path(self) -> str:
+        return os.path.join(self.spill_dir, f"spill-{os.getpid()}.jsonl")
+    
+    def spill(self, table: str, rows: List[Dict[str, Any]]):
+        """Append rows that could not be written to this process's spill file"""
+        if not rows:
+            return
+        path = self.spill_path()
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) >= SUPABASE_SPILL_MAX_MB * 1024 * 1024:
+                raise OSError(f"spill file is over {SUPABASE_SPILL_MAX_MB:g} MB")
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("".join(
+                    json.dumps({"table": table, "row": row}, ensure_ascii=False, default=str) + "\n" for row in rows
+                ))
+            self.stats["spilled"] += len(rows)
+            SUPABASE_ROWS.labels(table, "spilled").inc(len(rows))
+        except OSError as e:
+            logger.error(f"Lost {len(rows)} {table} rows that could not be spilled to {self.spill_dir}: {e}")
+            self.stats["lost"] += len(rows)
+            SUPABASE_ROWS.labels(table, "lost").inc(len(rows))
+    
+    def claim_spill_files(self) -> List[tuple[str, Any]]:
+        """Spill files this process may replay, each opened and locked.
+        
+        A process's own file is renamed to a .replay file before it is read, so
+        new spills start a fresh file. Other processes' files are taken over once
+        idle for a while (their process has likely exited), and .replay files
+        whose lock is free were left behind by a replay that never finished.
+        """
+        try:
+            names = sorted(os.listdir(self.spill_dir))
+        except FileNotFoundError:
+            return []
+        
+        own = os.path.basename(self.spill_path())
+        claimed = []
+        for name in names:
+            path = os.path.join(self.spill_dir, name)
+            try:
+                if name.endswith(".jsonl"):
+                    if name != own and time.time() - os.path.getmtime(path) < SUPABASE_SPILL_CLAIM_SECONDS:
+                        continue
+                    replay_path = os.path.join(self.spill_dir, f"{name[:-len('.jsonl')]}.{time.time_ns()}.replay")
+                    os.rename(path, replay_path)
+                    path = replay_path
+                elif not name.endswith(".replay"):
+                    continue
+                f = open(path, encoding="utf-8")
+            except OSError:
+                # Claimed by another process first
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            claimed.append((path, f))
+        return claimed
+    
+    async def replay(self):
+        """Write spilled rows back; stops at the first batch Supabase still refuses"""
+        if not supabase_client or time.monotonic() - self.last_replay < SUPABASE_SPILL_REPLAY_INTERVAL:
+            return
+        self.last_replay = time.monotonic()
+        
+        claimed = self.claim_spill_files()
+        for index, (path, f) in enumerate(claimed):
+            pending: Dict[str, List[Dict[str, Any]]] = {}
+            reachable = True
+            
+            async def write_back(table: str):
+                nonlocal reachable
+                rows = pending.pop(table, [])
+                if reachable:
+                    failed = await self.write_rows(table, rows, 0)
+                    reachable = not failed
+                    self.stats["replayed"] += len(rows) - len(failed)
+                    SUPABASE_ROWS.labels(table, "replayed").inc(len(rows) - len(failed))
+                    rows = failed
+                self.spill(table, rows)
+            
+            try:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    rows = pending.setdefault(entry["table"], [])
+                    rows.append(entry["row"])
+                    if len(rows) >= self.batch_size:
+                        await write_back(entry["table"])
+                for table in list(pending):
+                    await write_back(table)
+                os.remove(path)
+            finally:
+                f.close()
+            logger.info(f"Replayed Supabase spill file {os.path.basename(path)}" if reachable else
+                        f"Supabase still unavailable; spilled rows from {os.path.basename(path)} kept for later")
+            if not reachable:
+                # Unlocked files are claimed again on the next attempt
+                for _, other in claimed[index + 1:]:
+                    other.close()
+                break
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self.stats, queued=self.queue.qsize() if self.queue else 0)
+
+supabase_writer = SupabaseWriter(
+    SUPABASE_WRITE_BATCH_SIZE, SUPABASE_WRITE_INTERVAL, SUPABASE_WRITE_QUEUE_SIZE, SUPABASE_SPILL_DIR
+)
 
 # ==================== Background Tasks ====================
 
@@ -587,87 +5331,659 @@ async def store_chat_history(
     context_id: str,
     model_used: str
 ):
-    """Store chat history in Supabase"""
+    """Queue a chat history row for Supabase"""
     try:
         if not supabase_client:
             return
         
-        supabase_client.table("chat_history").insert({
-            "user_id": user_id,
-            "message": message,
-            "response": response,
-            "sources": json.dumps(sources),
-            "context_id": context_id,
-            "model_used": model_used,
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
+        with observe_stage("history_write"):
+            await supabase_writer.write("chat_history", {
+                "user_id": user_id,
+                "message": message,
+                "response": response,
+                "sources": json.dumps(sources),
+                "context_id": context_id,
+                "model_used": model_used,
+                "created_at": datetime.utcnow().isoformat()
+            })
         
-        logger.info(f"Stored chat history for context {context_id}")
+        logger.info(f"Queued chat history for context {context_id}")
         
     except Exception as e:
         logger.error(f"Error storing chat history: {e}")
 
-async def process_document_chunks(
+async def store_search_history(
+    request: SearchRequest,
+    results: List[Dict],
+    execution_time_ms: int,
+    client_host: Optional[str],
+    user_agent: Optional[str]
+):
+    """Queue a search_history row for Supabase"""
+    # search_history.user_id references users(id), so other identifiers only go into metadata
+    try:
+        user_id = str(uuid.UUID(request.user_id)) if request.user_id else None
+    except ValueError:
+        user_id = None
+    try:
+        ip_address = str(ipaddress.ip_address(client_host)) if client_host else None
+    except ValueError:
+        ip_address = None
+    
+    try:
+        await supabase_writer.write("search_history", {
+            "user_id": user_id,
+            "query": request.query,
+            "results": [
+                {
+                    "title": doc.get("title"),
+                    "source": doc.get("source"),
+                    "chunk_index": doc.get("chunk_index"),
+                    "score": float(doc.get("score") or 0.0)
+                }
+                for doc in results
+            ],
+            "filters": request.filters or {},
+            "result_count": len(results),
+            "execution_time_ms": execution_time_ms,
+            "metadata": {
+                "user_id": request.user_id,
+                "limit": request.limit,
+                "vector_weight": request.vector_weight,
+                "lexical_weight": request.lexical_weight,
+                "vector_engine": VECTOR_ENGINE
+            },
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "created_at": datetime.utcnow().isoformat()
+        })
+    except Exception as e:
+        logger.error(f"Error storing search history: {e}")
+
+async def insert_milvus_chunks(
+    embeddings: List[List[float]],
+    contents: List[str],
+    titles: List[str],
+    sources: List[str],
+    chunk_indices: List[int],
+    timestamps: List[int],
+    content_hashes: List[str],
+    doc_id: str,
+    metadata: Dict[str, Any],
+    flush: bool = True
+) -> List[int]:
+    """Insert prepared chunk columns into Milvus and return their primary keys"""
+    collection = get_milvus_collection()
+    ids = None if milvus_auto_id else await allocate_chunk_ids(len(embeddings))
+    
+    if not milvus_stores_content():
+        if ids is None:
+            raise RuntimeError(f"Collection {MILVUS_COLLECTION} keeps text in the chunk store but assigns its own ids")
+        # Written first: a chunk stored here but missing from Milvus is never returned
+        await asyncio.get_running_loop().run_in_executor(None, chunk_store.put, ids, contents, embeddings)
+    
+    # Column order follows the collection schema; older collections lack metadata fields
+    columns = [milvus_vectors(embeddings)]
+    if milvus_stores_content():
+        columns.append(contents)
+    columns += [
+        titles,
+        sources,
+        chunk_indices,
+        timestamps
+    ]
+    if set(MILVUS_METADATA_FIELDS) <= milvus_fields:
+        columns += [
+            [doc_id] * len(embeddings),
+            [str(metadata.get("jurisdiction") or "")[:64]] * len(embeddings),
+            [str(metadata.get("document_type") or "")[:64]] * len(embeddings),
+            [str(metadata.get("legal_domain") or "")[:128]] * len(embeddings),
+            [int(metadata.get("document_date") or 0)] * len(embeddings)
+        ]
+    if "content_hash" in milvus_fields:
+        columns.append(content_hashes)
+    if ids is not None:
+        columns.insert(0, ids)
+    
+    insert_result = await run_milvus(collection.insert, columns)
+    if flush:
+        await run_milvus(collection.flush)
+    
+    return list(insert_result.primary_keys)
+
+def build_local_documents(
+    contents: List[str],
+    titles: List[str],
+    sources: List[str],
+    chunk_indices: List[int],
+    content_hashes: List[str],
+    doc_id: str,
+    metadata: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Sidecar records for the local vector store"""
+    chunk_metadata = {
+        "jurisdiction": metadata.get("jurisdiction") or "",
+        "document_type": metadata.get("document_type") or "",
+        "legal_domain": metadata.get("legal_domain") or "",
+        "document_date": int(metadata.get("document_date") or 0)
+    }
+    return [
+        {
+            "content": content,
+            "title": title,
+            "source": source,
+            "chunk_index": chunk_index,
+            "content_hash": content_hash,
+            "doc_id": doc_id,
+            "metadata": chunk_metadata
+        }
+        for content, title, source, chunk_index, content_hash in zip(
+            contents, titles, sources, chunk_indices, content_hashes
+        )
+    ]
+
+async def store_chunk_window(
     chunks: List[str],
+    first_index: int,
     doc_id: str,
     title: str,
     source: str,
-    user_id: Optional[str]
-):
-    """Process and store document chunks in Milvus"""
-    try:
-        if not milvus_connected:
-            logger.error("Cannot process document: Milvus not connected")
-            return
+    metadata: Dict[str, Any],
+    inventory: DocumentInventory
+) -> Dict[str, Any]:
+    """Store one window of consecutive chunks, embedding only content not already stored.
+    
+    Returns counts plus the ids of stored chunks this window replaced.
+    """
+    counts = {"unchanged": 0, "embedded": 0, "inserted": 0, "failed": 0, "replaced": []}
+    signature_source = (title[:512], source[:512])
+    
+    # Chunks whose content is stored keep their vector; only their other fields may need rewriting
+    pending: List[tuple[int, str, str]] = []
+    reused: Dict[int, int] = {}
+    for i, chunk in enumerate(chunks, start=first_index):
+        content = chunk[:65535]  # Truncate to max length
+        content_hash = chunk_content_hash(content)
+        stored = inventory.claim(content_hash, chunk_signature(i, *signature_source, metadata))
+        if stored is None:
+            pending.append((i, content, content_hash))
+        elif stored["signature"] == chunk_signature(i, *signature_source, metadata):
+            counts["unchanged"] += 1
+        else:
+            pending.append((i, content, content_hash))
+            reused[i] = stored["id"]
+    
+    with observe_stage("vector_fetch", "ingest"):
+        vectors = await fetch_chunk_vectors(list(reused.values()))
+    to_embed = [content for i, content, _ in pending if reused.get(i) not in vectors]
+    with observe_stage("embedding", "ingest"):
+        new_embeddings = iter(await generate_embeddings_batch(to_embed) if to_embed else [])
+    
+    # Prepare data for insertion
+    embeddings = []
+    contents = []
+    titles = []
+    sources = []
+    chunk_indices = []
+    timestamps = []
+    content_hashes = []
+    
+    for i, content, content_hash in pending:
+        if reused.get(i) in vectors:
+            embedding = vectors[reused[i]]
+        else:
+            embedding = next(new_embeddings)
+            if embedding is None:
+                counts["failed"] += 1
+                continue
+            counts["embedded"] += 1
+        if i in reused:
+            counts["replaced"].append(reused[i])
+        
+        embeddings.append(embedding)
+        contents.append(content)
+        titles.append(title[:512])
+        sources.append(source[:512])
+        chunk_indices.append(i)
+        timestamps.append(int(datetime.utcnow().timestamp()))
+        content_hashes.append(content_hash)
+    
+    await update_ingest_status(doc_id, increments={
+        "chunks_unchanged": counts["unchanged"],
+        "chunks_embedded": counts["embedded"],
+        "chunks_failed": counts["failed"]
+    })
+    
+    if counts["failed"]:
+        logger.error(f"Document {doc_id}: {counts['failed']} of {len(to_embed)} chunks could not be embedded")
+    
+    if not embeddings:
+        return counts
+    
+    with observe_stage("vector_insert", "ingest"):
+        if VECTOR_ENGINE == "local":
+            chunk_ids = await add_local_vectors(
+                embeddings,
+                build_local_documents(contents, titles, sources, chunk_indices, content_hashes, doc_id, metadata)
+            )
+        else:
+            # Flushed once per document by the caller
+            chunk_ids = await insert_milvus_chunks(
+                embeddings, contents, titles, sources, chunk_indices, timestamps, content_hashes,
+                doc_id, metadata, flush=False
+            )
+            if VECTOR_ENGINE == "auto":
+                # Mirror into the embedded store so searches survive a Milvus outage
+                try:
+                    await add_local_vectors(
+                        embeddings,
+                        build_local_documents(contents, titles, sources, chunk_indices, content_hashes, doc_id, metadata),
+                        chunk_ids
+                    )
+                except Exception as e:
+                    logger.error(f"Error mirroring document {doc_id} to local vector store: {e}")
+    
+    counts["inserted"] = len(chunk_ids)
+    await update_ingest_status(doc_id, increments={"chunks_inserted": len(chunk_ids)})
+    
+    # Keep the BM25 index in step with the vector store
+    with observe_stage("lexical_index", "ingest"):
+        await index_lexical_chunks(chunk_ids, contents, sources)
+    
+    return counts
+
+async def process_document_chunks(
+    chunks: Iterable[str],
+    doc_id: str,
+    title: str,
+    source: str,
+    user_id: Optional[str],
+    metadata: Optional[Dict[str, Any]] = None,
+    window_size: int = INGEST_WINDOW_CHUNKS,
+    flush: bool = True
+) -> Dict[str, int]:
+    """Process and store document chunks in Milvus.
+    
+    chunks may be a lazy iterator; it is consumed window_size chunks at a
+    time off the event loop, so memory stays flat however long the document is.
+    Re-ingesting a document only embeds chunks whose content is new and then
+    deletes stored chunks that no longer occur, which also makes retries of an
+    interrupted attempt cheap. Bulk loaders pass flush=False and flush once per
+    batch of documents. Raises on failure; returns chunk counts.
+    """
+    if VECTOR_ENGINE != "local" and not milvus_connected:
+        raise RuntimeError("Cannot process document: Milvus not connected")
+    
+    metadata = metadata or {}
+    if VECTOR_ENGINE != "local":
+        # Long-lived workers pick up a collection switched by milvus_reindex.py
+        await run_milvus(describe_milvus_collection, get_milvus_collection())
+    
+    async with document_lock(doc_id):
+        inventory = await load_document_inventory(doc_id, source)
+        await update_ingest_status(
+            doc_id,
+            state="processing",
+            chunks_processed=0,
+            chunks_unchanged=0,
+            chunks_embedded=0,
+            chunks_inserted=0,
+            chunks_failed=0,
+            chunks_deleted=0
+        )
         
-        collection = Collection("legal_documents")
-        
-        # Prepare data for insertion
-        embeddings = []
-        contents = []
-        titles = []
-        sources = []
-        chunk_indices = []
-        timestamps = []
-        
-        for i, chunk in enumerate(chunks):
-            # Generate embedding using OpenRouter
-            embedding = await generate_embedding_openrouter(chunk)
-            
-            embeddings.append(embedding)
-            contents.append(chunk[:65535])  # Truncate to max length
-            titles.append(title[:512])
-            sources.append(source[:512])
-            chunk_indices.append(i)
-            timestamps.append(int(datetime.utcnow().timestamp()))
-        
-        # Insert into Milvus
-        collection.insert([
-            embeddings,
-            contents,
-            titles,
-            sources,
-            chunk_indices,
-            timestamps
-        ])
-        
-        collection.flush()
+        chunk_iterator = iter(chunks)
+        chunks_seen = 0
+        totals = {"unchanged": 0, "inserted": 0, "failed": 0}
+        stale_ids: List[int] = []
         
-        # Store metadata in Supabase
-        if supabase_client and user_id:
-            supabase_client.table("documents").insert({
-                "document_id": doc_id,
-                "user_id": user_id,
-                "title": title,
-                "source": source,
-                "chunks_count": len(chunks),
-                "created_at": datetime.utcnow().isoformat()
-            }).execute()
+        while True:
+            # Extraction and chunking are lazy, so they run as each window is pulled
+            with observe_stage("extraction", "ingest"):
+                window = await asyncio.to_thread(next_chunk_window, chunk_iterator, window_size)
+            if not window:
+                break
+            counts = await store_chunk_window(window, chunks_seen, doc_id, title, source, metadata, inventory)
+            for name in totals:
+                totals[name] += counts[name]
+            stale_ids += counts["replaced"]
+            chunks_seen += len(window)
+            await update_ingest_status(doc_id, chunks_processed=chunks_seen)
+        
+        if totals["failed"]:
+            INGEST_CHUNKS.labels("failed").inc(totals["failed"])
+            # Keep the previous version's chunks so nothing goes missing; a retry re-embeds only the failures
+            raise RuntimeError(f"{totals['failed']} of {chunks_seen} chunks could not be embedded")
         
-        logger.info(f"Processed document {doc_id}: {len(chunks)} chunks")
+        stale_ids += inventory.unclaimed_ids()
+        with observe_stage("delete", "ingest"):
+            await delete_chunks(stale_ids)
+        await update_ingest_status(doc_id, chunks_deleted=len(stale_ids))
         
+        if totals["inserted"] or stale_ids:
+            if flush and VECTOR_ENGINE != "local":
+                with observe_stage("flush", "ingest"):
+                    await run_milvus(get_milvus_collection().flush)
+            
+            # Answers built from an earlier version of this source are now stale
+            await invalidate_cached_answers(sorted(set(inventory.sources) | {source[:512]}))
+        
+        # Store metadata in Supabase
+        if supabase_client and user_id:
+            with observe_stage("document_record", "ingest"):
+                await upsert_document_record(doc_id, user_id, title, source, totals["unchanged"] + totals["inserted"])
+    
+    await update_ingest_status(doc_id, state="completed")
+    INGEST_CHUNKS.labels("unchanged").inc(totals["unchanged"])
+    INGEST_CHUNKS.labels("inserted").inc(totals["inserted"])
+    INGEST_CHUNKS.labels("deleted").inc(len(stale_ids))
+    logger.info(
+        f"Processed document {doc_id}: {chunks_seen} chunks, {totals['unchanged']} unchanged, "
+        f"{totals['inserted']} inserted, {len(stale_ids)} deleted"
+    )
+    return {
+        "chunks": chunks_seen,
+        "unchanged": totals["unchanged"],
+        "inserted": totals["inserted"],
+        "deleted": len(stale_ids)
+    }
+
+def remove_spool_file(path: str):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove upload spool file {path}: {e}")
+
+async def process_uploaded_file(
+    upload_path: str,
+    file_ext: str,
+    doc_id: str,
+    title: str,
+    source: str,
+    user_id: Optional[str],
+    metadata: Dict[str, Any]
+):
+    """In-process fallback when the ingestion queue is unavailable"""
+    try:
+        chunks = chunk_legal_text(iter_document_lines(upload_path, file_ext, source))
+        await process_document_chunks(chunks, doc_id, title, source, user_id, metadata)
     except Exception as e:
         logger.error(f"Error processing document chunks: {e}")
+        await update_ingest_status(doc_id, state="failed", error=str(e) or type(e).__name__)
+    finally:
+        remove_spool_file(upload_path)
+
+# ==================== Ingestion Queue ====================
+
+def ingest_status_key(doc_id: str) -> str:
+    return f"ingest:status:{doc_id}"
+
+async def update_ingest_status(doc_id: str, increments: Optional[Dict[str, int]] = None, **fields):
+    """Record ingestion progress for the status endpoint; best effort"""
+    if not redis_client:
+        return
+    
+    try:
+        key = ingest_status_key(doc_id)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(key, mapping={
+            **{name: str(value) for name, value in fields.items()},
+            "updated_at": datetime.utcnow().isoformat()
+        })
+        for name, amount in (increments or {}).items():
+            pipe.hincrby(key, name, amount)
+        pipe.expire(key, INGEST_STATUS_TTL)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not update ingestion status of {doc_id}: {e}")
+
+async def get_ingest_status(doc_id: str) -> Dict[str, str]:
+    status = await redis_client.hgetall(ingest_status_key(doc_id))
+    return {name.decode(): value.decode() for name, value in status.items()}
+
+async def ingest_worker_heartbeat(name: str, stop: asyncio.Event):
+    """Announce a running worker so the API knows queued jobs will be consumed"""
+    while not stop.is_set():
+        try:
+            await redis_client.zadd(INGEST_WORKERS_KEY, {name: time.time()})
+        except Exception as e:
+            logger.warning(f"Could not record heartbeat of ingestion worker {name}: {e}")
+        try:
+            await asyncio.wait_for(stop.wait(), INGEST_WORKER_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+    try:
+        await redis_client.zrem(INGEST_WORKERS_KEY, name)
+    except Exception:
+        pass
+
+async def count_ingest_workers() -> int:
+    """Workers that sent a heartbeat recently; stale entries are pruned"""
+    cutoff = time.time() - INGEST_WORKER_LIVE_SECONDS
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zremrangebyscore(INGEST_WORKERS_KEY, "-inf", cutoff)
+    pipe.zcard(INGEST_WORKERS_KEY)
+    _, workers = await pipe.execute()
+    return workers
+
+async def enqueue_ingest_job(job: Dict[str, Any]) -> bool:
+    """Add an ingestion job to the durable queue; False if Redis can't take it or no worker is running"""
+    if not redis_client or not INGEST_QUEUE_ENABLED:
+        return False
+    
+    try:
+        # Jobs queued with nobody to consume them would wait indefinitely
+        if not await count_ingest_workers():
+            logger.warning(f"No ingestion worker is running; processing document {job['doc_id']} in-process")
+            return False
+        
+        await update_ingest_status(
+            job["doc_id"],
+            state="queued",
+            filename=job["source"],
+            queued_at=datetime.utcnow().isoformat(),
+            chunks_processed=0,
+            chunks_unchanged=0,
+            chunks_embedded=0,
+            chunks_inserted=0,
+            chunks_failed=0,
+            chunks_deleted=0,
+            attempts=0,
+            error=""
+        )
+        await redis_client.xadd(INGEST_STREAM, {"job": json.dumps(job)})
+        return True
+    except Exception as e:
+        logger.error(f"Could not enqueue document {job['doc_id']}: {e}")
+        return False
+
+async def ensure_ingest_group():
+    try:
+        await redis_client.xgroup_create(INGEST_STREAM, INGEST_GROUP, id="0", mkstream=True)
+    except aioredis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+async def keep_ingest_claim(entry_id: bytes, consumer: str):
+    """Reset the idle time of a job being processed so other workers don't reclaim it"""
+    while True:
+        await asyncio.sleep(INGEST_CLAIM_IDLE_MS / 3000)
+        try:
+            await redis_client.xclaim(INGEST_STREAM, INGEST_GROUP, consumer, 0, [entry_id], justid=True)
+        except Exception as e:
+            logger.warning(f"Could not refresh claim on ingestion job {entry_id!r}: {e}")
+
+async def handle_ingest_job(entry_id: bytes, fields: Dict[bytes, bytes], consumer: str):
+    """Run one queued job; acknowledge on success or once it is dead-lettered"""
+    job = json.loads(fields[b"job"])
+    doc_id = job["doc_id"]
+    attempts = await redis_client.hincrby(ingest_status_key(doc_id), "attempts", 1)
+    
+    heartbeat = asyncio.create_task(keep_ingest_claim(entry_id, consumer))
+    try:
+        await update_ingest_status(doc_id, state="processing", worker=consumer, error="")
+        chunks = chunk_legal_text(iter_document_lines(job["path"], job["file_ext"], job["source"]))
+        await process_document_chunks(
+            chunks, doc_id, job["title"], job["source"], job.get("user_id"), job.get("metadata")
+        )
+    except DocumentBusyError as e:
+        # Not the job's fault: retry once the other run releases the document
+        logger.info(f"{e}; retrying ingestion of {doc_id} later")
+        await redis_client.hincrby(ingest_status_key(doc_id), "attempts", -1)
+        await update_ingest_status(doc_id, state="queued")
+        return
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        if attempts < INGEST_MAX_ATTEMPTS:
+            # Left pending: after INGEST_CLAIM_IDLE_MS any worker reclaims and retries it
+            logger.warning(f"Ingestion of {doc_id} failed (attempt {attempts}/{INGEST_MAX_ATTEMPTS}): {error}")
+            await update_ingest_status(doc_id, state="retrying", error=error)
+            return
+        
+        logger.error(f"Ingestion of {doc_id} failed {attempts} times, moving it to {INGEST_DEAD_LETTER_STREAM}: {error}")
+        await redis_client.xadd(INGEST_DEAD_LETTER_STREAM, {
+            "job": fields[b"job"],
+            "error": error,
+            "attempts": attempts,
+            "failed_at": datetime.utcnow().isoformat()
+        })
+        await update_ingest_status(doc_id, state="failed", error=error)
+    else:
+        remove_spool_file(job["path"])
+    finally:
+        heartbeat.cancel()
+    
+    await redis_client.xack(INGEST_STREAM, INGEST_GROUP, entry_id)
+    await redis_client.xdel(INGEST_STREAM, entry_id)
+
+async def consume_ingest_jobs(consumer: str, stop: asyncio.Event):
+    """Worker loop: reclaim stalled or failed jobs first, then read new ones"""
+    await ensure_ingest_group()
+    logger.info(f"Ingestion consumer {consumer} started on {INGEST_STREAM}")
+    
+    while not stop.is_set():
+        try:
+            _, entries, *_ = await redis_client.xautoclaim(
+                INGEST_STREAM, INGEST_GROUP, consumer, INGEST_CLAIM_IDLE_MS, start_id="0-0", count=1
+            )
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+            if not entries:
+                response = await redis_client.xreadgroup(
+                    INGEST_GROUP, consumer, {INGEST_STREAM: ">"}, count=1, block=INGEST_BLOCK_MS
+                )
+                entries = response[0][1] if response else []
+            
+            for entry_id, fields in entries:
+                await handle_ingest_job(entry_id, fields, consumer)
+                
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ingestion consumer {consumer} error: {e}")
+            await asyncio.sleep(1)
+    
+    logger.info(f"Ingestion consumer {consumer} stopped")
+
+async def get_ingest_queue_stats() -> Dict[str, Any]:
+    """Backlog and dead-letter sizes for /health and /metrics"""
+    if not redis_client or not INGEST_QUEUE_ENABLED:
+        return {"enabled": False}
+    try:
+        queued, dead_letters, workers = await asyncio.gather(
+            redis_client.xlen(INGEST_STREAM),
+            redis_client.xlen(INGEST_DEAD_LETTER_STREAM),
+            count_ingest_workers()
+        )
+        return {"enabled": True, "queued": queued, "dead_letters": dead_letters, "workers": workers}
+    except Exception:
+        return {"enabled": True, "queued": None, "dead_letters": None, "workers": None}
+
+def validate_upload_type(file: UploadFile) -> str:
+    allowed_types = ['.pdf', '.txt', '.docx', '.md']
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    if file_ext not in allowed_types:
+        raise HTTPException(
+            status_code=400,
+            detail=f"File type {file_ext} not supported. Allowed: {allowed_types}"
+        )
+    return file_ext
+
+def upload_metadata(
+    jurisdiction: Optional[str],
+    document_type: Optional[str],
+    legal_domain: Optional[str],
+    document_date: Optional[str]
+) -> Dict[str, Any]:
+    """Filterable metadata stored with every chunk"""
+    try:
+        return {
+            "jurisdiction": jurisdiction or "",
+            "document_type": document_type or "",
+            "legal_domain": legal_domain or "",
+            "document_date": parse_document_date(document_date) if document_date else 0
+        }
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid document_date: {document_date}")
+
+async def queue_document(
+    background_tasks: BackgroundTasks,
+    file: UploadFile,
+    file_ext: str,
+    doc_id: Optional[str],
+    title: Optional[str],
+    user_id: Optional[str],
+    metadata: Dict[str, Any]
+) -> DocumentUploadResponse:
+    """Spool an upload to disk and queue it for ingestion; without a doc_id the content's hash is used"""
+    # Spool the upload to disk in blocks instead of reading it into memory
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    fd, upload_path = tempfile.mkstemp(prefix=f"{doc_id or 'upload'}-", suffix=file_ext, dir=UPLOAD_DIR)
+    size = 0
+    digest = hashlib.md5()
+    try:
+        with os.fdopen(fd, "wb") as spool:
+            while True:
+                block = await file.read(UPLOAD_READ_SIZE)
+                if not block:
+                    break
+                spool.write(block)
+                digest.update(block)
+                size += len(block)
+    except Exception:
+        os.remove(upload_path)
+        raise
+    doc_id = doc_id or digest.hexdigest()
+    
+    # Workers pick the job up from the durable queue; without Redis or a live worker, ingest in-process
+    job = {
+        "doc_id": doc_id,
+        "path": upload_path,
+        "file_ext": file_ext,
+        "title": title or file.filename,
+        "source": file.filename,
+        "user_id": user_id,
+        "metadata": metadata
+    }
+    if not await enqueue_ingest_job(job):
+        await update_ingest_status(doc_id, state="queued", filename=file.filename)
+        background_tasks.add_task(
+            process_uploaded_file,
+            upload_path,
+            file_ext,
+            doc_id,
+            job["title"],
+            file.filename,
+            user_id,
+            metadata
+        )
+    
+    # Chunking happens while the document is read back, so the count isn't known yet;
+    # progress is reported by /api/documents/{document_id}/status
+    return DocumentUploadResponse(
+        success=True,
+        document_id=doc_id,
+        message=f"Document queued for processing: {size} bytes"
+    )
 
 # ==================== Error Handlers ====================
 
@@ -679,7 +5995,8 @@ async def http_exception_handler(request, exc):
             "error": exc.detail,
             "status_code": exc.status_code,
             "timestamp": datetime.utcnow().isoformat()
-        }
+        },
+        headers=exc.headers  # Retry-After on 429 and 503
     )
 
 @app.exception_handler(Exception)
@@ -0,0 +1,294 @@
+"""
+Milvus Re-index
+Rebuilds the legal_documents collection with another index type, metric or build parameters,
+or another vector layout (fewer dimensions, quantized vectors, text in the chunk store),
+while the API keeps serving: rows are copied (ids preserved) into a new collection, caught up,
+and the legal_documents alias is switched to it. Run it where CHUNK_STORE_PATH is the store
+the API uses (e.g. docker compose exec rag-api python milvus_reindex.py ...)
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+import redis
+from pymilvus import connections, utility, Collection, CollectionSchema, DataType, FieldSchema
+
+from main import (
+    milvus_index_params,
+    milvus_collection_schema,
+    vector_index_params,
+    fit_dimensions,
+    chunk_store,
+    EMBEDDING_DIM,
+    VECTOR_ENGINE,
+    MILVUS_COLLECTION,
+    MILVUS_ID_COUNTER_KEY,
+    logger
+)
+
+Converter = Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]
+
+def resolve_collection(name: str) -> str:
+    """Real collection behind name, which is either a collection or (after a migration) an alias"""
+    collections = utility.list_collections()
+    if name in collections:
+        return name
+    for candidate in collections:
+        if name in utility.list_aliases(candidate):
+            return candidate
+    raise SystemExit(f"No collection or alias named {name}")
+
+def clone_schema(source: Collection) -> CollectionSchema:
+    """Same fields, but with caller-assigned primary keys so chunk ids survive the copy"""
+    fields = [
+        FieldSchema(
+            name=field.name,
+            dtype=field.dtype,
+            description=field.description,
+            is_primary=field.is_primary,
+            auto_id=False,
+            is_partition_key=getattr(field, "is_partition_key", False),
+            **field.params
+        )
+        for field in source.schema.fields
+    ]
+    return CollectionSchema(fields=fields, description=source.schema.description)
+
+def vector_field(collection: Collection) -> FieldSchema:
+    return next(field for field in collection.schema.fields if field.name == "embedding")
+
+def layout_converter(source: Collection, target: Collection) -> Converter:
+    """Rewrite source rows for the target's vector field, moving text into the chunk store if needed.
+
+    Full-precision vectors come from the source row, or from the chunk store when the source keeps
+    its text (and vectors) there. Fewer dimensions are taken by truncating and renormalizing, which
+    matches the embedding API's dimensions parameter for the text-embedding-3 models only.
+    """
+    source_fields = {field.name for field in source.schema.fields}
+    target_fields = {field.name for field in target.schema.fields}
+    field = vector_field(target)
+    dim = int(field.params["dim"])
+    binary = field.dtype == DataType.BINARY_VECTOR
+
+    def convert(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        ids = [int(row["id"]) for row in rows]
+        stored = chunk_store.get(ids, vectors=True) if "content" not in source_fields else {}
+        converted, contents, vectors = [], [], []
+        for row in rows:
+            if "content" in source_fields:
+                content, vector = row["content"], np.asarray(row["embedding"], dtype=np.float32)
+            elif int(row["id"]) in stored:
+                content, vector = stored[int(row["id"])]["content"], stored[int(row["id"])]["embedding"]
+            else:
+                logger.warning(f"Chunk {row['id']} is missing from the chunk store, skipping it")
+                continue
+            vector = fit_dimensions(vector, dim)
+            new_row = {key: value for key, value in row.items() if key in target_fields}
+            new_row["embedding"] = np.packbits(vector > 0).tobytes() if binary else vector.tolist()
+            if "content" in target_fields:
+                new_row["content"] = content
+            else:
+                contents.append(content)
+                vectors.append(vector)
+            converted.append(new_row)
+        if "content" not in target_fields:
+            chunk_store.put([row["id"] for row in converted], contents, vectors)
+        return converted
+
+    return convert
+
+def collect_ids(collection: Collection, batch_size: int) -> Set[int]:
+    iterator = collection.query_iterator(batch_size=batch_size, expr="id >= 0", output_fields=["id"], consistency_level="Strong")
+    ids = set()
+    while True:
+        rows = iterator.next()
+        if not rows:
+            break
+        ids.update(int(row["id"]) for row in rows)
+    iterator.close()
+    return ids
+
+def batched(items: List[int], size: int) -> Iterable[List[int]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def copy_all(source: Collection, target: Collection, batch_size: int, convert: Converter) -> int:
+    """Stream every row, embedding included, from source into target"""
+    iterator = source.query_iterator(
+        batch_size=batch_size,
+        expr="id >= 0",
+        output_fields=[field.name for field in source.schema.fields]
+    )
+    copied = 0
+    started = time.perf_counter()
+    while True:
+        rows = iterator.next()
+        if not rows:
+            break
+        target.insert(convert([dict(row) for row in rows]))
+        copied += len(rows)
+        if copied % (batch_size * 50) < batch_size:
+            logger.info(f"Copied {copied} rows ({copied / (time.perf_counter() - started):.0f} rows/s)")
+    iterator.close()
+    target.flush()
+    return copied
+
+def sync_collections(
+    source: Collection,
+    target: Collection,
+    batch_size: int,
+    convert: Converter,
+    copy_after: Optional[int] = None,
+    keep_from: Optional[int] = None
+) -> int:
+    """Copy rows target lacks and delete rows source no longer has; returns the largest source id.
+
+    copy_after limits copying to ids above it and keep_from protects ids from it upwards,
+    for the final pass after the switch, when target takes writes of its own.
+    """
+    source_ids = collect_ids(source, batch_size)
+    target_ids = collect_ids(target, batch_size)
+    missing = sorted(row_id for row_id in source_ids - target_ids if copy_after is None or row_id > copy_after)
+    extra = sorted(row_id for row_id in target_ids - source_ids if keep_from is None or row_id < keep_from)
+
+    output_fields = [field.name for field in source.schema.fields]
+    for ids in batched(missing, batch_size):
+        rows = source.query(expr=f"id in {ids}", output_fields=output_fields, consistency_level="Strong")
+        if rows:
+            target.insert(convert([dict(row) for row in rows]))
+    for ids in batched(extra, batch_size):
+        target.delete(expr=f"id in {ids}")
+    target.flush()
+
+    logger.info(f"Synced {source.name} -> {target.name}: {len(missing)} copied, {len(extra)} deleted")
+    return max(source_ids | target_ids, default=0)
+
+def seed_id_counter(client: Optional[redis.Redis], max_id: int) -> int:
+    """Start the chunk id counter above every copied id; returns the first id it will hand out"""
+    if client is None:
+        return max_id + 1
+    with client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(MILVUS_ID_COUNTER_KEY)
+                current = int(pipe.get(MILVUS_ID_COUNTER_KEY) or 0)
+                pipe.multi()
+                pipe.set(MILVUS_ID_COUNTER_KEY, max(current, max_id))
+                pipe.execute()
+                return max(current, max_id) + 1
+            except redis.WatchError:
+                continue
+
+def switch_alias(current: str, target: Collection) -> Collection:
+    """Point MILVUS_COLLECTION at target and return the collection it used to name"""
+    if current == MILVUS_COLLECTION:
+        # First migration: the name belongs to a real collection, which has to make way for the alias
+        retired = f"{MILVUS_COLLECTION}_retired_{int(time.time())}"
+        utility.rename_collection(MILVUS_COLLECTION, retired)
+        utility.create_alias(target.name, MILVUS_COLLECTION)
+        return Collection(retired)
+    utility.alter_alias(target.name, MILVUS_COLLECTION)
+    return Collection(current)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index-type", default=os.getenv("MILVUS_INDEX_TYPE", "HNSW").upper(), help="HNSW, IVF_FLAT, IVF_SQ8 or IVF_PQ")
+    parser.add_argument("--metric", default=os.getenv("MILVUS_METRIC_TYPE", "COSINE").upper(), help="COSINE, IP or L2")
+    parser.add_argument("--index-params", help="JSON build parameters, e.g. '{\"M\": 32, \"efConstruction\": 256}'")
+    parser.add_argument("--dimensions", type=int, help="Shorten vectors to this many dimensions (text-embedding-3 models only)")
+    parser.add_argument("--quantization", choices=["none", "scalar", "binary"], help="Vector layout; scalar builds IVF_SQ8, binary stores sign bits")
+    parser.add_argument("--content", choices=["milvus", "chunk-store"], help="Where chunk text is kept")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--target", help="Resume with a collection built by an earlier --no-switch run instead of copying again")
+    parser.add_argument("--no-switch", action="store_true", help="Build and load the new collection but leave the alias alone, e.g. to run tune_index.py on it")
+    parser.add_argument("--drop-old", action="store_true", help="Drop the previous collection after switching")
+    args = parser.parse_args()
+
+    connections.connect(
+        alias="default",
+        host=os.getenv("MILVUS_HOST", "milvus-standalone"),
+        port=int(os.getenv("MILVUS_PORT", "19530"))
+    )
+    current = resolve_collection(MILVUS_COLLECTION)
+    source = Collection(current)
+    source.load()
+
+    if args.target:
+        target = Collection(args.target)
+    else:
+        if args.dimensions or args.quantization or args.content:
+            source_vector = vector_field(source)
+            quantization = args.quantization or ("binary" if source_vector.dtype == DataType.BINARY_VECTOR else "none")
+            schema = milvus_collection_schema(
+                dim=args.dimensions or int(source_vector.params["dim"]),
+                quantization=quantization,
+                store_content=(args.content or ("milvus" if "content" in {field.name for field in source.schema.fields} else "chunk-store")) == "milvus"
+            )
+            index_params = vector_index_params(quantization) if quantization != "none" else None
+        else:
+            schema = clone_schema(source)
+            index_params = None
+        index_params = index_params or milvus_index_params(
+            args.index_type,
+            args.metric,
+            json.loads(args.index_params) if args.index_params else None
+        )
+        name = f"{MILVUS_COLLECTION}_{int(time.time())}"
+        partitioned = any(getattr(field, "is_partition_key", False) for field in source.schema.fields)
+        target = Collection(
+            name=name,
+            schema=schema,
+            **({"num_partitions": len(source.partitions)} if partitioned else {})
+        )
+        logger.info(f"Copying {source.num_entities} rows from {current} into {name}")
+        copy_all(source, target, args.batch_size, layout_converter(source, target))
+
+        # Building after the bulk copy is much faster than indexing segment by segment
+        logger.info(f"Building {index_params} on {name}")
+        target.create_index(field_name="embedding", index_params=index_params)
+        utility.wait_for_index_building_complete(name, index_name="")
+    target.load()
+    convert = layout_converter(source, target)
+
+    # Two passes: the first catches up the copy, the second is short, leaving little to the final pass
+    sync_collections(source, target, args.batch_size, convert)
+    max_id = sync_collections(source, target, args.batch_size, convert)
+    if args.no_switch:
+        print(f"Built {target.name}; switch with: python milvus_reindex.py --target {target.name}")
+        return
+
+    try:
+        client = redis.Redis.from_url(os.getenv("REDIS_URL", "redis://redis:6379"))
+        client.ping()
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable, API processes will fall back to time-based chunk ids: {e}")
+        client = None
+    first_new_id = seed_id_counter(client, max_id)
+
+    old = switch_alias(current, target)
+    logger.info(f"{MILVUS_COLLECTION} now points at {target.name}")
+
+    # Writes that reached the old collection between the last sync and the switch
+    sync_collections(old, target, args.batch_size, convert, copy_after=max_id, keep_from=first_new_id)
+
+    if args.drop_old:
+        old.release()
+        old.drop()
+        logger.info(f"Dropped {old.name}")
+    else:
+        print(f"Previous collection kept as {old.name}; drop it once the new index is verified")
+
+    dim = int(vector_field(target).params["dim"])
+    if dim != EMBEDDING_DIM:
+        # Running processes follow the collection; the setting matters for restarts and new collections
+        print(f"Set EMBEDDING_DIMENSIONS={dim} for the API and workers")
+        if VECTOR_ENGINE == "auto":
+            print("The local failover store still holds the old vectors; rebuild it with "
+                  "benchmark_local_index.py --sync --local-dir <new dir> and point LOCAL_VECTOR_DIR at it")
+
+if __name__ == "__main__":
+    main()
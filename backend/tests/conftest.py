@@ -0,0 +1,7 @@
+"""Shared setup: main.py reads its settings at import time, so they are set before any test imports it."""
+
+import os
+import sys
+
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+import main
+
+INTERACTIVE = main.PRIORITY_INTERACTIVE
+INGEST = main.PRIORITY_INGEST
+
+
+def test_semaphore_grants_up_to_limit():
+    async def run():
+        semaphore = main.PrioritySemaphore(2, reserve=0)
+        await semaphore.acquire(INTERACTIVE)
+        await semaphore.acquire(INTERACTIVE)
+        with pytest.raises(asyncio.TimeoutError):
+            await semaphore.acquire(INTERACTIVE, timeout=0.01)
+        assert semaphore.active == 2
+        semaphore.release()
+        await semaphore.acquire(INTERACTIVE, timeout=0.01)
+        assert semaphore.active == 2
+
+    asyncio.run(run())
+
+
+def test_semaphore_keeps_reserve_for_interactive():
+    async def run():
+        semaphore = main.PrioritySemaphore(4, reserve=0.5)
+        await semaphore.acquire(INGEST)
+        await semaphore.acquire(INGEST)
+        with pytest.raises(asyncio.TimeoutError):
+            await semaphore.acquire(INGEST, timeout=0.01)
+        await semaphore.acquire(INTERACTIVE, timeout=0.01)
+        await semaphore.acquire(INTERACTIVE, timeout=0.01)
+        assert semaphore.active == 4
+
+    asyncio.run(run())
+
+
+def test_semaphore_hands_freed_slot_to_most_urgent_waiter():
+    async def run():
+        semaphore = main.PrioritySemaphore(1, reserve=0)
+        await semaphore.acquire(INTERACTIVE)
+        granted = []
+
+        async def wait(priority, name):
+            await semaphore.acquire(priority)
+            granted.append(name)
+
+        ingest = asyncio.create_task(wait(INGEST, "ingest"))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(wait(INTERACTIVE, "interactive"))
+        await asyncio.sleep(0)
+        semaphore.release()
+        await interactive
+        assert granted == ["interactive"]
+        semaphore.release()
+        await ingest
+        assert granted == ["interactive", "ingest"]
+
+    asyncio.run(run())
+
+
+def test_semaphore_timed_out_waiter_does_not_leak_a_slot():
+    async def run():
+        semaphore = main.PrioritySemaphore(1, reserve=0)
+        await semaphore.acquire(INTERACTIVE)
+        with pytest.raises(asyncio.TimeoutError):
+            await semaphore.acquire(INTERACTIVE, timeout=0.01)
+        semaphore.release()
+        assert semaphore.active == 0
+        await semaphore.acquire(INTERACTIVE, timeout=0.01)
+        assert semaphore.active == 1
+
+    asyncio.run(run())
+
+
+def test_semaphore_expected_wait():
+    async def run():
+        semaphore = main.PrioritySemaphore(1, reserve=0)
+        assert semaphore.expected_wait(INTERACTIVE) == 0.0
+        await semaphore.acquire(INTERACTIVE)
+        assert semaphore.expected_wait(INTERACTIVE) == pytest.approx(semaphore.hold_seconds)
+
+    asyncio.run(run())
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+def test_token_bucket_allows_cost_within_level(clock):
+    bucket = main.TokenBucket(60)
+    assert bucket.shortfall(10, reserve=0) == 0.0
+
+
+def test_token_bucket_shortfall_is_time_to_refill(clock):
+    bucket = main.TokenBucket(60)
+    bucket.level = 0.0
+    assert bucket.shortfall(6, reserve=0) == pytest.approx(6.0)
+    clock.now += 3
+    assert bucket.shortfall(6, reserve=0) == pytest.approx(3.0)
+
+
+def test_token_bucket_reserve_is_kept_back(clock):
+    bucket = main.TokenBucket(100)
+    bucket.level = 30.0
+    assert bucket.shortfall(10, reserve=0) == 0.0
+    # 10 + 25 reserved > 30 available: 5 tokens short at 100 per minute
+    assert bucket.shortfall(10, reserve=0.25) == pytest.approx(3.0)
+
+
+def test_token_bucket_caps_cost_and_level(clock):
+    bucket = main.TokenBucket(60)
+    clock.now += 600
+    bucket.refill()
+    assert bucket.level == 60.0
+    # A cost above the usable capacity is capped so it can eventually pass
+    assert bucket.shortfall(1000, reserve=0.5) == 0.0
@@ -0,0 +1,93 @@
+import pytest
+
+import main
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    monkeypatch.setattr(main, "CIRCUIT_MIN_CALLS", 4)
+    monkeypatch.setattr(main, "CIRCUIT_ERROR_THRESHOLD", 0.5)
+    monkeypatch.setattr(main, "CIRCUIT_OPEN_SECONDS", 30.0)
+    monkeypatch.setattr(main, "CIRCUIT_SLOW_CALL_MS", 1000.0)
+    return clock
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = main.CircuitBreaker("model-a")
+    for _ in range(3):
+        breaker.record_failure()
+    assert not breaker.is_open()
+    assert breaker.allow()
+
+
+def test_opens_at_error_threshold(clock):
+    breaker = main.CircuitBreaker("model-a")
+    breaker.record_success(0.1)
+    breaker.record_success(0.1)
+    breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+
+def test_slow_first_token_counts_as_failure(clock):
+    breaker = main.CircuitBreaker("model-a")
+    for _ in range(4):
+        breaker.record_success(2.0)
+    assert breaker.is_open()
+
+
+def test_half_open_allows_a_single_trial(clock):
+    breaker = main.CircuitBreaker("model-a")
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 31
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes(clock):
+    breaker = main.CircuitBreaker("model-a")
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 31
+    assert breaker.allow()
+    breaker.record_success(0.1)
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert len(breaker.outcomes) == 0
+
+
+def test_failed_trial_reopens(clock):
+    breaker = main.CircuitBreaker("model-a")
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 31
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 2
+    assert breaker.allow()
+
+
+def test_abandoned_trial_expires(clock):
+    breaker = main.CircuitBreaker("model-a")
+    for _ in range(4):
+        breaker.record_failure()
+    clock.now += 31
+    assert breaker.allow()
+    clock.now += 31
+    assert breaker.allow()
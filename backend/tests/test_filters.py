@@ -0,0 +1,58 @@
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def collection_fields(monkeypatch):
+    monkeypatch.setattr(main, "milvus_fields", {
+        "id", "embedding", "title", "source", "doc_id", "jurisdiction",
+        "document_type", "legal_domain", "document_date"
+    })
+
+
+def test_no_filters():
+    assert main.build_filter_expression(None) is None
+    assert main.build_filter_expression({}) is None
+    assert main.build_filter_expression({"jurisdiction": None, "legal_domain": []}) is None
+
+
+def test_equality_and_list_filters():
+    expression = main.build_filter_expression({"jurisdiction": "federal", "document_type": ["ley", "reglamento"]})
+    assert expression == '(jurisdiction == "federal") and (document_type in ["ley", "reglamento"])'
+
+
+def test_title_prefix_strips_wildcards():
+    assert main.build_filter_expression({"title": "Código%"}) == '(title like "Código%")'
+
+
+def test_date_range():
+    expression = main.build_filter_expression({"date_from": "2020-01-01", "date_to": 1700000000})
+    assert expression == (
+        f"(document_date >= {main.parse_document_date('2020-01-01')}) and (document_date <= 1700000000)"
+    )
+
+
+def test_values_are_quoted():
+    assert main.build_filter_expression({"source": 'a" or id > 0 or "'}) == '(source == "a\\" or id > 0 or \\"")'
+
+
+def test_invalid_date_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        main.build_filter_expression({"date_from": "ayer"})
+    assert error.value.status_code == 400
+
+
+def test_unknown_filter_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        main.build_filter_expression({"author": "x"})
+    assert error.value.status_code == 400
+
+
+def test_filter_on_missing_field_is_rejected(monkeypatch):
+    monkeypatch.setattr(main, "milvus_fields", {"id", "embedding", "title", "source"})
+    with pytest.raises(HTTPException) as error:
+        main.build_filter_expression({"jurisdiction": "federal"})
+    assert error.value.status_code == 400
+    assert main.build_filter_expression({"source": "cff.pdf"}) == '(source == "cff.pdf")'
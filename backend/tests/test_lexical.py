@@ -0,0 +1,59 @@
+import pytest
+
+import main
+
+
+def test_rrf_sums_weighted_reciprocal_ranks():
+    scores = main.reciprocal_rank_fusion([([1, 2, 3], 1.0), ([3, 1], 1.0)], k=60)
+    assert scores[1] == pytest.approx(1 / 61 + 1 / 62)
+    assert scores[2] == pytest.approx(1 / 62)
+    assert scores[3] == pytest.approx(1 / 63 + 1 / 61)
+    assert sorted(scores, key=scores.get, reverse=True) == [1, 3, 2]
+
+
+def test_rrf_weights_scale_each_ranking():
+    scores = main.reciprocal_rank_fusion([([1], 1.0), ([2], 2.0)], k=60)
+    assert scores[2] == pytest.approx(2 * scores[1])
+    assert main.reciprocal_rank_fusion([([1, 2], 0.0)]) == {1: 0.0, 2: 0.0}
+
+
+@pytest.fixture
+def index():
+    index = main.LexicalIndex()
+    index.add(10, "Artículo 1. El contribuyente deberá presentar la declaración anual.", "cff.pdf")
+    index.add(20, "Artículo 2. La declaración se presenta ante el SAT en abril.", "cff.pdf")
+    index.add(30, "Artículo 123. Toda persona tiene derecho al trabajo digno.", "constitucion.pdf")
+    return index
+
+
+def test_lexical_search_ranks_matching_chunks(index):
+    results = index.search("declaración anual del contribuyente", 5)
+    assert [milvus_id for milvus_id, _ in results] == [10, 20]
+    assert results[0][1] > results[1][1] > 0
+
+
+def test_lexical_search_ignores_accents_and_case(index):
+    assert [milvus_id for milvus_id, _ in index.search("TRABAJO DIGNO", 5)] == [30]
+    assert [milvus_id for milvus_id, _ in index.search("declaracion", 5)] == [10, 20]
+
+
+def test_lexical_search_without_matches(index):
+    assert index.search("inexistente", 5) == []
+    assert main.LexicalIndex().search("declaración", 5) == []
+
+
+def test_lexical_remove_masks_chunks(index):
+    assert index.remove([10, 99]) == 1
+    assert [milvus_id for milvus_id, _ in index.search("declaración", 5)] == [20]
+    assert index.live_docs == 2
+
+
+def test_lexical_readd_replaces_chunk(index):
+    index.add(10, "Texto sobre el impuesto predial.", "cff.pdf")
+    assert index.live_docs == 3
+    assert [milvus_id for milvus_id, _ in index.search("predial", 5)] == [10]
+    assert [milvus_id for milvus_id, _ in index.search("contribuyente", 5)] == []
+
+
+def test_lexical_search_respects_top_k(index):
+    assert len(index.search("artículo declaración trabajo", 1)) == 1
@@ -0,0 +1,53 @@
+import numpy as np
+
+import main
+
+
+def unit(rows):
+    vectors = np.asarray(rows, dtype=np.float64)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_relevance_only_keeps_score_order():
+    relevance = np.array([0.2, 0.9, 0.5, 0.7])
+    vectors = np.eye(4)
+    groups = np.arange(4)
+    assert main.mmr_order(relevance, vectors, groups, 4, diversity_lambda=1.0, max_per_group=0) == [1, 3, 2, 0]
+
+
+def test_redundant_candidate_is_pushed_down():
+    relevance = np.array([1.0, 0.95, 0.8])
+    vectors = unit([[1, 0], [1, 0.01], [0, 1]])
+    groups = np.arange(3)
+    assert main.mmr_order(relevance, vectors, groups, 2, diversity_lambda=0.5, max_per_group=0) == [0, 2]
+
+
+def test_returns_at_most_top_k_and_no_duplicates():
+    rng = np.random.default_rng(0)
+    relevance = rng.random(10)
+    vectors = unit(rng.normal(size=(10, 8)))
+    groups = rng.integers(0, 3, 10)
+    order = main.mmr_order(relevance, vectors, groups, 6)
+    assert len(order) == 6
+    assert len(set(order)) == 6
+    assert len(main.mmr_order(relevance[:3], vectors[:3], groups[:3], 6)) == 3
+
+
+def test_source_cap_yields_to_comparably_relevant_source():
+    relevance = np.array([1.0, 0.98, 0.97, 0.9])
+    vectors = np.eye(4)
+    groups = np.array([0, 0, 0, 1])
+    order = main.mmr_order(relevance, vectors, groups, 3, diversity_lambda=1.0, max_per_group=2, cap_margin=0.15)
+    assert order == [0, 1, 3]
+
+
+def test_source_cap_does_not_promote_weak_candidates():
+    relevance = np.array([1.0, 0.98, 0.97, 0.3])
+    vectors = np.eye(4)
+    groups = np.array([0, 0, 0, 1])
+    order = main.mmr_order(relevance, vectors, groups, 3, diversity_lambda=1.0, max_per_group=2, cap_margin=0.15)
+    assert order == [0, 1, 2]
+
+
+def test_empty_candidates():
+    assert main.mmr_order(np.array([]), np.zeros((0, 4)), np.array([], dtype=np.int64), 5) == []
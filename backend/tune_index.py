@@ -0,0 +1,227 @@
+"""
+Milvus Index Tuning
+Measures recall@k (against exact search) and latency of the collection's ANN index over a
+sweep of search parameters, and recommends the cheapest setting meeting a recall and p99 target
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from pymilvus import connections, Collection
+
+import main
+from main import (
+    describe_milvus_collection,
+    initialize_clients,
+    close_openrouter_client,
+    generate_embeddings_batch,
+    MILVUS_COLLECTION,
+    logger
+)
+
+# Search parameter sweeps, cheapest first
+SWEEPS = {
+    "HNSW": ("ef", [16, 32, 48, 64, 96, 128, 192, 256, 384, 512]),
+    "IVF_FLAT": ("nprobe", [1, 2, 4, 8, 16, 32, 64, 128, 256]),
+    "IVF_SQ8": ("nprobe", [1, 2, 4, 8, 16, 32, 64, 128, 256]),
+    "IVF_PQ": ("nprobe", [1, 2, 4, 8, 16, 32, 64, 128, 256])
+}
+
+def percentile_ms(samples: List[float], q: float) -> float:
+    return float(np.percentile(samples, q) * 1000) if samples else 0.0
+
+def collect_ids(collection: Collection, batch_size: int) -> np.ndarray:
+    iterator = collection.query_iterator(batch_size=batch_size, expr="id >= 0", output_fields=["id"])
+    ids = []
+    while True:
+        rows = iterator.next()
+        if not rows:
+            break
+        ids.extend(int(row["id"]) for row in rows)
+    iterator.close()
+    return np.asarray(ids, dtype=np.int64)
+
+def sample_queries(collection: Collection, count: int, noise: float, batch_size: int, seed: int):
+    """Perturbed copies of stored vectors; each query's own row is excluded from its results"""
+    rng = np.random.default_rng(seed)
+    ids = collect_ids(collection, batch_size)
+    chosen = np.sort(rng.choice(ids, size=min(count, len(ids)), replace=False)).tolist()
+    rows = []
+    for start in range(0, len(chosen), batch_size):
+        rows += collection.query(expr=f"id in {chosen[start:start + batch_size]}", output_fields=["id", "embedding"])
+    sample = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+    scale = np.linalg.norm(sample, axis=1, keepdims=True) / np.sqrt(sample.shape[1])
+    queries = sample + rng.standard_normal(sample.shape).astype(np.float32) * scale * noise
+    return queries, [int(row["id"]) for row in rows]
+
+def embed_query_file(path: str) -> np.ndarray:
+    """Real user queries, one per line, embedded like /api/search does"""
+    with open(path, encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()]
+
+    async def embed():
+        await initialize_clients()
+        try:
+            return await generate_embeddings_batch(texts)
+        finally:
+            await close_openrouter_client()
+            if main.redis_client:
+                await main.redis_client.aclose()
+
+    embeddings = [embedding for embedding in asyncio.run(embed()) if embedding is not None]
+    if not embeddings:
+        raise SystemExit(f"Could not embed any query from {path}")
+    return np.asarray(embeddings, dtype=np.float32)
+
+def exact_search(collection: Collection, queries: np.ndarray, limit: int, metric: str, batch_size: int) -> List[List[int]]:
+    """Brute-force top-limit ids per query, streaming the collection so memory stays bounded"""
+    best_ids = np.full((len(queries), 0), -1, dtype=np.int64)
+    best_keys = np.zeros((len(queries), 0), dtype=np.float32)
+    query_norms = np.linalg.norm(queries, axis=1)
+    iterator = collection.query_iterator(batch_size=batch_size, expr="id >= 0", output_fields=["id", "embedding"])
+    while True:
+        rows = iterator.next()
+        if not rows:
+            break
+        vectors = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+        products = queries @ vectors.T
+        # Sort keys are "smaller is nearer" for every metric
+        if metric == "L2":
+            keys = (vectors * vectors).sum(axis=1)[None, :] - 2.0 * products
+        elif metric == "IP":
+            keys = -products
+        else:
+            keys = -products / np.maximum(query_norms[:, None] * np.linalg.norm(vectors, axis=1)[None, :], 1e-12)
+        ids = np.broadcast_to(np.asarray([int(row["id"]) for row in rows], dtype=np.int64), keys.shape)
+        merged_keys = np.concatenate([best_keys, keys], axis=1)
+        merged_ids = np.concatenate([best_ids, ids], axis=1)
+        if merged_keys.shape[1] > limit:
+            keep = np.argpartition(merged_keys, limit, axis=1)[:, :limit]
+            merged_keys = np.take_along_axis(merged_keys, keep, axis=1)
+            merged_ids = np.take_along_axis(merged_ids, keep, axis=1)
+        best_keys, best_ids = merged_keys, merged_ids
+    iterator.close()
+    order = np.argsort(best_keys, axis=1)
+    return np.take_along_axis(best_ids, order, axis=1).tolist()
+
+def without(ids: List[int], excluded: Optional[int], k: int) -> List[int]:
+    return [row_id for row_id in ids if row_id != excluded][:k]
+
+def measure(
+    collection: Collection,
+    queries: np.ndarray,
+    truth: List[List[int]],
+    excluded: List[Optional[int]],
+    search_param: Dict[str, Any],
+    top_k: int,
+    warmup: int
+) -> Dict[str, float]:
+    limit = top_k + 1
+    for query in queries[:warmup]:
+        collection.search(data=[query.tolist()], anns_field="embedding", param=search_param, limit=limit)
+
+    recalls, timings = [], []
+    for query, expected, own_id in zip(queries, truth, excluded):
+        started = time.perf_counter()
+        hits = collection.search(data=[query.tolist()], anns_field="embedding", param=search_param, limit=limit)
+        timings.append(time.perf_counter() - started)
+        found = without([int(hit.id) for hit in hits[0]], own_id, top_k)
+        expected = without(expected, own_id, top_k)
+        recalls.append(len(set(found) & set(expected)) / max(len(expected), 1))
+    return {
+        f"recall@{top_k}": float(np.mean(recalls)),
+        "p50_ms": percentile_ms(timings, 50),
+        "p95_ms": percentile_ms(timings, 95),
+        "p99_ms": percentile_ms(timings, 99)
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--collection", default=MILVUS_COLLECTION, help="Collection or alias, e.g. one built by milvus_reindex.py --no-switch")
+    parser.add_argument("--queries", type=int, default=200, help="Held-out queries sampled from stored vectors")
+    parser.add_argument("--queries-file", help="Text file of real queries, one per line, used instead of sampling")
+    parser.add_argument("--noise", type=float, default=0.05, help="Relative noise added to sampled query vectors")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--max-p99-ms", type=float, default=50.0)
+    parser.add_argument("--values", help="Comma-separated ef/nprobe values to sweep instead of the defaults")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    connections.connect(
+        alias="default",
+        host=os.getenv("MILVUS_HOST", "milvus-standalone"),
+        port=int(os.getenv("MILVUS_PORT", "19530"))
+    )
+    collection = Collection(args.collection)
+    collection.load()
+    describe_milvus_collection(collection)
+    index_type = main.milvus_index.get("index_type")
+    metric = main.milvus_index.get("metric_type", "L2")
+    if main.milvus_index.get("binary"):
+        raise SystemExit("Binary collections are re-scored from the chunk store; compare layouts with vector_memory_report.py")
+    if index_type not in SWEEPS:
+        raise SystemExit(f"Nothing to tune for a {index_type or 'missing'} index")
+    name, values = SWEEPS[index_type]
+    if args.values:
+        values = [int(value) for value in args.values.split(",")]
+    if name == "nprobe" and "nlist" in main.milvus_index["params"]:
+        values = [value for value in values if value <= int(main.milvus_index["params"]["nlist"])]
+    if name == "ef":
+        values = [value for value in values if value >= args.top_k + 1]
+
+    if args.queries_file:
+        queries = embed_query_file(args.queries_file)
+        excluded: List[Optional[int]] = [None] * len(queries)
+    else:
+        queries, excluded = sample_queries(collection, args.queries, args.noise, args.batch_size, args.seed)
+    logger.info(f"Computing exact {metric} neighbours of {len(queries)} queries over {collection.num_entities} vectors")
+    truth = exact_search(collection, queries, args.top_k + 1, metric, args.batch_size)
+
+    results = []
+    for value in values:
+        search_param = {"metric_type": metric, "params": {name: value}}
+        metrics = measure(collection, queries, truth, excluded, search_param, args.top_k, args.warmup)
+        results.append(dict(metrics, **{name: value}))
+        print(f"{name}={value:<5d} " + "  ".join(f"{key}={metric_value:.3f}" for key, metric_value in metrics.items()))
+
+    recall_key = f"recall@{args.top_k}"
+    passing = [
+        result for result in results
+        if result[recall_key] >= args.target_recall and result["p99_ms"] <= args.max_p99_ms
+    ]
+    recommendation = passing[0] if passing else None
+
+    print(f"{collection.num_entities} vectors, {len(queries)} queries, {index_type}/{metric} {main.milvus_index['params']}")
+    if recommendation:
+        print(f"Recommended: MILVUS_SEARCH_PARAMS='{json.dumps({name: recommendation[name]})}' "
+              f"({recall_key}={recommendation[recall_key]:.3f}, p99={recommendation['p99_ms']:.1f}ms)")
+    else:
+        best = max(results, key=lambda result: result[recall_key]) if results else None
+        print(f"No {name} meets recall {args.target_recall} within {args.max_p99_ms}ms p99"
+              + (f"; best was {name}={best[name]} at {recall_key}={best[recall_key]:.3f}, p99={best['p99_ms']:.1f}ms" if best else "")
+              + "; consider a different index (milvus_reindex.py)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "collection": args.collection,
+                "index": main.milvus_index,
+                "vectors": collection.num_entities,
+                "queries": len(queries),
+                "target_recall": args.target_recall,
+                "max_p99_ms": args.max_p99_ms,
+                "results": results,
+                "recommended": {name: recommendation[name]} if recommendation else None
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,191 @@
+"""
+Vector Memory Report
+Estimates Milvus memory and recall@k for each combination of embedding dimensions, quantization
+and re-scoring shortlist size, simulated on a sample of stored vectors against exact search
+at full precision
+"""
+
+import argparse
+import json
+import os
+from typing import Any, Dict, List
+
+import numpy as np
+from pymilvus import connections, Collection
+
+from main import LocalVectorStore, fit_dimensions, chunk_store, MILVUS_COLLECTION, logger
+
+QUANTIZATIONS = ["none", "scalar", "binary"]
+
+def field_bytes(row: Dict[str, Any]) -> int:
+    """Approximate in-memory size of a row's scalar fields, text excluded"""
+    size = 0
+    for key, value in row.items():
+        if key in ("content", "embedding"):
+            continue
+        size += len(value.encode()) if isinstance(value, str) else 8
+    return size
+
+def sample_milvus(collection: Collection, count: int, batch_size: int):
+    fields = {field.name for field in collection.schema.fields}
+    compact = "content" not in fields
+    iterator = collection.query_iterator(
+        batch_size=batch_size,
+        expr="id >= 0",
+        output_fields=[name for name in fields if not compact or name != "embedding"]
+    )
+    rows: List[Dict[str, Any]] = []
+    while len(rows) < count:
+        batch = iterator.next()
+        if not batch:
+            break
+        batch = [dict(row) for row in batch]
+        if compact:
+            # Full-precision vectors and text live in the chunk store
+            stored = chunk_store.get([int(row["id"]) for row in batch], vectors=True)
+            batch = [dict(row, **stored[int(row["id"])]) for row in batch if int(row["id"]) in stored]
+        rows += batch
+    iterator.close()
+    rows = rows[:count]
+    return (
+        np.asarray([row["embedding"] for row in rows], dtype=np.float32),
+        float(np.mean([len((row.get("content") or "").encode()) for row in rows])),
+        float(np.mean([field_bytes(row) for row in rows]))
+    )
+
+def sample_local(directory: str, count: int, seed: int):
+    store = LocalVectorStore(directory)
+    store.refresh()
+    live = np.flatnonzero(store.alive[:store.count])
+    chosen = np.sort(np.random.default_rng(seed).choice(live, size=min(count, len(live)), replace=False))
+    rows = [store.rows[position] for position in chosen]
+    metadata = [dict(row.get("metadata") or {}, title=row.get("title"), source=row.get("source")) for row in rows]
+    return (
+        np.asarray(store.matrix[chosen], dtype=np.float32),
+        float(np.mean([len((row.get("content") or "").encode()) for row in rows])),
+        float(np.mean([field_bytes({key: value for key, value in row.items() if value is not None}) for row in metadata]))
+    )
+
+def top_ids(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores per row, best first"""
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(best, np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1), axis=1)
+
+def approximate_scores(vectors: np.ndarray, queries: np.ndarray, quantization: str) -> np.ndarray:
+    """Similarities as a quantized index would see them"""
+    if quantization == "binary":
+        # Agreeing minus disagreeing sign bits, which ranks exactly like Hamming distance
+        return np.where(queries > 0, 1.0, -1.0).astype(np.float32) @ np.where(vectors > 0, 1.0, -1.0).astype(np.float32).T
+    if quantization == "scalar":
+        # SQ8 as Milvus builds it: per-dimension min/max, 256 levels
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        step = np.maximum(high - low, 1e-12) / 255.0
+        decoded = np.round((vectors - low) / step) * step + low
+        return queries @ decoded.T
+    return queries @ vectors.T
+
+def vector_bytes(dim: int, quantization: str) -> float:
+    return {"none": 4.0 * dim, "scalar": float(dim), "binary": dim / 8.0}[quantization]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--local-dir", help="Sample the embedded vector store instead of Milvus")
+    parser.add_argument("--sample", type=int, default=20000, help="Stored vectors to simulate on")
+    parser.add_argument("--queries", type=int, default=200, help="Held-out queries (perturbed sample vectors)")
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dimensions", default="1536,1024,512,256", help="Comma-separated dimensions to try")
+    parser.add_argument("--rescore", default="1,2,4,8", help="Comma-separated shortlist multipliers for quantized vectors")
+    parser.add_argument("--vectors", type=int, help="Collection size to project memory for; defaults to the current size")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    if args.local_dir:
+        sample, content_bytes, metadata_bytes = sample_local(args.local_dir, args.sample, args.seed)
+        total = args.vectors or len(sample)
+    else:
+        connections.connect(
+            alias="default",
+            host=os.getenv("MILVUS_HOST", "milvus-standalone"),
+            port=int(os.getenv("MILVUS_PORT", "19530"))
+        )
+        collection = Collection(MILVUS_COLLECTION)
+        collection.load()
+        sample, content_bytes, metadata_bytes = sample_milvus(collection, args.sample, args.batch_size)
+        total = args.vectors or collection.num_entities
+    if len(sample) <= args.top_k:
+        raise SystemExit("Not enough stored vectors to sample")
+
+    full_dim = sample.shape[1]
+    dims = sorted({dim for dim in (int(value) for value in args.dimensions.split(",")) if dim <= full_dim}, reverse=True)
+    multipliers = sorted(int(value) for value in args.rescore.split(","))
+
+    # Queries are perturbed copies of sampled vectors; each query's own vector is excluded
+    rng = np.random.default_rng(args.seed)
+    own = rng.choice(len(sample), size=min(args.queries, len(sample)), replace=False)
+    scale = np.linalg.norm(sample[own], axis=1, keepdims=True) / np.sqrt(full_dim)
+    queries = sample[own] + rng.standard_normal((len(own), full_dim)).astype(np.float32) * scale * args.noise
+    sample = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+    def without_own(scores: np.ndarray) -> np.ndarray:
+        scores = scores.copy()
+        scores[np.arange(len(own)), own] = -np.inf
+        return scores
+
+    truth = top_ids(without_own(queries @ sample.T), args.top_k)
+    logger.info(f"Simulating on {len(sample)} vectors of {full_dim} dimensions with {len(own)} queries")
+
+    results = []
+    for dim in dims:
+        vectors, dim_queries = fit_dimensions(sample, dim), fit_dimensions(queries, dim)
+        exact = without_own(dim_queries @ vectors.T)
+        for quantization in QUANTIZATIONS:
+            approximate = without_own(approximate_scores(vectors, dim_queries, quantization))
+            for multiplier in (multipliers if quantization != "none" else [1]):
+                shortlist = top_ids(approximate, args.top_k * multiplier)
+                if quantization != "none":
+                    # Re-score the shortlist with full-precision vectors, as search_milvus does
+                    rescored = np.take_along_axis(exact, shortlist, axis=1)
+                    shortlist = np.take_along_axis(shortlist, np.argsort(-rescored, axis=1), axis=1)
+                found = shortlist[:, :args.top_k]
+                recall = float(np.mean([len(set(f) & set(t)) / args.top_k for f, t in zip(found.tolist(), truth.tolist())]))
+                in_memory = vector_bytes(dim, quantization) + metadata_bytes
+                results.append({
+                    "dimensions": dim,
+                    "quantization": quantization,
+                    "rescore_multiplier": multiplier if quantization != "none" else None,
+                    f"recall@{args.top_k}": recall,
+                    "milvus_gb_text_in_milvus": total * (in_memory + content_bytes) / 1e9,
+                    "milvus_gb_text_in_chunk_store": total * in_memory / 1e9,
+                    "chunk_store_gb": total * (4.0 * dim + content_bytes) / 1e9
+                })
+
+    recall_key = f"recall@{args.top_k}"
+    print(f"{total} vectors projected from {len(sample)} sampled ({full_dim} dims, "
+          f"{content_bytes:.0f} B text, {metadata_bytes:.0f} B fields per chunk); raw vectors and fields, before index overhead")
+    print(f"{'dims':>5s} {'quant':>7s} {'rescore':>7s} {recall_key:>10s} {'GB w/ text':>10s} {'GB compact':>10s} {'store GB':>9s}")
+    for result in results:
+        print(
+            f"{result['dimensions']:5d} {result['quantization']:>7s} {str(result['rescore_multiplier'] or '-'):>7s} "
+            f"{result[recall_key]:10.3f} {result['milvus_gb_text_in_milvus']:10.2f} "
+            f"{result['milvus_gb_text_in_chunk_store']:10.2f} {result['chunk_store_gb']:9.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "vectors": total,
+                "sampled": len(sample),
+                "queries": len(own),
+                "source_dimensions": full_dim,
+                "content_bytes": content_bytes,
+                "field_bytes": metadata_bytes,
+                "results": results
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
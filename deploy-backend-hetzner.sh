@@ -205,6 +205,11 @@ tar czf ../backend-deploy.tar.gz \
     docker-compose.yml \
     requirements.txt \
     main.py \
+    ingest_worker.py \
+    bulk_ingest.py \
+    milvus_reindex.py \
+    tune_index.py \
+    vector_memory_report.py \
     .env \
     nginx/ \
     config/ \
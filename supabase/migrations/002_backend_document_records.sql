@@ -0,0 +1,22 @@
+-- ============================================
+-- Legal RAG Mexico - Backend document records
+-- ============================================
+-- Run after 001_initial_schema.sql.
+-- The backend records each ingested document in public.documents, upserting
+-- on its own document_id (the id used in Milvus and the ingest APIs), which
+-- is not the table's UUID primary key.
+
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS document_id TEXT;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS user_id TEXT;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS source TEXT;
+ALTER TABLE public.documents ADD COLUMN IF NOT EXISTS chunks_count INTEGER DEFAULT 0;
+
+-- Upserts (ON CONFLICT (document_id)) need a unique constraint; rows created
+-- outside the backend keep a NULL document_id, which never conflicts
+DO $$ BEGIN
+    ALTER TABLE public.documents ADD CONSTRAINT documents_document_id_key UNIQUE (document_id);
+EXCEPTION
+    WHEN duplicate_object OR duplicate_table THEN null;
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_documents_user_id ON public.documents(user_id);